@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""Benchmark of article fetching.
+
+Serves a corpus of saved HTML pages from local HTTP servers, one per
+simulated site, and reports pages per second of:
+
+- sequential: download and parse one page at a time with newspaper, as
+  fetch jobs used to;
+- pipeline: fetcher threads feeding parser processes, as fetch jobs do
+  now (heutagogy.article.fetch_and_parse).
+
+Every response is delayed by --latency seconds to stand in for remote
+sites. Nothing is written to the database.
+
+Usage:
+    ./benchmarks/fetch.py --corpus ~/saved-pages --pages 200
+"""
+import argparse
+import glob
+import http.server
+import os
+import socketserver
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from heutagogy import app  # noqa
+from heutagogy.article import fetch_and_parse  # noqa
+from heutagogy.fetcher import Fetcher  # noqa
+
+from newspaper import Article  # noqa
+
+
+def generate_corpus(count):
+    """Synthetic article pages, for when no corpus is given."""
+    paragraph = '<p>{}</p>'.format(
+        'Heutagogy is the study of self-determined learning. ' * 40)
+    return [
+        '<html><head><title>Article {0}</title></head><body>'
+        '<div class="nav"><a href="/">Home</a> <a href="/about">About</a>'
+        '</div><article><h1>Article {0}</h1>{1}</article>'
+        '<div class="footer">Footer</div></body></html>'
+        .format(i, paragraph * 10).encode()
+        for i in range(count)
+    ]
+
+
+def load_corpus(path):
+    pages = []
+    for name in sorted(glob.glob(os.path.join(path, '**', '*.htm*'),
+                                 recursive=True)):
+        with open(name, 'rb') as f:
+            pages.append(f.read())
+    if not pages:
+        sys.exit('No .html files in {}'.format(path))
+    return pages
+
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, pages, latency):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.pages = pages
+        self.latency = latency
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        # Path is /<page number>
+        pages = self.server.pages
+        body = pages[int(self.path.strip('/')) % len(pages)]
+        time.sleep(self.server.latency)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def sequential(urls):
+    for url in urls:
+        article = Article(url, keep_article_html=True)
+        article.download()
+        article.parse()
+
+
+def pipeline(urls, parsers):
+    for _ in fetch_and_parse(urls, fetcher=Fetcher.from_config(),
+                             parsers=parsers):
+        pass
+
+
+def report(name, pages, elapsed):
+    print('{}: {} pages in {:.2f}s ({:.1f} pages/s)'.format(
+        name, pages, elapsed, pages / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--corpus', help='directory of saved .html pages')
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--sites', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--parsers', type=int,
+                        default=app.config['FETCH_PARSERS'])
+    parser.add_argument('--skip-sequential', action='store_true')
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus) if args.corpus \
+        else generate_corpus(50)
+    print('{} pages in corpus, {:.1f} MB'.format(
+        len(corpus), sum(map(len, corpus)) / 1e6))
+
+    servers = [Server(corpus, args.latency) for _ in range(args.sites)]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    urls = ['http://127.0.0.1:{}/{}'.format(
+        servers[i % len(servers)].server_port, i) for i in range(args.pages)]
+
+    if not args.skip_sequential:
+        start = time.perf_counter()
+        sequential(urls)
+        report('sequential', len(urls), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    pipeline(urls, args.parsers)
+    report('pipeline ({} workers, {} parsers)'.format(
+        app.config['FETCH_WORKERS'], args.parsers),
+        len(urls), time.perf_counter() - start)
+
+    for server in servers:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
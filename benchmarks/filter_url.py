@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of url normalization (views.filter_url).
+
+Browser extensions send hundreds of urls to /api/v1/bookmarks/lookup
+at once, and each of them is normalized before the lookup.
+
+Usage:
+    ./benchmarks/filter_url.py
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from heutagogy.views import filter_url  # noqa
+
+
+URLS = [
+    'https://github.com/heutagogy/heutagogy-backend',
+    'https://medium.com/some-article#.vlqdq2s5j',
+    'https://example.com/search?q=heutagogy&page=2&utm_source=twitter'
+    '&utm_medium=social&utm_campaign=launch',
+    'https://en.wikipedia.org/wiki/Heutagogy#History',
+    'https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=42s&list=PL123',
+    'http://localhost:5000/',
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--batch', type=int, default=500,
+                        help='number of urls in one lookup request')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    batch = (URLS * (args.batch // len(URLS) + 1))[:args.batch]
+
+    for url in URLS:
+        timings = timeit.repeat(lambda: filter_url(url),
+                                number=1000, repeat=args.repeat)
+        print('{:>8.2f} us  {}'.format(min(timings) * 1000, url))
+
+    timings = timeit.repeat(lambda: [filter_url(url) for url in batch],
+                            number=1, repeat=args.repeat)
+    print('{:>8.2f} ms  batch of {} urls'.format(
+        min(timings) * 1000, args.batch))
+
+
+if __name__ == '__main__':
+    main()
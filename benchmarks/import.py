@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Benchmark of bulk import (POST /api/v1/import).
+
+Generates a synthetic NDJSON export and runs it through the same
+parse, normalize and COPY pipeline as the import endpoint, for a user
+created for the run. Everything happens in one transaction that is
+rolled back, so the benchmark leaves no data behind. Fetch jobs are
+not enqueued.
+
+Usage:
+    DATABASE_URL=postgresql:///heutagogy ./benchmarks/import.py
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from heutagogy import app  # noqa
+from heutagogy.auth import User  # noqa
+import heutagogy.importer as importer  # noqa
+import heutagogy.persistence as db  # noqa
+from heutagogy.views import import_row  # noqa
+
+
+def generate(rows):
+    start = datetime.datetime(2017, 1, 1)
+    for i in range(rows):
+        yield json.dumps({
+            'url': 'https://example.com/{}?utm_source=feed&page={}'.format(
+                i, i % 10),
+            'title': 'Bookmark {}'.format(i),
+            'timestamp': (start + datetime.timedelta(minutes=i))
+            .isoformat() + '+02:00',
+            'read': None if i % 3 else '2017-06-01T00:00:00Z',
+            'tags': ['tag{}'.format(i % 50), 'tag{}'.format(i % 7)],
+        }) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args()
+
+    lines = list(generate(args.rows))
+    print('{} bookmarks, {:.1f} MB of NDJSON'.format(
+        args.rows, sum(map(len, lines)) / 1e6))
+
+    with app.app_context():
+        session = db.db.session
+        try:
+            user = User(username='benchmark-import',
+                        email='benchmark-import@example.com')
+            session.add(user)
+            session.flush()
+
+            now = datetime.datetime.utcnow()
+            start = time.perf_counter()
+            rows = (import_row(e, now, line) for line, e
+                    in enumerate(importer.parse_ndjson(lines), 1))
+            total, new = db.copy_bookmarks(user.id, rows)
+            elapsed = time.perf_counter() - start
+        finally:
+            session.rollback()
+
+    print('imported {} of {} in {:.2f}s ({:.0f} bookmarks/s)'.format(
+        len(new), total, elapsed, total / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""Benchmark of bookmark indexes.
+
+Seeds temporary copies of bookmark and note tables with synthetic
+data, then runs the hot query shapes before and after creating the
+indexes and prints plans and latencies. The tables and indexes are
+copies of what the migrations create, not the migrations themselves.
+
+Temporary tables are used, so the benchmark never touches real data
+and needs no cleanup.
+
+Usage:
+    DATABASE_URL=postgresql:///heutagogy ./benchmarks/indexes.py
+"""
+import argparse
+import os
+import statistics
+import time
+
+import sqlalchemy
+
+
+SCHEMA = '''
+CREATE TEMPORARY TABLE bookmark (
+    id serial PRIMARY KEY,
+    "user" integer NOT NULL,
+    timestamp timestamp NOT NULL,
+    url varchar NOT NULL,
+    title varchar NOT NULL,
+    read timestamp,
+    meta jsonb,
+    tags text[],
+    content_html text,
+    content_text text,
+    parent_id integer
+);
+CREATE TEMPORARY TABLE note (
+    id serial PRIMARY KEY,
+    bookmark_id integer NOT NULL,
+    text text NOT NULL
+);
+'''
+
+# Every user gets rows / users bookmarks. A third is unread, every
+# tenth has a parent, every fifth has a note.
+SEED = '''
+INSERT INTO bookmark ("user", timestamp, url, title, read, meta, tags,
+                      parent_id)
+SELECT i % :users + 1,
+       now() - i * interval '1 minute',
+       'https://example.com/' || i,
+       'Bookmark ' || i,
+       CASE WHEN i % 3 = 0 THEN NULL
+            ELSE now() - i * interval '30 seconds' END,
+       jsonb_build_object('source', 'source' || i % 20),
+       ARRAY['tag' || i % 50, 'tag' || i % 7],
+       CASE WHEN i % 10 = 0 THEN i - :users END
+FROM generate_series(1, :rows) AS i;
+
+INSERT INTO note (bookmark_id, text)
+SELECT id, 'Note ' || id FROM bookmark WHERE id % 5 = 0;
+
+ANALYZE bookmark;
+ANALYZE note;
+'''
+
+# Copies of the indexes of Bookmark and Note in heutagogy.persistence
+# that QUERIES use. Keep in sync.
+INDEXES = '''
+CREATE INDEX ix_bookmark_user_read_timestamp ON bookmark
+    ("user", read DESC NULLS FIRST, timestamp DESC, id DESC);
+CREATE INDEX ix_bookmark_user_url_md5 ON bookmark ("user", md5(url));
+CREATE INDEX ix_bookmark_tags ON bookmark USING gin (tags);
+CREATE INDEX ix_bookmark_user_timestamp ON bookmark ("user", timestamp);
+CREATE INDEX ix_bookmark_meta ON bookmark USING gin (meta jsonb_path_ops);
+CREATE INDEX ix_bookmark_parent_id ON bookmark (parent_id);
+CREATE INDEX ix_note_bookmark_id ON note (bookmark_id);
+ANALYZE bookmark;
+ANALYZE note;
+'''
+
+QUERIES = [
+    ('list page', '''
+        SELECT * FROM bookmark WHERE "user" = 1
+        ORDER BY read DESC NULLS FIRST, timestamp DESC, id DESC
+        LIMIT 21 OFFSET 200'''),
+    # Position of a cursor deep into the read bookmarks of the user
+    ('list page by cursor', '''
+        SELECT * FROM bookmark
+        WHERE "user" = 1
+          AND (read, timestamp, id) < (now() - interval '50 days', now(), 0)
+        ORDER BY read DESC NULLS FIRST, timestamp DESC, id DESC
+        LIMIT 21'''),
+    ('url lookup', '''
+        SELECT * FROM bookmark
+        WHERE "user" = 1
+          AND md5(url) = md5('https://example.com/1001')
+          AND url = 'https://example.com/1001' '''),
+    ('tag filter', '''
+        SELECT * FROM bookmark
+        WHERE "user" = 1 AND tags @> ARRAY['tag3', 'tag5']
+        ORDER BY read DESC NULLS FIRST, timestamp DESC, id DESC
+        LIMIT 21'''),
+    ('unread', '''
+        SELECT * FROM bookmark
+        WHERE "user" = 1 AND read IS NULL
+        ORDER BY read DESC NULLS FIRST, timestamp DESC, id DESC
+        LIMIT 21'''),
+    ('created range', '''
+        SELECT * FROM bookmark
+        WHERE "user" = 1
+          AND timestamp >= now() - interval '30 days'
+          AND timestamp < now() - interval '29 days'
+        ORDER BY read DESC NULLS FIRST, timestamp DESC, id DESC
+        LIMIT 21'''),
+    ('meta filter', '''
+        SELECT * FROM bookmark
+        WHERE "user" = 1 AND meta @> '{"source": "source1"}'
+        ORDER BY read DESC NULLS FIRST, timestamp DESC, id DESC
+        LIMIT 21'''),
+    ('children', '''
+        SELECT * FROM bookmark WHERE parent_id IN (
+            SELECT id FROM bookmark WHERE "user" = 1
+            ORDER BY read DESC NULLS FIRST, timestamp DESC, id DESC
+            LIMIT 20)'''),
+    ('notes', '''
+        SELECT * FROM note WHERE bookmark_id IN (
+            SELECT id FROM bookmark WHERE "user" = 1
+            ORDER BY read DESC NULLS FIRST, timestamp DESC, id DESC
+            LIMIT 20)'''),
+]
+
+
+def run(conn, repeat):
+    for name, query in QUERIES:
+        plan = conn.execute('EXPLAIN ' + query).fetchall()
+
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            conn.execute(query).fetchall()
+            timings.append((time.perf_counter() - start) * 1000)
+
+        print('--- {}: median {:.2f} ms, min {:.2f} ms'.format(
+            name, statistics.median(timings), min(timings)))
+        for line, in plan:
+            print('    ' + line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    engine = sqlalchemy.create_engine(
+        os.getenv('DATABASE_URL', 'postgresql:///heutagogy'))
+    with engine.connect() as conn:
+        conn.execute(SCHEMA)
+
+        print('Seeding {} bookmarks...'.format(args.rows))
+        conn.execute(sqlalchemy.text(SEED), rows=args.rows, users=args.users)
+
+        print('\n=== Without indexes')
+        run(conn, args.repeat)
+
+        conn.execute(INDEXES)
+
+        print('\n=== With indexes')
+        run(conn, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Benchmark of full-text search (GET /api/v1/search).
+
+Seeds users, pages and bookmarks with synthetic text, then checks with
+EXPLAIN that the query built by the endpoint looks up matches in both
+GIN indexes (of bookmarks and of pages) rather than scanning, and
+prints its plan and latency. Everything happens in one transaction
+that is rolled back, so the benchmark leaves no data behind.
+
+Exits with status 1 if an index isn't used.
+
+Usage:
+    DATABASE_URL=postgresql:///heutagogy ./benchmarks/search.py
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from heutagogy import app  # noqa
+import heutagogy.persistence as db  # noqa
+from heutagogy.views import search_bookmarks  # noqa
+
+
+# Every user gets rows / users bookmarks, each of a page of its own.
+# About one in a hundred bookmarks matches the terms in its title, and
+# one in a hundred pages in its content. Users have many bookmarks, so
+# that the indexes of the terms are more selective than that of user.
+SEED = '''
+INSERT INTO "user" (username, email, is_active)
+SELECT 'benchmark-search-' || i, 'benchmark-search-' || i || '@example.com',
+       true
+FROM generate_series(0, :users - 1) AS i;
+
+INSERT INTO page (url, content_text)
+SELECT 'https://benchmark-search.example/' || i,
+       'Article ' || i || ' about '
+       || CASE WHEN i % 89 = 1 THEN 'elephants' ELSE 'giraffes' END
+       || ' and other animals of topic ' || i % 500
+FROM generate_series(1, :rows) AS i;
+
+INSERT INTO bookmark ("user", timestamp, url, title, tags, page_id)
+SELECT "user".id, now(), page.url,
+       CASE WHEN p.i % 97 = 0 THEN 'Elephant ' ELSE 'Bookmark ' END || p.i,
+       ARRAY['tag' || p.i % 50],
+       page.id
+FROM page,
+     LATERAL (SELECT substring(page.url FROM '[0-9]+$')::integer AS i) AS p,
+     "user"
+WHERE page.url LIKE 'https://benchmark-search.example/%'
+  AND "user".username = 'benchmark-search-' || p.i % :users;
+
+ANALYZE "user";
+ANALYZE page;
+ANALYZE bookmark;
+'''
+
+INDEXES = ['ix_bookmark_search', 'ix_page_search']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--terms', default='elephant')
+    args = parser.parse_args()
+
+    with app.app_context():
+        session = db.db.session
+        try:
+            print('Seeding {} bookmarks...'.format(args.rows))
+            session.execute(sqlalchemy.text(SEED),
+                            {'rows': args.rows, 'users': args.users})
+            user = session.execute(
+                "SELECT id FROM \"user\" "
+                "WHERE username = 'benchmark-search-0'").scalar()
+
+            query = search_bookmarks(user, args.terms).limit(21)
+            compiled = query.statement.compile(dialect=postgresql.dialect())
+            plan = session.connection().execute(
+                'EXPLAIN ' + str(compiled), compiled.params).fetchall()
+
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                found = query.all()
+                timings.append((time.perf_counter() - start) * 1000)
+        finally:
+            session.rollback()
+
+    print('--- search: {} found, median {:.2f} ms, min {:.2f} ms'.format(
+        len(found), statistics.median(timings), min(timings)))
+    for line, in plan:
+        print('    ' + line)
+
+    text = '\n'.join(line for line, in plan)
+    missing = [index for index in INDEXES if index not in text]
+    if missing:
+        print('Not used: ' + ', '.join(missing))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,234 @@
-from heutagogy.persistence import db, Bookmark
+"""Fetching of bookmarked pages.
+
+Fetching runs as a pipeline of three stages, so that a worker waits on
+sockets and parses at the same time:
+
+1. Threads of a Fetcher download pages.
+2. A pool of processes parses downloaded pages with newspaper as soon
+   as they arrive. Parsing is CPU-bound, so it doesn't scale in threads.
+3. The calling process stores parsed pages in batches, with one commit
+   per batch.
+
+Content is stored once per url in a page that all bookmarks of the url
+reference. A page fetched less than PAGE_MAX_AGE seconds ago is reused
+without fetching. Jobs fetching the same url at the same time are
+coalesced with a lock in redis: the job holding the lock links the page
+to bookmarks of all users, so the others skip the url. Bookmarks are
+linked to an existing page, stale or not, before any fetching, so that
+they keep its content when refetching fails.
+
+Stale pages are refetched with conditional requests, using validators
+(ETag and Last-Modified) of the previous response. When the server
+responds 304 Not Modified, the page isn't parsed nor written, only its
+fetched_at is bumped. The refresh-pages command enqueues refetching of
+stale pages, most recently opened first. Opens are collected in redis,
+so that reading content doesn't write to the database, and are moved to
+pages when refresh-pages runs.
+"""
+from heutagogy import app
+from heutagogy.heutagogy import redis_db
+import heutagogy.persistence as db
+from heutagogy.fetcher import Fetcher
+import heutagogy.cache as cache
 
 from newspaper import Article
+import datetime
+import multiprocessing
+import redis.exceptions
+import time
 
 
 def fetch_article(id, url):
+    fetch_articles([(id, url)])
+
+
+def fetch_articles(bookmarks):
+    """Fetch content of (id, url) bookmarks."""
+    fetch_urls({url for _, url in bookmarks})
+
+
+def fetch_urls(urls):
+    """Fetch content of the urls and link it to their bookmarks. Pages
+    that fail to download or parse are skipped."""
+    urls = set(urls)
+
+    locks = {}
+    for url in urls:
+        lock = redis_db.lock(lock_key(url),
+                             timeout=app.config['FETCH_LOCK_TIMEOUT'])
+        if lock.acquire(blocking=False):
+            locks[url] = lock
+        # Otherwise the url is being fetched by another job, which
+        # links it to our bookmarks once the page is stored. An existing
+        # page is linked below anyway, in case that fetch fails.
+
+    try:
+        pages = db.find_pages(urls)
+        since = datetime.datetime.utcnow() - \
+            datetime.timedelta(seconds=app.config['PAGE_MAX_AGE'])
+        users = set()
+        for url, page in pages.items():
+            if page.fetched_at > since:
+                release(locks.pop(url, None))
+            # A stale page is refreshed in place, so bookmarks get its
+            # content now even if refetching fails
+            users |= db.link_page(page.id, url, page.title)
+        commit_links(users)
+
+        headers = {url: conditional_headers(pages[url])
+                   for url in locks if url in pages}
+        batch = []
+        for page in fetch_and_parse(list(locks), headers=headers):
+            batch.append(page)
+            if len(batch) >= app.config['FETCH_WRITE_BATCH']:
+                store_articles(batch, locks)
+                batch = []
+        store_articles(batch, locks)
+    finally:
+        for lock in locks.values():
+            release(lock)
+
+
+def conditional_headers(page):
+    """Headers that make refetching of the page respond 304 if it
+    didn't change."""
+    headers = {}
+    if page.etag:
+        headers['If-None-Match'] = page.etag
+    if page.last_modified:
+        headers['If-Modified-Since'] = page.last_modified
+    return headers
+
+
+# Hash of bookmark id to the time its content was last read
+OPENED_KEY = 'heutagogy:opened'
+
+
+def record_open(bookmark_id):
+    redis_db.hset(OPENED_KEY, bookmark_id, time.time())
+
+
+def flush_opens():
+    """Move opens recorded since the last flush to pages."""
+    with redis_db.pipeline() as pipe:
+        pipe.hgetall(OPENED_KEY)
+        pipe.delete(OPENED_KEY)
+        opens, _ = pipe.execute()
+
+    db.pages_opened({int(id): datetime.datetime.utcfromtimestamp(float(at))
+                     for id, at in opens.items()})
+    db.db.session.commit()
+
+
+def lock_key(url):
+    return 'heutagogy:fetch:{}'.format(db.url_hash(url))
+
+
+def release(lock):
+    if lock is None:
+        return
+    try:
+        lock.release()
+    except redis.exceptions.LockError:
+        # Expired, another job may be fetching the url already
+        pass
+
+
+def commit_links(users):
+    """Commit pages linked to bookmarks of the users."""
+    db.db.session.commit()
+    for user in users:
+        cache.bump_version(user)
+
+
+def fetch_and_parse(urls, fetcher=None, parsers=None, headers=None):
+    """Download and parse the urls. Yields (url, content) pairs in the
+    order pages are parsed, content being a dict of title, html, text
+    and validators etag and last_modified, or None if the page was not
+    modified. headers maps urls to extra request headers."""
+    urls = list(urls)
+    fetcher = fetcher or Fetcher.from_config()
+    if parsers is None:
+        parsers = app.config['FETCH_PARSERS']
+    parsers = min(parsers, len(urls))
+    pages = downloaded(fetcher, urls, headers)
+
+    if parsers <= 1:
+        yield from filter(None, map(parse_page, pages))
+        return
+
+    # Start parsers before downloads, so that no download thread runs
+    # when processes are forked
+    with multiprocessing.Pool(parsers) as pool:
+        yield from filter(None, pool.imap_unordered(parse_page, pages))
+
+
+def downloaded(fetcher, urls, headers=None):
+    """(url, html, validators) of pages that downloaded successfully,
+    html being None if the page was not modified."""
+    for url, page, error in fetcher.fetch_all(urls, headers):
+        if error is not None:
+            app.logger.warning('Could not fetch %s: %s', url, error)
+        else:
+            yield url, page.html, {
+                'etag': page.headers.get('ETag'),
+                'last_modified': page.headers.get('Last-Modified'),
+            }
+
+
+def parse_page(page):
+    """(url, content) of the downloaded (url, html, validators) page,
+    or None if it can't be parsed. Runs in a parser process."""
+    url, html, validators = page
+    if html is None:
+        return url, None
+
     article = Article(url, keep_article_html=True)
-    article.download()
-    article.parse()
+    try:
+        article.download(html)
+        article.parse()
+    except Exception:
+        app.logger.exception('Could not parse %s', url)
+        return None
+
+    return url, dict(validators, title=article.title,
+                     html=article.article_html, text=article.text)
+
+
+def store_articles(batch, locks=None):
+    """Store a batch of parsed (url, content) pages in a single
+    transaction, and link them to bookmarks of the urls. Pages with
+    None content were not modified, and only get their fetched_at
+    bumped.
+
+    Locks of the urls are released once the pages are committed and
+    before they are linked, so that bookmarks of jobs that saw the lock
+    are committed by then and get linked too.
+    """
+    if not batch:
+        return
+
+    pages = []
+    stored = []
+    for url, content in batch:
+        if content is None:
+            page = db.touch_page(url)
+            if page is not None:
+                pages.append((url, page.title, page.id))
+            continue
 
-    bookmark = Bookmark.query.get(id)
-    if bookmark.title == bookmark.url and article.title != '':
-        # title was not set
-        bookmark.title = article.title
+        page_id = db.store_page(
+            url, content['title'], content['html'], content['text'],
+            content.get('etag'), content.get('last_modified'))
+        pages.append((url, content['title'], page_id))
+        stored.append(page_id)
+    db.db.session.commit()
 
-    bookmark.content_html = article.article_html
-    bookmark.content_text = article.text
+    for url, _ in batch:
+        release((locks or {}).pop(url, None))
 
-    db.session.commit()
+    # Bookmarks that already referenced refreshed pages changed too
+    users = db.page_users(stored)
+    for url, title, page_id in pages:
+        users |= db.link_page(page_id, url, title)
+    commit_links(users)
@@ -15,9 +15,18 @@ from flask import request
 from flask_jwt import JWT, JWTError, jwt_required, current_identity
 import flask_login
 import flask_user
+from http import HTTPStatus
+import collections
+import json
+import re
+import requests
+import sqlalchemy.orm
+import threading
+import time
 
-from google.oauth2 import id_token
-from google.auth.transport import requests
+import google.auth.exceptions
+import google.auth.jwt
+import google.auth.transport.requests
 
 
 class User(db.Model, flask_user.UserMixin):
@@ -36,12 +45,134 @@ class User(db.Model, flask_user.UserMixin):
 
     def set_password(self, password):
         self.password = user_manager.hash_password(password)
+        forget_user(self.id)
 
 
 def get_user(user_id):
     return user_manager.get_user_by_id(user_id)
 
 
+class UserCache(object):
+    """Bounded LRU cache of users, so that authenticated requests don't
+    need a database round trip to load the user.
+
+    Entries expire after IDENTITY_CACHE_TTL seconds. They are dropped when
+    the user changes password or username in this process; other
+    processes see the change once their entry expires.
+    """
+
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, load):
+        """User cached under the key attached to the current session.
+        Calls load() to get the user on a miss, None results are not
+        cached."""
+        ttl = app.config['IDENTITY_CACHE_TTL']
+        if not ttl:
+            return load()
+
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                # Attaching the copy to the session doesn't query
+                return db.session.merge(entry[1], load=False)
+
+        user = load()
+        if user is None:
+            return None
+
+        with self.lock:
+            self.entries[key] = (now + ttl, detached_copy(user))
+            self.entries.move_to_end(key)
+            while len(self.entries) > app.config['IDENTITY_CACHE_SIZE']:
+                self.entries.popitem(last=False)
+
+        return user
+
+    def invalidate(self, user_id):
+        with self.lock:
+            for key in [key for key, (_, user) in self.entries.items()
+                        if user.id == user_id]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def detached_copy(user):
+    """Copy of the user that doesn't belong to any session, so it stays
+    usable after the session that loaded the user is gone."""
+    copy = User(**{attr.key: getattr(user, attr.key)
+                   for attr in sqlalchemy.inspect(User).column_attrs})
+    sqlalchemy.orm.make_transient_to_detached(copy)
+    return copy
+
+
+# Keyed by user id and the time the token was issued
+identity_cache = UserCache()
+# Keyed by Google account id
+google_user_cache = UserCache()
+
+
+class CertCache(object):
+    """Google's public certificates for verifying id tokens.
+
+    Certificates are refetched once the max-age of the Cache-Control
+    header of the last response passes. Requests go through a single
+    session, so the connection is reused.
+    """
+
+    def __init__(self, request=None):
+        self.request = request or google.auth.transport.requests.Request(
+            requests.Session())
+        self.certs = None
+        self.expires = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        """Mapping of key id to x.509 certificate."""
+        # Holding the lock while fetching makes concurrent logins wait for
+        # a single request
+        with self.lock:
+            now = time.monotonic()
+            if self.certs is None or now >= self.expires:
+                self.certs, max_age = self.fetch()
+                self.expires = now + max_age
+            return self.certs
+
+    def fetch(self):
+        url = app.config['GOOGLE_CERTS_URL']
+        response = self.request(url, method='GET')
+        if response.status != HTTPStatus.OK:
+            raise google.auth.exceptions.TransportError(
+                'Could not fetch certificates at {}'.format(url))
+
+        return json.loads(response.data.decode()), max_age(response.headers)
+
+
+def max_age(headers):
+    """Seconds the response may be cached for according to its
+    Cache-Control and Age headers."""
+    cache_control = headers.get('Cache-Control', '').lower()
+    match = re.search(r'max-age=(\d+)', cache_control)
+    if not match or 'no-cache' in cache_control \
+            or 'no-store' in cache_control:
+        return 0
+    try:
+        age = int(headers.get('Age', 0))
+    except ValueError:
+        age = 0
+    return max(int(match.group(1)) - age, 0)
+
+
+google_certs = CertCache()
+
+
 def authenticate_username(username, password):
     user = user_manager.find_user_by_username(username)
     if user and user_manager.verify_password(password, user):
@@ -49,8 +180,9 @@ def authenticate_username(username, password):
 
 
 def authenticate_id_token(token):
-    idinfo = id_token.verify_oauth2_token(token, requests.Request(),
-                                          app.config.get('GOOGLE_CLIENT_ID'))
+    idinfo = google.auth.jwt.decode(
+        token, certs=google_certs.get(),
+        audience=app.config.get('GOOGLE_CLIENT_ID'))
 
     allowed_issuers = ['accounts.google.com', 'https://accounts.google.com']
     if idinfo['iss'] not in allowed_issuers:
@@ -62,9 +194,8 @@ def authenticate_id_token(token):
 def find_or_register(idinfo):
     userid = idinfo['sub']
 
-    user = User.query \
-               .filter_by(google_id=userid) \
-               .first()
+    user = google_user_cache.get(
+        userid, lambda: User.query.filter_by(google_id=userid).first())
     if user:
         return user
 
@@ -112,8 +243,26 @@ def jwt_auth_request_handler():
 
 @jwt.identity_handler
 def identity(payload):
-    user = get_user(payload['identity'])
-    return user
+    user_id = payload['identity']
+    return identity_cache.get((user_id, payload.get('iat')),
+                              lambda: get_user(user_id))
+
+
+def forget_user(user_id):
+    """Drop cached copies of the user."""
+    identity_cache.invalidate(user_id)
+    google_user_cache.invalidate(user_id)
+
+
+def invalidate_identity(sender, user, **extra):
+    forget_user(user.id)
+
+
+for signal in [flask_user.signals.user_changed_password,
+               flask_user.signals.user_changed_username,
+               flask_user.signals.user_confirmed_email,
+               flask_user.signals.user_reset_password]:
+    signal.connect(invalidate_identity, app)
 
 
 @login_manager.request_loader
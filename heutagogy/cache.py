@@ -0,0 +1,105 @@
+"""Per-user cache of read responses in redis.
+
+Entries are keyed on a per-user version counter. Every write bumps the
+counter after commit, which makes all cached entries of the user
+unreachable at once. Nothing is ever deleted; stale entries expire after
+RESPONSE_CACHE_TTL seconds.
+
+The same version makes ETags of responses (see views.make_etag), so a
+response is cached and tagged with one version, and checking
+If-None-Match takes a single redis read. A missing counter (new, or
+evicted) starts from the current time in microseconds rather than 0, so
+it never repeats a version clients may still have in an ETag.
+"""
+from heutagogy import app
+from heutagogy.heutagogy import redis_db
+import click
+import hashlib
+import json
+import time
+
+
+# Hash of "<name>:hit" and "<name>:miss" counters
+METRICS_KEY = 'heutagogy:cache:metrics'
+
+
+def version_key(user):
+    return 'heutagogy:user:{}:version'.format(user)
+
+
+get_version = redis_db.register_script("""
+local version = redis.call('GET', KEYS[1])
+if not version then
+    version = ARGV[1]
+    redis.call('SET', KEYS[1], version)
+end
+return version
+""")
+
+incr_version = redis_db.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+return redis.call('INCR', KEYS[1])
+""")
+
+
+def now_micros():
+    return int(time.time() * 1000000)
+
+
+def user_version(user):
+    """Version of data of the user, which changes on every write."""
+    return int(get_version(keys=[version_key(user)], args=[now_micros()]))
+
+
+def bump_version(user):
+    """Invalidate cached responses and ETags of the user. Must be
+    called after the change is committed, otherwise a concurrent request
+    could cache the old data under the new version."""
+    incr_version(keys=[version_key(user)], args=[now_micros()])
+
+
+def cached(name, user, key, compute, version=None):
+    """Return value of compute() for the user, caching it as JSON
+    under the name and key (e.g. request path). version is the version
+    of the user the value is computed for, the current one by
+    default."""
+    ttl = app.config['RESPONSE_CACHE_TTL']
+    if not ttl:
+        return compute()
+
+    if version is None:
+        version = user_version(user)
+    cache_key = 'heutagogy:cache:{}:{}:{}:{}'.format(
+        user, version, name, hashlib.sha1(key.encode()).hexdigest())
+
+    value = redis_db.get(cache_key)
+    if value is not None:
+        redis_db.hincrby(METRICS_KEY, name + ':hit')
+        return json.loads(value.decode())
+
+    value = compute()
+    with redis_db.pipeline(transaction=False) as pipe:
+        pipe.set(cache_key, json.dumps(value), ex=ttl)
+        pipe.hincrby(METRICS_KEY, name + ':miss')
+        pipe.execute()
+    return value
+
+
+def metrics():
+    """{name: {'hit': n, 'miss': m}} of all cached responses."""
+    result = {}
+    for field, count in redis_db.hgetall(METRICS_KEY).items():
+        name, kind = field.decode().rsplit(':', 1)
+        result.setdefault(name, {'hit': 0, 'miss': 0})[kind] = int(count)
+    return result
+
+
+@app.cli.command('cache-metrics')
+def cache_metrics_command():
+    """Print hit rate of the response cache."""
+    for name, counts in sorted(metrics().items()):
+        total = counts['hit'] + counts['miss']
+        click.echo('{}: {} hits, {} misses ({:.0%} hit rate)'.format(
+            name, counts['hit'], counts['miss'], counts['hit'] / total))
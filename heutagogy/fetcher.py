@@ -0,0 +1,166 @@
+"""Concurrent downloading of bookmarked pages.
+
+A single worker downloads many pages at once in a thread pool, so one
+slow site doesn't hold up the rest. To stay polite, only a few requests
+go to the same host at a time. Every request has connect and read
+timeouts, and bodies over a size limit are dropped.
+"""
+from heutagogy import app
+from concurrent.futures import ThreadPoolExecutor
+import codecs
+import collections
+import queue
+import re
+import requests
+import threading
+import urllib.parse as urlparse
+
+
+USER_AGENT = 'Mozilla/5.0 (compatible; heutagogy)'
+
+
+class FetchError(Exception):
+    pass
+
+
+Page = collections.namedtuple('Page', ['url', 'status', 'headers', 'html'])
+
+
+class Fetcher(object):
+    """Downloads pages with a shared pool of connections.
+
+    workers is the number of concurrent downloads, per_host the number
+    of them that may go to the same host, max_bytes the size limit of a
+    body. Timeouts are in seconds.
+    """
+
+    def __init__(self, workers=16, per_host=2, connect_timeout=5,
+                 read_timeout=30, max_bytes=5 * 1024 * 1024):
+        self.workers = workers
+        self.per_host = per_host
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_bytes = max_bytes
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers,
+                                                pool_maxsize=per_host)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['User-Agent'] = USER_AGENT
+
+    @classmethod
+    def from_config(cls, config=None):
+        config = config or app.config
+        return cls(workers=config['FETCH_WORKERS'],
+                   per_host=config['FETCH_PER_HOST'],
+                   connect_timeout=config['FETCH_CONNECT_TIMEOUT'],
+                   read_timeout=config['FETCH_READ_TIMEOUT'],
+                   max_bytes=config['FETCH_MAX_BYTES'])
+
+    def fetch(self, url, headers=None):
+        """Download the page. Raises FetchError if the server doesn't
+        respond with 2XX or 304, or the body is too large. html of the
+        page is None on 304, which is only expected when headers make
+        the request conditional."""
+        with self.session.get(url, headers=headers, timeout=self.timeout,
+                              stream=True) as response:
+            if response.status_code == 304:
+                return Page(response.url, response.status_code,
+                            response.headers, None)
+
+            if not 200 <= response.status_code < 300:
+                raise FetchError('{} responded with {}'.format(
+                    url, response.status_code))
+
+            length = response.headers.get('Content-Length')
+            if length and length.isdigit() and int(length) > self.max_bytes:
+                raise FetchError('{} is larger than {} bytes'.format(
+                    url, self.max_bytes))
+
+            body = bytearray()
+            for chunk in response.iter_content(64 * 1024):
+                body += chunk
+                if len(body) > self.max_bytes:
+                    raise FetchError('{} is larger than {} bytes'.format(
+                        url, self.max_bytes))
+
+            html = body.decode(encoding_of(response, body), 'replace')
+            return Page(response.url, response.status_code,
+                        response.headers, html)
+
+    def fetch_all(self, urls, headers=None):
+        """Download the urls concurrently. Yields (url, page, error)
+        triples in the order downloads finish, error being None on
+        success. headers maps urls to extra request headers. The
+        generator must be consumed to the end."""
+        urls = list(urls)
+        headers = headers or {}
+        results = queue.Queue()
+        lock = threading.Lock()
+        # Urls waiting for a slot of their host, and slots in use
+        waiting = collections.defaultdict(collections.deque)
+        active = collections.Counter()
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            def start(url):
+                future = pool.submit(self.fetch, url, headers.get(url))
+                future.add_done_callback(lambda f: finish(url, f))
+
+            def finish(url, future):
+                host = host_of(url)
+                with lock:
+                    next_url = None
+                    if waiting[host]:
+                        next_url = waiting[host].popleft()
+                    else:
+                        active[host] -= 1
+                if next_url is not None:
+                    start(next_url)
+                results.put((url, future))
+
+            for url in urls:
+                host = host_of(url)
+                with lock:
+                    if active[host] >= self.per_host:
+                        waiting[host].append(url)
+                        continue
+                    active[host] += 1
+                start(url)
+
+            for _ in urls:
+                url, future = results.get()
+                try:
+                    yield url, future.result(), None
+                except (FetchError, requests.RequestException) as e:
+                    yield url, None, e
+
+
+# charset parameter of Content-Type, and the same in <meta charset> or
+# <meta http-equiv="Content-Type"> of a page
+CHARSET = re.compile(r'charset\s*=\s*["\']?([-\w.:]+)', re.I)
+META_CHARSET = re.compile(r'<meta[^>]+charset\s*=\s*["\']?([-\w.:]+)',
+                          re.I)
+# Browsers look for <meta> in the first 1024 bytes, be more lenient
+META_PRESCAN = 4096
+
+
+def encoding_of(response, body):
+    """Charset of the response given in Content-Type, or else in
+    <meta> at the start of the body. utf-8 if it is missing or unknown
+    to Python (e.g. utf8mb4)."""
+    # Not response.encoding, which is ISO-8859-1 for any text without
+    # a charset
+    match = CHARSET.search(response.headers.get('Content-Type', ''))
+    if match is None:
+        match = META_CHARSET.search(
+            body[:META_PRESCAN].decode('ascii', 'replace'))
+    encoding = match.group(1) if match else 'utf-8'
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        return 'utf-8'
+    return encoding
+
+
+def host_of(url):
+    return urlparse.urlsplit(url).netloc.lower()
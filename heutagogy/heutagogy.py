@@ -16,10 +16,17 @@ app.config.update(dict(
         'GOOGLE_CLIENT_ID',
         '405142759904-v1f1llvnukvism73kc81kojmhl4k0imm.apps.googleusercontent.com' # noqa
     ),
+    GOOGLE_CERTS_URL=os.getenv(
+        'GOOGLE_CERTS_URL', 'https://www.googleapis.com/oauth2/v1/certs'),
 
     JWT_AUTH_URL_RULE=None,
     JWT_EXPIRATION_DELTA=timedelta(seconds=2592000),  # 1 month
 
+    # Users of JWT tokens and Google accounts are cached in each process
+    # for up to IDENTITY_CACHE_TTL seconds. 0 disables caching.
+    IDENTITY_CACHE_SIZE=int(os.getenv('IDENTITY_CACHE_SIZE', 1000)),
+    IDENTITY_CACHE_TTL=int(os.getenv('IDENTITY_CACHE_TTL', 60)),
+
     SECRET_KEY=os.getenv('SECRET_KEY', 'super-secret'),
 
     # Flask-Mail settings
@@ -33,6 +40,46 @@ app.config.update(dict(
     MAIL_USE_SSL=int(os.getenv('MAIL_USE_SSL', True)),
 
     USER_APP_NAME='Heutagogy',
+
+    # Render bookmark lists to JSON in the database instead of Python,
+    # on PostgreSQL 12+
+    BOOKMARKS_JSON_IN_DB=int(os.getenv('BOOKMARKS_JSON_IN_DB', True)),
+
+    # Global stats are recomputed once older than STATS_MAX_AGE seconds,
+    # by one request at a time. 0 disables caching.
+    STATS_MAX_AGE=int(os.getenv('STATS_MAX_AGE', 60)),
+
+    # For how long (in seconds) cached responses of a user are kept.
+    # They are invalidated on every change anyway. 0 disables caching.
+    RESPONSE_CACHE_TTL=int(os.getenv('RESPONSE_CACHE_TTL', 3600)),
+
+    # Article fetching. Bookmarks are fetched in jobs of FETCH_BATCH_SIZE,
+    # each downloading FETCH_WORKERS pages at a time, at most
+    # FETCH_PER_HOST of them from the same host. Timeouts are in seconds.
+    # Pages are parsed in FETCH_PARSERS processes and stored
+    # FETCH_WRITE_BATCH at a time.
+    FETCH_BATCH_SIZE=int(os.getenv('FETCH_BATCH_SIZE', 100)),
+    # Posts of up to FETCH_INTERACTIVE_MAX bookmarks are fetched with high
+    # priority. Larger posts, imports and refreshes are bulk fetches.
+    FETCH_INTERACTIVE_MAX=int(os.getenv('FETCH_INTERACTIVE_MAX', 10)),
+    FETCH_WORKERS=int(os.getenv('FETCH_WORKERS', 16)),
+    FETCH_PER_HOST=int(os.getenv('FETCH_PER_HOST', 2)),
+    FETCH_CONNECT_TIMEOUT=float(os.getenv('FETCH_CONNECT_TIMEOUT', 5)),
+    FETCH_READ_TIMEOUT=float(os.getenv('FETCH_READ_TIMEOUT', 30)),
+    FETCH_MAX_BYTES=int(os.getenv('FETCH_MAX_BYTES', 5 * 1024 * 1024)),
+    FETCH_PARSERS=int(os.getenv('FETCH_PARSERS', os.cpu_count() or 1)),
+    FETCH_WRITE_BATCH=int(os.getenv('FETCH_WRITE_BATCH', 20)),
+    # Bulk batches of failed jobs are fetched again, up to
+    # FETCH_JOB_ATTEMPTS times in total
+    FETCH_JOB_ATTEMPTS=int(os.getenv('FETCH_JOB_ATTEMPTS', 3)),
+    # For how long (in seconds) a job may hold the lock of a url it
+    # fetches. Other jobs skip the url meanwhile.
+    FETCH_LOCK_TIMEOUT=int(os.getenv('FETCH_LOCK_TIMEOUT', 600)),
+    # Pages fetched less than PAGE_MAX_AGE seconds ago are shared with
+    # new bookmarks of the url instead of being fetched again. Older
+    # pages are refetched by the refresh-pages command.
+    PAGE_MAX_AGE=int(os.getenv('PAGE_MAX_AGE', 7 * 24 * 3600)),
+
     SQLALCHEMY_DATABASE_URI=os.getenv(
         'DATABASE_URL', 'postgresql:///heutagogy'),
     SQLALCHEMY_TRACK_MODIFICATIONS=False))
@@ -45,5 +92,7 @@ if app.config['USER_ENABLE_EMAIL']:
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
-q = Queue(connection=redis.from_url(os.getenv(
-    'REDIS_URL', 'redis://localhost:6379')))
+redis_db = redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379'))
+# Fetch jobs, see heutagogy.jobs. Workers drain high before low.
+high_q = Queue('high', connection=redis_db)
+low_q = Queue('low', connection=redis_db)
@@ -0,0 +1,131 @@
+"""Parsers for bookmark exports of other services.
+
+Every parser takes an iterable of text lines and lazily yields
+bookmarks as dicts in the shape accepted by POST /api/v1/bookmarks
+(url, title, timestamp, read, meta, tags), so arbitrarily large files
+can be imported without reading them into memory.
+"""
+import csv
+import datetime
+import html.parser
+import json
+
+
+class ParseError(ValueError):
+    pass
+
+
+def from_unix_time(value):
+    if not value:
+        return None
+    try:
+        return datetime.datetime.utcfromtimestamp(int(value))
+    except (ValueError, OverflowError):
+        raise ParseError('invalid timestamp: {}'.format(value))
+
+
+def parse_ndjson(lines):
+    """One JSON object per line, e.g. output of /api/v1/export.
+
+    Exported ids, notes and parents are passed through, but bookmarks
+    are imported without them, see views.import_bookmarks()."""
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            entity = json.loads(line)
+        except ValueError:
+            raise ParseError('invalid JSON on line {}'.format(number))
+        if not isinstance(entity, dict):
+            raise ParseError('line {} is not an object'.format(number))
+        yield entity
+
+
+class NetscapeParser(html.parser.HTMLParser):
+    """Collects links of a Netscape bookmark file, as exported by
+    browsers, Pocket and Pinboard."""
+
+    def __init__(self):
+        super().__init__()
+        self.bookmarks = []
+        self.link = None
+
+    def handle_starttag(self, tag, attrs):
+        # Tolerate unclosed links
+        if tag in ('a', 'dt', 'dl', 'h3'):
+            self.end_link()
+
+        if tag != 'a':
+            return
+        attrs = dict(attrs)
+        if not attrs.get('href'):
+            return
+
+        tags = [t.strip() for t in (attrs.get('tags') or '').split(',')]
+        self.link = {
+            'url': attrs['href'],
+            'title': '',
+            'timestamp': from_unix_time(attrs.get('add_date')),
+            'tags': [t for t in tags if t],
+        }
+
+    def handle_data(self, data):
+        if self.link is not None:
+            self.link['title'] += data
+
+    def handle_endtag(self, tag):
+        if tag in ('a', 'dl'):
+            self.end_link()
+
+    def end_link(self):
+        if self.link is not None:
+            self.link['title'] = self.link['title'].strip()
+            self.bookmarks.append(self.link)
+            self.link = None
+
+
+def parse_netscape_html(lines):
+    parser = NetscapeParser()
+    for line in lines:
+        parser.feed(line)
+        yield from parser.bookmarks
+        parser.bookmarks = []
+    parser.close()
+    parser.end_link()
+    yield from parser.bookmarks
+
+
+def parse_pocket_csv(lines):
+    """CSV with a header row of title, url, time_added, tags and status
+    columns. Tags are separated by "|", archived items are imported as
+    read."""
+    reader = csv.DictReader(lines)
+    for row in reader:
+        if not row.get('url'):
+            raise ParseError(
+                'url is missing on line {}'.format(reader.line_num))
+
+        timestamp = from_unix_time(row.get('time_added'))
+        tags = [t for t in (row.get('tags') or '').split('|') if t]
+        yield {
+            'url': row['url'],
+            'title': row.get('title'),
+            'timestamp': timestamp,
+            'read': timestamp if row.get('status') == 'archive' else None,
+            'tags': tags,
+        }
+
+
+PARSERS = {
+    'ndjson': parse_ndjson,
+    'html': parse_netscape_html,
+    'csv': parse_pocket_csv,
+}
+
+# Format guessed from Content-Type of an upload
+MIMETYPES = {
+    'application/x-ndjson': 'ndjson',
+    'application/json': 'ndjson',
+    'text/html': 'html',
+    'text/csv': 'csv',
+}
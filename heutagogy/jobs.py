@@ -0,0 +1,248 @@
+"""Queues of article fetching jobs.
+
+Jobs go to one of two RQ queues, which workers drain in order (see
+Procfile):
+
+- high: fetching of a few bookmarks a user just saved, so that content
+  shows up while they are looking;
+- low: bulk fetching, of imports, large posts and refresh-pages.
+
+Bulk batches don't go to the low queue themselves. They wait in a list
+per owner (a user, or 'refresh'), and every job in the low queue takes
+the next batch round-robin over owners. A large import of one user thus
+delays imports of others by at most one batch per turn.
+
+Jobs may run for job_timeout() seconds, enough for a batch of urls of
+a single host. A bulk batch is kept in redis while it runs. If the job
+fails, the batch is queued again, up to FETCH_JOB_ATTEMPTS times. When
+a worker dies without failing the job, later bulk jobs take the batch
+back once its job would have timed out.
+
+Time from enqueueing a batch to its start is recorded per queue, see
+metrics() and the queue-metrics command.
+"""
+from heutagogy import app
+from heutagogy.heutagogy import high_q, low_q, redis_db
+from rq.job import Job
+from rq.utils import import_attribute
+import click
+import json
+import time
+import uuid
+
+
+# List of owners with pending bulk batches, in round-robin order
+OWNERS_KEY = 'heutagogy:bulk'
+# Hash of "<queue>:runs" and "<queue>:wait" (total seconds) counters
+METRICS_KEY = 'heutagogy:jobs:metrics'
+# Hash of bulk batches being run, by a token of the run, as JSON of
+# {'batch', 'deadline'}
+RUNNING_KEY = 'heutagogy:bulk-running'
+
+# Seconds a job may take on top of downloads, for parsing and storing
+JOB_TIMEOUT_MARGIN = 120
+
+REFRESH_OWNER = 'refresh'
+
+
+def batches_key(owner):
+    return 'heutagogy:bulk:{}'.format(owner)
+
+
+# An owner is in the round-robin list while it has pending batches
+push_batches = redis_db.register_script("""
+if redis.call('LLEN', KEYS[2]) == 0 then
+    redis.call('RPUSH', KEYS[1], ARGV[1])
+end
+for i = 2, #ARGV do
+    redis.call('RPUSH', KEYS[2], ARGV[i])
+end
+""")
+
+# The batch is recorded as running in the same step, so that it can't
+# get lost in between
+take_batch = redis_db.register_script("""
+local owner = redis.call('LPOP', KEYS[1])
+if not owner then
+    return nil
+end
+local key = ARGV[1] .. owner
+local batch = redis.call('LPOP', key)
+if redis.call('LLEN', key) > 0 then
+    redis.call('RPUSH', KEYS[1], owner)
+end
+redis.call('HSET', KEYS[2], ARGV[2],
+           cjson.encode({batch = batch, deadline = tonumber(ARGV[3])}))
+return batch
+""")
+
+
+def job_timeout():
+    """Seconds a fetch job may run: long enough for a batch of urls of
+    a single host, downloaded FETCH_PER_HOST at a time with every
+    download taking as long as timeouts allow."""
+    config = app.config
+    rounds = -(-config['FETCH_BATCH_SIZE'] // config['FETCH_PER_HOST'])
+    fetch = config['FETCH_CONNECT_TIMEOUT'] + config['FETCH_READ_TIMEOUT']
+    return int(rounds * fetch) + JOB_TIMEOUT_MARGIN
+
+
+def batches(func, items):
+    """Split items into batches of FETCH_BATCH_SIZE for func."""
+    name = '{}.{}'.format(func.__module__, func.__name__)
+    size = app.config['FETCH_BATCH_SIZE']
+    return [{'func': name, 'items': items[i:i + size],
+             'enqueued_at': time.time()}
+            for i in range(0, len(items), size)]
+
+
+def enqueue(func, items):
+    """Enqueue jobs calling func with batches of items in the high
+    priority queue, in one redis round trip."""
+    with redis_db.pipeline() as pipe:
+        for batch in batches(func, items):
+            job = high_q.job_class.create(run_batch,
+                                          args=(high_q.name, batch),
+                                          connection=redis_db,
+                                          origin=high_q.name,
+                                          timeout=job_timeout())
+            high_q.enqueue_job(job, pipeline=pipe)
+        pipe.execute()
+
+
+def enqueue_bulk(owner, func, items):
+    """Queue batches of items for func behind bulk batches of the
+    owner, and a job in the low priority queue for each, in one redis
+    round trip."""
+    push_bulk(owner, [dict(batch, owner=owner, attempts=1)
+                      for batch in batches(func, items)])
+
+
+def push_bulk(owner, pending):
+    if not pending:
+        return
+
+    with redis_db.pipeline() as pipe:
+        push_batches(keys=[OWNERS_KEY, batches_key(owner)],
+                     args=[owner] + [json.dumps(b) for b in pending],
+                     client=pipe)
+        for _ in pending:
+            job = low_q.job_class.create(run_bulk,
+                                         connection=redis_db,
+                                         origin=low_q.name,
+                                         timeout=job_timeout())
+            low_q.enqueue_job(job, pipeline=pipe)
+        pipe.execute()
+
+
+def take(token):
+    """The next bulk batch in round-robin order, or None if there are
+    none. The batch stays recorded as running under the token until
+    finished() is called."""
+    deadline = time.time() + job_timeout() + JOB_TIMEOUT_MARGIN
+    batch = take_batch(keys=[OWNERS_KEY, RUNNING_KEY],
+                       args=[batches_key(''), token, int(deadline)])
+    return json.loads(batch.decode()) if batch is not None else None
+
+
+def finished(token):
+    redis_db.hdel(RUNNING_KEY, token)
+
+
+def retry(batch):
+    """Queue the batch again behind batches of its owner, unless it has
+    been tried FETCH_JOB_ATTEMPTS times already."""
+    attempts = batch.get('attempts', 1)
+    if attempts >= app.config['FETCH_JOB_ATTEMPTS']:
+        app.logger.warning('Giving up on a batch of %s after %d attempts',
+                           batch['owner'], attempts)
+        return
+    push_bulk(batch['owner'], [dict(batch, attempts=attempts + 1,
+                                    enqueued_at=time.time())])
+
+
+def recover_lost():
+    """Queue again batches whose jobs died without finishing them, which
+    is when they are still running past the job timeout."""
+    now = time.time()
+    for token, value in redis_db.hgetall(RUNNING_KEY).items():
+        running = json.loads(value.decode())
+        # Only the job that removes the batch retries it
+        if running['deadline'] < now and redis_db.hdel(RUNNING_KEY, token):
+            retry(json.loads(running['batch']))
+
+
+def run_bulk():
+    recover_lost()
+
+    token = uuid.uuid4().hex
+    batch = take(token)
+    if batch is None:
+        return
+    try:
+        run_batch(low_q.name, batch)
+    except Exception:
+        # Also when the job times out
+        retry(batch)
+        raise
+    finally:
+        finished(token)
+
+
+def run_batch(queue, batch):
+    wait = max(0, time.time() - batch['enqueued_at'])
+    with redis_db.pipeline(transaction=False) as pipe:
+        pipe.hincrby(METRICS_KEY, queue + ':runs')
+        pipe.hincrbyfloat(METRICS_KEY, queue + ':wait', wait)
+        pipe.execute()
+
+    import_attribute(batch['func'])(batch['items'])
+
+
+def metrics():
+    """{queue: {'waiting', 'oldest', 'runs', 'wait'}} where waiting is
+    the number of pending batches, oldest seconds the oldest of them has
+    been waiting (or None), runs the number of batches started and wait
+    their total wait in seconds. low also has the number of owners."""
+    now = time.time()
+    counters = {field.decode(): float(value) for field, value
+                in redis_db.hgetall(METRICS_KEY).items()}
+    result = {}
+    for queue in [high_q.name, low_q.name]:
+        result[queue] = {'runs': int(counters.get(queue + ':runs', 0)),
+                         'wait': counters.get(queue + ':wait', 0.0)}
+
+    oldest = None
+    ids = high_q.get_job_ids(0, 1)
+    if ids:
+        job = Job.fetch(ids[0], connection=redis_db)
+        oldest = now - job.args[1]['enqueued_at']
+    result[high_q.name].update(waiting=len(high_q), oldest=oldest)
+
+    owners = [owner.decode() for owner in redis_db.lrange(OWNERS_KEY, 0, -1)]
+    with redis_db.pipeline(transaction=False) as pipe:
+        for owner in owners:
+            pipe.llen(batches_key(owner))
+            pipe.lindex(batches_key(owner), 0)
+        replies = pipe.execute()
+    heads = [json.loads(head.decode()) for head in replies[1::2] if head]
+    result[low_q.name].update(
+        waiting=sum(replies[0::2]), owners=len(owners),
+        oldest=max((now - head['enqueued_at'] for head in heads),
+                   default=None))
+    return result
+
+
+@app.cli.command('queue-metrics')
+def queue_metrics_command():
+    """Print depth and wait times of fetch queues."""
+    for queue, counts in sorted(metrics().items()):
+        line = '{}: {} waiting'.format(queue, counts['waiting'])
+        if 'owners' in counts:
+            line += ' from {} owners'.format(counts['owners'])
+        if counts['oldest'] is not None:
+            line += ', oldest for {:.1f}s'.format(counts['oldest'])
+        if counts['runs']:
+            line += '; {} started after {:.1f}s on average'.format(
+                counts['runs'], counts['wait'] / counts['runs'])
+        click.echo(line)
@@ -1,9 +1,15 @@
 from heutagogy import db
 from heutagogy.auth import User
+import collections
 import datetime
+import hashlib
+import itertools
 import pytz
 
+import sqlalchemy
 import sqlalchemy.dialects.postgresql as postgresql
+import sqlalchemy.orm
+from sqlalchemy.orm.attributes import set_committed_value
 
 
 # The database doesn't store timezones, so we convert all timestamps
@@ -20,6 +26,38 @@ def to_utc(t):
     return t.astimezone(pytz.utc).replace(tzinfo=None)
 
 
+# Current time in UTC, taken when the statement changes the row rather
+# than at the start of the transaction
+UTC_NOW = sqlalchemy.text("(clock_timestamp() AT TIME ZONE 'UTC')")
+
+
+class Page(db.Model):
+    """Fetched content of a url, shared by all bookmarks of the url.
+
+    Written by article fetching (see heutagogy.article).
+    """
+    __tablename__ = 'page'
+    id = db.Column(db.Integer, primary_key=True)
+    # Normalized by filter_url, same as Bookmark.url
+    url = db.Column(db.String, nullable=False)
+    title = db.Column(db.String)
+    content_html = db.deferred(db.Column(db.Text))
+    content_text = db.deferred(db.Column(db.Text))
+    # Maintained by BOOKMARK_SEARCH_TRIGGERS. Search combines it with
+    # Bookmark.search, so content is indexed once however many
+    # bookmarks share it.
+    search = db.deferred(db.Column(postgresql.TSVECTOR, nullable=True))
+    # Validators of the response, sent back when the page is refreshed
+    etag = db.Column(db.String)
+    last_modified = db.Column(db.String)
+    fetched_at = db.Column(db.DateTime, nullable=False,
+                           server_default=UTC_NOW)
+    # When content of a bookmark of the page was last read, see
+    # heutagogy.article.record_open(). Most recently opened pages are
+    # refreshed first.
+    opened_at = db.Column(db.DateTime)
+
+
 class Bookmark(db.Model):
     __tablename__ = 'bookmark'
     id = db.Column(db.Integer, primary_key=True)
@@ -28,14 +66,20 @@ class Bookmark(db.Model):
     url = db.Column(db.String, nullable=False)
     title = db.Column(db.String, nullable=False)
     read = db.Column(db.DateTime)
-    meta = db.Column(postgresql.JSON)
+    meta = db.Column(postgresql.JSONB)
     tags = db.Column(postgresql.ARRAY(db.Text))
-    content_html = db.deferred(db.Column(db.Text, nullable=True))
-    content_text = db.deferred(db.Column(db.Text, nullable=True))
+    page_id = db.Column(db.Integer,
+                        db.ForeignKey(Page.id, ondelete='SET NULL'))
+    page = db.relationship(Page)
+    # Maintained by BOOKMARK_SEARCH_TRIGGERS
+    search = db.deferred(db.Column(postgresql.TSVECTOR, nullable=True))
     notes = db.relationship('Note', back_populates='bookmark')
     parent_id = db.Column(db.Integer, db.ForeignKey('bookmark.id'))
     children = db.relationship('Bookmark',
                                backref=db.backref('parent', remote_side=[id]))
+    # Maintained by SYNC_TRIGGERS. Changes of notes update it too.
+    updated_at = db.Column(db.DateTime, nullable=False,
+                           server_default=UTC_NOW)
 
     def __init__(
             self, user, url,
@@ -60,22 +104,38 @@ class Bookmark(db.Model):
     def __repr__(self):
         return '<Bookmark %r of %r>' % self.url % self.user
 
-    def to_dict(self):
-        result = {
-            'id': self.id,
-            'url': self.url,
-            'title': self.title,
-            'timestamp': self.timestamp.isoformat(),
-            'read': self.read.isoformat() if self.read else None,
-            'meta': self.meta,
-            'tags': self.tags,
-            'notes': list(map(lambda x: x.to_dict(), self.notes)),
-        }
-        if self.parent_id is not None:
+    def to_dict(self, children=True, fields=None, notes=True):
+        """children is the number of levels of children to include, or
+        True for all of them. fields limits the result to the given
+        keys. Only attributes needed for the result are accessed, so
+        the rest may be left unloaded."""
+        values = [
+            ('id', lambda: self.id),
+            ('url', lambda: self.url),
+            ('title', lambda: self.title),
+            ('timestamp', lambda: self.timestamp.isoformat()),
+            ('read', lambda: self.read.isoformat() if self.read else None),
+            ('meta', lambda: self.meta),
+            ('tags', lambda: self.tags),
+        ]
+        if notes:
+            values.append(
+                ('notes', lambda: list(map(lambda x: x.to_dict(),
+                                           self.notes))))
+
+        result = {}
+        for key, value in values:
+            if fields is None or key in fields:
+                result[key] = value()
+
+        if (fields is None or 'parent' in fields) and \
+           self.parent_id is not None:
             result['parent'] = self.parent_id
-        if self.children:
-            result['children'] = list(map(lambda x: x.to_dict(),
-                                          self.children))
+        if children and self.children:
+            if children is not True:
+                children -= 1
+            result['children'] = list(map(
+                lambda x: x.to_dict(children, fields, notes), self.children))
 
         return result
 
@@ -86,6 +146,9 @@ class Note(db.Model):
                             nullable=False)
     bookmark = db.relationship('Bookmark', back_populates='notes')
     text = db.Column(db.Text, nullable=False)
+    # Maintained by SYNC_TRIGGERS
+    updated_at = db.Column(db.DateTime, nullable=False,
+                           server_default=UTC_NOW)
 
     def __init__(self, bookmark, text):
         self.bookmark = bookmark
@@ -96,3 +159,825 @@ class Note(db.Model):
             'id': self.id,
             'text': self.text,
         }
+
+
+class Tag(db.Model):
+    """Number of bookmarks of the user with the given tag.
+
+    The table is maintained by a trigger on bookmark (see
+    BOOKMARK_TAGS_TRIGGER), so it is never written from Python.
+    """
+    user = db.Column(db.Integer, db.ForeignKey(User.id), primary_key=True)
+    name = db.Column(db.Text, primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'count': self.count,
+        }
+
+
+class BookmarkTombstone(db.Model):
+    """Deleted bookmark, so that sync can tell clients to delete it.
+
+    Rows are written by a trigger on bookmark (see SYNC_TRIGGERS).
+    """
+    __tablename__ = 'bookmark_tombstone'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user = db.Column(db.Integer, db.ForeignKey(User.id), nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=False,
+                           server_default=UTC_NOW)
+
+
+# Indexes for the hot query shapes. Keep in sync with migrations.
+db.Index('ix_bookmark_user_read_timestamp',
+         Bookmark.user,
+         Bookmark.read.desc().nullsfirst(),
+         Bookmark.timestamp.desc(),
+         Bookmark.id.desc())
+# Indexing md5 keeps index entries small for long urls
+db.Index('ix_bookmark_user_url_md5', Bookmark.user, db.func.md5(Bookmark.url))
+# Bookmarks of all users are linked to a fetched page by url
+db.Index('ix_bookmark_url_md5', db.func.md5(Bookmark.url))
+db.Index('ix_bookmark_page_id', Bookmark.page_id)
+db.Index('ix_page_url_md5', db.func.md5(Page.url), unique=True)
+db.Index('ix_page_opened_at_fetched_at',
+         Page.opened_at.desc().nullslast(), Page.fetched_at)
+db.Index('ix_bookmark_tags', Bookmark.tags, postgresql_using='gin')
+db.Index('ix_bookmark_user_timestamp', Bookmark.user, Bookmark.timestamp)
+# jsonb_path_ops supports only @>, but is smaller and faster than the
+# default operator class
+db.Index('ix_bookmark_meta', Bookmark.meta, postgresql_using='gin',
+         postgresql_ops={'meta': 'jsonb_path_ops'})
+db.Index('ix_bookmark_parent_id', Bookmark.parent_id)
+db.Index('ix_note_bookmark_id', Note.bookmark_id)
+db.Index('ix_bookmark_search', Bookmark.search, postgresql_using='gin')
+db.Index('ix_page_search', Page.search, postgresql_using='gin')
+db.Index('ix_tag_user_name_pattern', Tag.user, Tag.name,
+         postgresql_ops={'name': 'text_pattern_ops'})
+db.Index('ix_bookmark_user_updated_at',
+         Bookmark.user, Bookmark.updated_at, Bookmark.id)
+db.Index('ix_bookmark_tombstone_user_deleted_at',
+         BookmarkTombstone.user, BookmarkTombstone.deleted_at)
+
+
+# Keeps tag table in sync with bookmark tags. Keep in sync with
+# migrations.
+BOOKMARK_TAGS_TRIGGER = """
+CREATE OR REPLACE FUNCTION bookmark_tags_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE tag SET count = count - 1
+         WHERE tag."user" = OLD."user" AND tag.name = ANY(OLD.tags);
+        DELETE FROM tag
+         WHERE tag."user" = OLD."user" AND tag.name = ANY(OLD.tags)
+           AND tag.count <= 0;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO tag ("user", name, count)
+        SELECT DISTINCT NEW."user", t.name, 1
+          FROM unnest(NEW.tags) AS t(name)
+         WHERE t.name IS NOT NULL
+        ON CONFLICT ("user", name) DO UPDATE SET count = tag.count + 1;
+    END IF;
+
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER bookmark_tags_changed
+AFTER DELETE OR UPDATE OF "user", tags ON bookmark
+FOR EACH ROW EXECUTE PROCEDURE bookmark_tags_changed();
+
+-- Inserts are counted once per statement. Upserting the same tag rows
+-- for every inserted bookmark gets slower with every update of a row
+-- in the same transaction, which made bulk imports quadratic.
+CREATE OR REPLACE FUNCTION bookmark_tags_inserted() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO tag ("user", name, count)
+    SELECT b."user", t.name, count(DISTINCT b.id)
+      FROM inserted AS b, unnest(b.tags) AS t(name)
+     WHERE t.name IS NOT NULL
+     GROUP BY b."user", t.name
+    ON CONFLICT ("user", name) DO UPDATE
+       SET count = tag.count + EXCLUDED.count;
+
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER bookmark_tags_inserted
+AFTER INSERT ON bookmark
+REFERENCING NEW TABLE AS inserted
+FOR EACH STATEMENT EXECUTE PROCEDURE bookmark_tags_inserted();
+"""
+
+sqlalchemy.event.listen(db.metadata, 'after_create',
+                        sqlalchemy.DDL(BOOKMARK_TAGS_TRIGGER))
+
+
+# Functions that render values of bookmark columns as JSON in the
+# database, byte-for-byte as json.dumps() renders them after loading:
+# separators of the default settings, \u escapes for non-ASCII
+# characters, isoformat() for timestamps and repr() for floats. The
+# latter relies on PostgreSQL 12+ printing the shortest representation
+# of floats. Keep in sync with Bookmark.to_dict() and migrations.
+BOOKMARK_JSON_FUNCTIONS = r"""
+CREATE OR REPLACE FUNCTION json_ascii(s text) RETURNS text AS $$
+    SELECT CASE
+        WHEN octet_length(s) = char_length(s) AND strpos(s, chr(127)) = 0
+            THEN s
+        ELSE (
+            -- Runs of ASCII are kept, other characters are escaped
+            SELECT string_agg(CASE
+                WHEN ascii(m[1]) < 127 THEN m[1]
+                WHEN ascii(m[1]) < 65536
+                    THEN '\u' || lpad(to_hex(ascii(m[1])), 4, '0')
+                ELSE '\u' || to_hex(55296 + ((ascii(m[1]) - 65536) >> 10)) ||
+                     '\u' || to_hex(56320 + ((ascii(m[1]) - 65536) & 1023))
+            END, '' ORDER BY n)
+            FROM regexp_matches(s, '[\x01-\x7e]+|.', 'g')
+                 WITH ORDINALITY AS t(m, n))
+    END
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION json_isoformat(t timestamp) RETURNS text AS $$
+    SELECT CASE
+        WHEN t IS NULL THEN 'null'
+        WHEN date_trunc('second', t) = t
+            THEN '"' || to_char(t, 'YYYY-MM-DD"T"HH24:MI:SS') || '"'
+        ELSE '"' || to_char(t, 'YYYY-MM-DD"T"HH24:MI:SS.US') || '"'
+    END
+$$ LANGUAGE sql IMMUTABLE;
+
+-- repr() of the float, given the shortest representation that
+-- PostgreSQL 12+ prints
+CREATE OR REPLACE FUNCTION json_float(x float8) RETURNS text AS $$
+DECLARE
+    s text := abs(x)::text;
+    mantissa text := split_part(s, 'e', 1);
+    digits text := replace(mantissa, '.', '');
+    -- Decimal exponent of the first significant digit
+    e integer := coalesce(nullif(split_part(s, 'e', 2), '')::integer, 0) +
+                 length(split_part(mantissa, '.', 1)) - 1 -
+                 (length(digits) - length(ltrim(digits, '0')));
+    sign text := CASE WHEN x < 0 THEN '-' ELSE '' END;
+    k integer;
+    n numeric;
+    unit numeric;
+    c numeric;
+    best numeric;
+BEGIN
+    -- Some of these integers are printed with more digits than needed,
+    -- so the shortest one that reads back as x is searched for. n is x
+    -- exactly: abs(x) / 2 ^ k is an integer that fits bigint.
+    IF abs(x) >= 2 ^ 53 THEN
+        k := greatest(floor(log(2, abs(x)::numeric))::integer - 54, 0);
+        n := trunc((abs(x) / 2 ^ k)::bigint * 2::numeric ^ k);
+        FOR p IN 1..17 LOOP
+            unit := 10::numeric ^ (length(n::text) - p);
+            FOREACH c IN ARRAY ARRAY[div(n, unit) * unit,
+                                     (div(n, unit) + 1) * unit] LOOP
+                -- Rounding up may go past the largest float
+                CONTINUE WHEN c >= 2::numeric ^ 1024;
+                IF c::float8 = abs(x) AND
+                   (best IS NULL OR abs(c - n) < abs(best - n)) THEN
+                    best := c;
+                END IF;
+            END LOOP;
+            EXIT WHEN best IS NOT NULL;
+        END LOOP;
+        digits := trunc(best)::text;
+        e := length(digits) - 1;
+    END IF;
+
+    digits := rtrim(ltrim(digits, '0'), '0');
+    IF digits = '' THEN
+        RETURN sign || '0.0';
+    ELSIF e >= 16 OR e < -4 THEN
+        RETURN sign || left(digits, 1) ||
+            CASE WHEN length(digits) > 1 THEN '.' || substr(digits, 2)
+                 ELSE '' END ||
+            CASE WHEN e < 0 THEN 'e-' ELSE 'e+' END ||
+            CASE WHEN abs(e) < 10 THEN '0' ELSE '' END || abs(e);
+    ELSIF e < 0 THEN
+        RETURN sign || '0.' || repeat('0', -e - 1) || digits;
+    END IF;
+    RETURN sign || rpad(left(digits, e + 1), e + 1, '0') || '.' ||
+        coalesce(nullif(substr(digits, e + 2), ''), '0');
+END
+$$ LANGUAGE plpgsql IMMUTABLE SET extra_float_digits = 1;
+
+-- jsonb as json.dumps() renders it after psycopg2 loads it: fractional
+-- numbers become floats, integers stay as they are
+CREATE OR REPLACE FUNCTION json_meta(meta jsonb) RETURNS text AS $$
+    SELECT CASE
+        WHEN strpos(meta::text, '.') = 0 THEN json_ascii(meta::text)
+        ELSE (
+            SELECT string_agg(CASE
+                WHEN m[1] ~ '^-?[0-9].*[.]' THEN json_float(m[1]::float8)
+                ELSE json_ascii(m[1])
+            END, '' ORDER BY n)
+            FROM regexp_matches(meta::text,
+                                '"(?:[^"\\]|\\.)*"|-?[0-9][-+.eE0-9]*|[^"0-9-]+',
+                                'g') WITH ORDINALITY AS t(m, n))
+    END
+$$ LANGUAGE sql IMMUTABLE;
+"""
+
+sqlalchemy.event.listen(db.metadata, 'after_create',
+                        sqlalchemy.DDL(BOOKMARK_JSON_FUNCTIONS))
+
+
+# Text search configuration used for Bookmark.search and Page.search. It
+# is also hardcoded in BOOKMARK_SEARCH_TRIGGERS.
+SEARCH_CONFIG = 'english'
+
+# Keeps Bookmark.search up to date with title, tags and notes, and
+# Page.search with content (in order of decreasing weight). Keep in sync
+# with migrations.
+BOOKMARK_SEARCH_TRIGGERS = """
+CREATE OR REPLACE FUNCTION bookmark_search_vector(
+    target_id integer, title text, tags text[])
+RETURNS tsvector AS $$
+    SELECT setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+           setweight(to_tsvector('english',
+                                 coalesce(array_to_string(tags, ' '), '')),
+                     'A') ||
+           setweight(to_tsvector('english', coalesce(
+               (SELECT string_agg(note.text, ' ' ORDER BY note.id)
+                  FROM note
+                 WHERE note.bookmark_id = target_id), '')), 'B')
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION bookmark_search_changed() RETURNS trigger AS $$
+BEGIN
+    NEW.search := bookmark_search_vector(NEW.id, NEW.title, NEW.tags);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER bookmark_search_changed
+BEFORE INSERT OR UPDATE OF title, tags ON bookmark
+FOR EACH ROW EXECUTE PROCEDURE bookmark_search_changed();
+
+CREATE OR REPLACE FUNCTION note_search_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE bookmark
+           SET search = bookmark_search_vector(id, title, tags)
+         WHERE id = OLD.bookmark_id;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE bookmark
+           SET search = bookmark_search_vector(id, title, tags)
+         WHERE id = NEW.bookmark_id;
+    END IF;
+
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER note_search_changed
+AFTER INSERT OR DELETE OR UPDATE OF bookmark_id, text ON note
+FOR EACH ROW EXECUTE PROCEDURE note_search_changed();
+
+CREATE OR REPLACE FUNCTION page_search_changed() RETURNS trigger AS $$
+BEGIN
+    -- tsvector size is limited to 1MB
+    NEW.search := setweight(
+        to_tsvector('english', left(coalesce(NEW.content_text, ''), 500000)),
+        'C');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER page_search_inserted
+BEFORE INSERT ON page
+FOR EACH ROW EXECUTE PROCEDURE page_search_changed();
+
+CREATE TRIGGER page_search_changed
+BEFORE UPDATE OF content_text ON page
+FOR EACH ROW
+WHEN (OLD.content_text IS DISTINCT FROM NEW.content_text)
+EXECUTE PROCEDURE page_search_changed();
+"""
+
+sqlalchemy.event.listen(db.metadata, 'after_create',
+                        sqlalchemy.DDL(BOOKMARK_SEARCH_TRIGGERS))
+
+
+# Keeps updated_at columns up to date and records deleted bookmarks.
+# Changes of notes reach bookmark.updated_at through the UPDATE issued
+# by note_search_changed(). Keep in sync with migrations.
+SYNC_TRIGGERS = """
+CREATE OR REPLACE FUNCTION touch_updated_at() RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at := clock_timestamp() AT TIME ZONE 'UTC';
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER bookmark_touch_updated_at
+BEFORE UPDATE ON bookmark
+FOR EACH ROW EXECUTE PROCEDURE touch_updated_at();
+
+CREATE TRIGGER note_touch_updated_at
+BEFORE UPDATE ON note
+FOR EACH ROW EXECUTE PROCEDURE touch_updated_at();
+
+CREATE OR REPLACE FUNCTION bookmark_deleted() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO bookmark_tombstone (id, "user")
+    VALUES (OLD.id, OLD."user");
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER bookmark_deleted
+AFTER DELETE ON bookmark
+FOR EACH ROW EXECUTE PROCEDURE bookmark_deleted();
+"""
+
+sqlalchemy.event.listen(db.metadata, 'after_create',
+                        sqlalchemy.DDL(SYNC_TRIGGERS))
+
+
+def sync_horizon():
+    """Time up to which changes of all committed and running
+    transactions are visible.
+
+    updated_at is taken when a row is changed, but the row becomes
+    visible only on commit. Changes stamped before the start of a
+    transaction that is still writing may yet appear, so the horizon
+    doesn't go past it.
+    """
+    return db.session.execute("""
+        SELECT least(clock_timestamp(), min(xact_start))
+               AT TIME ZONE 'UTC'
+          FROM pg_stat_activity
+         WHERE backend_xid IS NOT NULL
+           AND datname = current_database()
+    """).scalar()
+
+
+def page_keys(query):
+    """Make bookmarks query return (id, read, timestamp) tuples, enough
+    to paginate it and render the page with bookmarks_json()."""
+    return query.with_entities(Bookmark.id, Bookmark.read,
+                               Bookmark.timestamp)
+
+
+# Renders bookmarks with the given ids, in the order of the ids, with
+# notes and all descendants, as fragments of a JSON list. Descendants
+# come in depth-first order, so each fragment knows from the depth of
+# its neighbours whether to open a list of children or how many to
+# close.
+BOOKMARKS_JSON = sqlalchemy.text("""
+WITH RECURSIVE tree (n, id, path) AS (
+    SELECT items.n, bookmark.id, ARRAY[bookmark.id]
+      FROM unnest(CAST(:ids AS integer[])) WITH ORDINALITY AS items(id, n)
+      JOIN bookmark ON bookmark.id = items.id
+    UNION ALL
+    SELECT tree.n, bookmark.id, tree.path || bookmark.id
+      FROM tree
+      JOIN bookmark ON bookmark.parent_id = tree.id
+     WHERE bookmark.id <> ALL(tree.path)
+), rendered AS (
+    SELECT tree.n, tree.path, array_length(tree.path, 1) AS depth,
+           '{"id": ' || b.id ||
+           ', "url": ' || json_ascii(to_json(b.url)::text) ||
+           ', "title": ' || json_ascii(to_json(b.title)::text) ||
+           ', "timestamp": ' || json_isoformat(b.timestamp) ||
+           ', "read": ' || json_isoformat(b.read) ||
+           ', "meta": ' || coalesce(json_meta(b.meta), 'null') ||
+           ', "tags": ' || coalesce('[' || tags.json || ']', 'null') ||
+           ', "notes": [' || coalesce(notes.json, '') || ']' ||
+           coalesce(', "parent": ' || b.parent_id, '') AS json
+      FROM tree
+      JOIN bookmark b ON b.id = tree.id
+      CROSS JOIN LATERAL (
+          SELECT CASE WHEN b.tags IS NOT NULL THEN coalesce(string_agg(
+                     coalesce(json_ascii(to_json(tag)::text), 'null'),
+                     ', ' ORDER BY i), '') END AS json
+            FROM unnest(b.tags) WITH ORDINALITY AS t(tag, i)) AS tags
+      CROSS JOIN LATERAL (
+          SELECT string_agg('{"id": ' || note.id || ', "text": ' ||
+                            json_ascii(to_json(note.text)::text) || '}',
+                            ', ' ORDER BY note.id) AS json
+            FROM note
+           WHERE note.bookmark_id = b.id) AS notes
+)
+SELECT CASE WHEN lag(depth) OVER w >= depth THEN ', ' ELSE '' END ||
+       json ||
+       CASE WHEN lead(depth) OVER w > depth THEN ', "children": ['
+            ELSE '}' || repeat(']}', depth - coalesce(lead(depth) OVER w, 1))
+       END
+  FROM rendered
+WINDOW w AS (ORDER BY n, path)
+ORDER BY n, path
+""")
+
+
+def bookmarks_json(ids):
+    """Fragments of the JSON list of bookmarks with the ids, in order,
+    exactly as json.dumps([b.to_dict() for b in bookmarks]) renders it
+    between the brackets. Rows are streamed from the database."""
+    if not ids:
+        return
+    result = db.session.execute(
+        BOOKMARKS_JSON.execution_options(stream_results=True),
+        {'ids': list(ids)})
+    for fragment, in result:
+        yield fragment
+
+
+def bookmark_version(id, user):
+    """(updated_at, page fetched_at) of the bookmark, or None if the
+    user has no such bookmark. Content of a shared page changes without
+    touching its bookmarks, hence the latter."""
+    return Bookmark.query \
+                   .outerjoin(Bookmark.page) \
+                   .with_entities(Bookmark.updated_at, Page.fetched_at) \
+                   .filter(Bookmark.id == id, Bookmark.user == user) \
+                   .first()
+
+
+def url_hash(url):
+    """Same as md5(url) in the database."""
+    return hashlib.md5(url.encode()).hexdigest()
+
+
+def has_url(urls):
+    """Filter for bookmarks with one of the (already normalized) urls
+    that can use ix_bookmark_user_url_md5."""
+    urls = list(urls)
+    return db.and_(db.func.md5(Bookmark.url).in_(list(map(url_hash, urls))),
+                   Bookmark.url.in_(urls))
+
+
+def find_pages(urls):
+    """{url: page} of pages of the urls."""
+    urls = list(urls)
+    if not urls:
+        return {}
+
+    pages = Page.query \
+                .filter(db.func.md5(Page.url).in_(list(map(url_hash, urls))),
+                        Page.url.in_(urls))
+    return {page.url: page for page in pages}
+
+
+def stale_pages(max_age, limit):
+    """Urls of pages fetched more than max_age seconds ago that still
+    have bookmarks, most recently opened first."""
+    since = datetime.datetime.utcnow() - datetime.timedelta(seconds=max_age)
+    bookmarked = db.session.query(Bookmark.id) \
+                           .filter(Bookmark.page_id == Page.id) \
+                           .exists()
+    pages = db.session.query(Page.url) \
+                      .filter(Page.fetched_at <= since, bookmarked) \
+                      .order_by(Page.opened_at.desc().nullslast(),
+                                Page.fetched_at) \
+                      .limit(limit)
+    return [url for url, in pages]
+
+
+def store_page(url, title, html, text, etag=None, last_modified=None):
+    """Insert or update the page of the url and return its id.
+
+    This doesn't commit.
+    """
+    table = Page.__table__
+    insert = postgresql.insert(table).values(
+        url=url, title=title, content_html=html, content_text=text,
+        etag=etag, last_modified=last_modified)
+    insert = insert.on_conflict_do_update(
+        index_elements=[db.func.md5(table.c.url)],
+        set_={'title': insert.excluded.title,
+              'content_html': insert.excluded.content_html,
+              'content_text': insert.excluded.content_text,
+              'etag': insert.excluded.etag,
+              'last_modified': insert.excluded.last_modified,
+              'fetched_at': UTC_NOW})
+    return db.session.execute(insert.returning(table.c.id)).scalar()
+
+
+def page_users(page_ids):
+    """Ids of users with bookmarks referencing one of the pages."""
+    page_ids = list(page_ids)
+    if not page_ids:
+        return set()
+
+    users = db.session.query(Bookmark.user) \
+                      .filter(Bookmark.page_id.in_(page_ids)) \
+                      .distinct()
+    return {user for user, in users}
+
+
+def touch_page(url):
+    """Mark the page of the url as fetched just now, when it didn't
+    change since the last fetch. Returns (id, title) of the page, or
+    None if there is no page.
+
+    This doesn't commit.
+    """
+    table = Page.__table__
+    update = table.update() \
+                  .where(db.func.md5(table.c.url) == url_hash(url)) \
+                  .where(table.c.url == url) \
+                  .values(fetched_at=UTC_NOW) \
+                  .returning(table.c.id, table.c.title)
+    return db.session.execute(update).first()
+
+
+def pages_opened(opens):
+    """Record when content of bookmarks was last read, given as
+    {bookmark id: time}, in opened_at of their pages.
+
+    This doesn't commit.
+    """
+    if not opens:
+        return
+
+    ids, times = zip(*opens.items())
+    db.session.execute(sqlalchemy.text("""
+        UPDATE page
+           SET opened_at = GREATEST(page.opened_at, opened.at)
+          FROM (SELECT bookmark.page_id, max(o.at) AS at
+                  FROM unnest(:ids, :times) AS o(id, at)
+                  JOIN bookmark ON bookmark.id = o.id
+                 GROUP BY bookmark.page_id) AS opened
+         WHERE page.id = opened.page_id
+    """), {'ids': list(ids), 'times': list(times)})
+
+
+def link_page(page_id, url, title):
+    """Make bookmarks of all users with the url reference the page, and
+    take the page title where bookmarks have no title of their own.
+    Returns ids of users whose bookmarks changed.
+
+    This doesn't commit.
+    """
+    table = Bookmark.__table__
+    values = {'page_id': page_id}
+    if title:
+        # title was not set
+        values['title'] = sqlalchemy.case(
+            [(table.c.title == table.c.url, title)], else_=table.c.title)
+
+    update = table.update() \
+                  .where(db.func.md5(table.c.url) == url_hash(url)) \
+                  .where(table.c.url == url) \
+                  .where(table.c.page_id.is_distinct_from(page_id)) \
+                  .values(values) \
+                  .returning(table.c.user)
+    return {user for user, in db.session.execute(update)}
+
+
+def insert_bookmarks(bookmarks, chunk_size=1000):
+    """Insert new bookmarks using multi-row INSERT statements, instead
+    of one statement per bookmark as session.add() does. Bookmarks are
+    assigned ids, but are not added to the session.
+
+    This doesn't commit.
+    """
+    if not bookmarks:
+        return
+
+    # Allocate ids first, so they can be matched with bookmarks
+    ids = db.session.query(db.func.nextval('bookmark_id_seq')) \
+                    .select_from(db.func.generate_series(1, len(bookmarks))) \
+                    .all()
+    for bookmark, (id,) in zip(bookmarks, sorted(ids)):
+        bookmark.id = id
+
+    table = Bookmark.__table__
+    columns = ['id', 'user', 'timestamp', 'url', 'title', 'read', 'meta',
+               'tags', 'parent_id']
+    for i in range(0, len(bookmarks), chunk_size):
+        db.session.execute(table.insert().values([
+            {c: getattr(b, c) for c in columns}
+            for b in bookmarks[i:i + chunk_size]
+        ]))
+
+
+def copy_text(value):
+    """Format value as a field of COPY text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, list):
+        value = '{' + ','.join(
+            '"' + v.replace('\\', '\\\\').replace('"', '\\"') + '"'
+            for v in value) + '}'
+    return value.replace('\x00', '') \
+                .replace('\\', '\\\\') \
+                .replace('\t', '\\t') \
+                .replace('\n', '\\n') \
+                .replace('\r', '\\r')
+
+
+class CopyStream(object):
+    """File-like object that psycopg2 reads COPY data from. It pulls
+    rows from an iterator only as fast as the database consumes them."""
+
+    def __init__(self, rows):
+        self.lines = ('\t'.join(map(copy_text, row)) + '\n' for row in rows)
+        self.buffer = ''
+        self.error = None
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                chunk = ''.join(itertools.islice(self.lines, 1000))
+            except Exception as e:
+                self.error = e
+                raise
+            if not chunk:
+                break
+            self.buffer += chunk
+
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+IMPORT_COLUMNS = ('timestamp', 'url', 'title', 'read', 'meta', 'tags')
+
+
+def copy_bookmarks(user, rows):
+    """Import (timestamp, url, title, read, meta, tags) rows of a user.
+    meta is a JSON string.
+
+    Rows are streamed with COPY into a temporary staging table and then
+    merged into bookmark with a single INSERT ... SELECT. Urls that the
+    user already has, or that appear more than once, are imported once.
+
+    Returns (number of rows, [(id, url)] of the new bookmarks). This
+    doesn't commit.
+    """
+    db.session.execute("""
+        CREATE TEMPORARY TABLE bookmark_import (
+            position bigserial,
+            timestamp timestamp NOT NULL,
+            url text NOT NULL,
+            title text NOT NULL,
+            read timestamp,
+            meta jsonb,
+            tags text[]
+        ) ON COMMIT DROP
+    """)
+
+    stream = CopyStream(rows)
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            'COPY bookmark_import ({}) FROM STDIN'.format(
+                ', '.join(IMPORT_COLUMNS)),
+            stream)
+    except Exception:
+        # psycopg2 replaces errors raised by read() with its own
+        if stream.error is not None:
+            raise stream.error
+        raise
+    finally:
+        cursor.close()
+    total = cursor.rowcount
+
+    new = db.session.execute("""
+        INSERT INTO bookmark ("user", timestamp, url, title, read, meta, tags)
+        SELECT :user, i.timestamp, i.url, i.title, i.read, i.meta, i.tags
+          FROM (SELECT DISTINCT ON (url) *
+                  FROM bookmark_import
+                 ORDER BY url, position) AS i
+         WHERE NOT EXISTS (
+                   SELECT 1
+                     FROM bookmark
+                    WHERE bookmark."user" = :user
+                      AND md5(bookmark.url) = md5(i.url)
+                      AND bookmark.url = i.url)
+         ORDER BY i.position
+        RETURNING id, url
+    """, {'user': user}).fetchall()
+
+    return total, new
+
+
+def load_notes(bookmarks):
+    """Load notes of all bookmarks in one query."""
+    if not bookmarks:
+        return bookmarks
+
+    notes = collections.defaultdict(list)
+    for note in Note.query \
+                    .filter(Note.bookmark_id.in_([b.id for b in bookmarks])) \
+                    .order_by(Note.id):
+        notes[note.bookmark_id].append(note)
+
+    for bookmark in bookmarks:
+        set_committed_value(bookmark, 'notes', notes[bookmark.id])
+
+    return bookmarks
+
+
+def load_tree(bookmarks, depth=None, notes=True, options=()):
+    """Load notes and descendants of the bookmarks, so that
+    Bookmark.to_dict() doesn't issue lazy loads for every row and every
+    level of nesting.
+
+    depth limits the number of levels of descendants (None loads all of
+    them). notes=False skips loading notes. options (e.g. load_only())
+    apply to the query for descendants.
+
+    This takes two queries no matter how many bookmarks there are or
+    how deep the hierarchy is: one recursive query for descendants and
+    one for notes.
+    """
+    if not bookmarks:
+        return bookmarks
+
+    ids = [b.id for b in bookmarks]
+
+    descendants = []
+    if depth is None:
+        # UNION (not UNION ALL) stops recursion if there is a loop
+        tree = db.session.query(Bookmark.id) \
+                         .filter(Bookmark.parent_id.in_(ids)) \
+                         .cte('tree', recursive=True)
+        tree = tree.union(db.session.query(Bookmark.id)
+                                    .filter(Bookmark.parent_id == tree.c.id))
+    elif depth > 0:
+        tree = db.session.query(Bookmark.id,
+                                sqlalchemy.literal(1).label('depth')) \
+                         .filter(Bookmark.parent_id.in_(ids)) \
+                         .cte('tree', recursive=True)
+        child = sqlalchemy.orm.aliased(Bookmark)
+        tree = tree.union_all(
+            db.session.query(child.id, tree.c.depth + 1)
+                      .filter(child.parent_id == tree.c.id,
+                              tree.c.depth < depth))
+    if depth is None or depth > 0:
+        descendants = Bookmark.query \
+            .options(*options) \
+            .filter(Bookmark.id.in_(db.session.query(tree.c.id))) \
+            .order_by(Bookmark.id) \
+            .all()
+
+    everything = list(bookmarks) + descendants
+    if notes:
+        load_notes(everything)
+
+    children = collections.defaultdict(list)
+    for bookmark in descendants:
+        children[bookmark.parent_id].append(bookmark)
+
+    for bookmark in everything:
+        set_committed_value(bookmark, 'children', children[bookmark.id])
+
+    return bookmarks
+
+
+def load_subtree(id, user, depth):
+    """Load bookmark with descendants up to depth levels below it
+    (and notes of all of them) in a single query. Returns None if
+    there is no such bookmark. Bookmarks at the last level are loaded
+    without children.
+    """
+    tree = db.session.query(Bookmark.id,
+                            sqlalchemy.literal(0).label('depth')) \
+                     .filter(Bookmark.id == id, Bookmark.user == user) \
+                     .cte('tree', recursive=True)
+    child = sqlalchemy.orm.aliased(Bookmark)
+    tree = tree.union_all(
+        db.session.query(child.id, tree.c.depth + 1)
+                  .filter(child.parent_id == tree.c.id,
+                          tree.c.depth < depth))
+
+    rows = db.session.query(Bookmark, Note) \
+                     .join(tree, Bookmark.id == tree.c.id) \
+                     .outerjoin(Note, Note.bookmark_id == Bookmark.id) \
+                     .order_by(tree.c.depth, Bookmark.id, Note.id)
+
+    bookmarks = collections.OrderedDict()
+    notes = collections.defaultdict(list)
+    for bookmark, note in rows:
+        bookmarks[bookmark.id] = bookmark
+        if note is not None:
+            notes[bookmark.id].append(note)
+
+    children = collections.defaultdict(list)
+    for bookmark in bookmarks.values():
+        if bookmark.id != id:
+            children[bookmark.parent_id].append(bookmark)
+
+    for bookmark in bookmarks.values():
+        set_committed_value(bookmark, 'notes', notes[bookmark.id])
+        set_committed_value(bookmark, 'children', children[bookmark.id])
+
+    return bookmarks.get(id)
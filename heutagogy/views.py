@@ -1,16 +1,31 @@
 from heutagogy import app
-from heutagogy.heutagogy import q
+from heutagogy.heutagogy import redis_db
 import heutagogy.persistence as db
-from heutagogy.auth import token_required
+from heutagogy.auth import token_required, User
 import heutagogy.article as article
+import heutagogy.cache as cache
+import heutagogy.importer as importer
+import heutagogy.jobs as jobs
 
 from flask_user import current_user
-from flask import request, send_from_directory
-from flask_restful import Resource, Api
+from flask import request, send_from_directory, stream_with_context
+from flask_restful import Resource, Api, unpack
+import sqlalchemy
+import sqlalchemy.dialects.postgresql as postgresql
 import sqlalchemy.orm
 
 from http import HTTPStatus
+import base64
+import binascii
+import click
+import codecs
 import datetime
+import hashlib
+import itertools
+import json
+import os
+import time
+import zlib
 import aniso8601
 import urllib.parse as urlparse
 import link_header as lh
@@ -26,7 +41,8 @@ def root():
 @app.after_request
 def after_request(response):
     response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers['Access-Control-Expose-Headers'] = 'Link'
+    response.headers['Access-Control-Expose-Headers'] = \
+        'Link, X-Total-Count, ETag'
     if request.method == 'OPTIONS':
         response.headers['Access-Control-Allow-Methods'] = \
             'DELETE, GET, POST, PUT'
@@ -48,47 +64,490 @@ def update_query(url, params):
 def filter_url(url):
     u = urlparse.urlsplit(url)
 
-    query = sorted([
-        (k, v)
-        for k, v in urlparse.parse_qsl(u.query)
-        if not k.startswith('utm_')])
+    if u.query:
+        query = sorted([
+            (k, v)
+            for k, v in urlparse.parse_qsl(u.query)
+            if not k.startswith('utm_')])
+        u = u._replace(query=urlparse.urlencode(query))
 
-    u = u._replace(fragment='', query=urlparse.urlencode(query))
+    u = u._replace(fragment='')
 
     return u.geturl()
 
 
-def is_child(parent, potential_child):
-    if parent.id == potential_child.id:
-        return True
+# Order in which bookmarks are listed. Unread bookmarks go first, then
+# the most recently read ones. id breaks the ties, so the order is
+# total and can be used for keyset pagination.
+BOOKMARKS_ORDER = (
+    db.Bookmark.read.desc().nullsfirst(),
+    db.Bookmark.timestamp.desc(),
+    db.Bookmark.id.desc(),
+)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def encode_cursor(bookmark, direction):
+    """Encode position of the bookmark in BOOKMARKS_ORDER as an opaque
+    cursor. direction is either 'next' or 'prev'."""
+    def micros(t):
+        return (t - EPOCH) // datetime.timedelta(microseconds=1)
+
+    key = [
+        micros(bookmark.read) if bookmark.read is not None else None,
+        micros(bookmark.timestamp),
+        bookmark.id,
+        direction,
+    ]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decode cursor produced by encode_cursor. Returns (read,
+    timestamp, id, direction) tuple. Raises ValueError if cursor is
+    malformed."""
+    def from_micros(t):
+        return EPOCH + datetime.timedelta(microseconds=t)
+
+    try:
+        read, timestamp, id, direction = json.loads(
+            base64.urlsafe_b64decode(cursor.encode()).decode())
+        if direction not in ('next', 'prev'):
+            raise ValueError('unknown direction')
+        return (from_micros(read) if read is not None else None,
+                from_micros(timestamp), int(id), direction)
+    except (binascii.Error, TypeError, OverflowError, UnicodeError):
+        raise ValueError('malformed cursor')
+
+
+def after_cursor(read, timestamp, id):
+    """Filters for bookmarks that go after the given position in
+    BOOKMARKS_ORDER, one per group of bookmarks (unread, then read), in
+    order. Each is a single row comparison that PostgreSQL uses as a
+    range bound on ix_bookmark_user_read_timestamp, which an OR of the
+    groups couldn't be."""
+    if read is None:
+        return [sqlalchemy.and_(
+                    db.Bookmark.read.is_(None),
+                    sqlalchemy.tuple_(db.Bookmark.timestamp,
+                                      db.Bookmark.id) <
+                    sqlalchemy.tuple_(timestamp, id)),
+                db.Bookmark.read.isnot(None)]
+    return [sqlalchemy.tuple_(db.Bookmark.read, db.Bookmark.timestamp,
+                              db.Bookmark.id) <
+            sqlalchemy.tuple_(read, timestamp, id)]
+
+
+def before_cursor(read, timestamp, id):
+    """Filters for bookmarks that go before the given position in
+    BOOKMARKS_ORDER, in reverse order. See after_cursor()."""
+    if read is None:
+        return [sqlalchemy.and_(
+            db.Bookmark.read.is_(None),
+            sqlalchemy.tuple_(db.Bookmark.timestamp, db.Bookmark.id) >
+            sqlalchemy.tuple_(timestamp, id))]
+    return [sqlalchemy.tuple_(db.Bookmark.read, db.Bookmark.timestamp,
+                              db.Bookmark.id) >
+            sqlalchemy.tuple_(read, timestamp, id),
+            db.Bookmark.read.is_(None)]
+
+
+def first_rows(query, filters, order, limit):
+    """Up to limit rows of query in order, taking rows matching the
+    first filter, then the second one and so on. A group is queried
+    only if the previous ones don't fill the limit."""
+    items = []
+    for f in filters:
+        items += query.filter(f).order_by(*order) \
+                      .limit(limit - len(items)).all()
+        if len(items) >= limit:
+            break
+    return items
+
+
+# Largest page size clients can get. Larger per_page is reduced to it.
+MAX_PER_PAGE = 500
+
+
+def per_page_arg():
+    """per_page argument (20 by default) limited to MAX_PER_PAGE.
+    Raises ValueError if it isn't positive."""
+    per_page = request.args.get('per_page', 20, type=int)
+    if per_page < 1:
+        raise ValueError('per_page must be positive')
+    return min(per_page, MAX_PER_PAGE)
+
+
+def keyset_paginate(query, cursor, per_page):
+    """Paginate query using keyset pagination. Unlike .paginate(), it
+    doesn't issue COUNT and doesn't use OFFSET, so the cost of the
+    page doesn't depend on how deep it is.
+
+    cursor is either empty (first page) or a value produced by
+    encode_cursor. Returns (items, next_cursor, prev_cursor), where
+    cursors are None if there is no corresponding page."""
+    if not cursor:
+        items = query.order_by(*BOOKMARKS_ORDER).limit(per_page + 1).all()
+        has_next, has_prev = len(items) > per_page, False
+        items = items[:per_page]
+    else:
+        read, timestamp, id, direction = decode_cursor(cursor)
+        if direction == 'next':
+            items = first_rows(query, after_cursor(read, timestamp, id),
+                               BOOKMARKS_ORDER, per_page + 1)
+            has_next, has_prev = len(items) > per_page, True
+            items = items[:per_page]
+        else:
+            items = first_rows(query, before_cursor(read, timestamp, id),
+                               [db.Bookmark.read.asc().nullslast(),
+                                db.Bookmark.timestamp.asc(),
+                                db.Bookmark.id.asc()],
+                               per_page + 1)
+            has_next, has_prev = True, len(items) > per_page
+            items = list(reversed(items[:per_page]))
+
+    next_cursor = encode_cursor(items[-1], 'next') \
+        if has_next and items else None
+    prev_cursor = encode_cursor(items[0], 'prev') \
+        if has_prev and items else None
+    return items, next_cursor, prev_cursor
+
+
+def render_json_in_db():
+    """Whether bookmark lists should be rendered to JSON by the
+    database. Database output matches Flask-RESTful output only with
+    default JSON settings, which debug mode overrides, and floats are
+    rendered the way Python does only by PostgreSQL 12+."""
+    version = db.db.engine.dialect.server_version_info or ()
+    return app.config['BOOKMARKS_JSON_IN_DB'] and \
+        not app.debug and \
+        not app.config.get('RESTFUL_JSON') and \
+        version >= (12,)
+
+
+# Keys of Bookmark.to_dict() that can be requested with ?fields=, and
+# columns they are rendered from
+BOOKMARK_FIELDS = {
+    'id': 'id',
+    'url': 'url',
+    'title': 'title',
+    'timestamp': 'timestamp',
+    'read': 'read',
+    'meta': 'meta',
+    'tags': 'tags',
+    'parent': 'parent_id',
+    'notes': None,
+    'children': None,
+}
+
+# Relationships that can be requested with ?expand=
+BOOKMARK_EXPANSIONS = ('notes', 'children')
+
+
+def split_names(arg, allowed, kind):
+    """Set of comma-separated names. Raises ValueError if any of them
+    is not allowed."""
+    names = set(filter(None, arg.split(',')))
+    unknown = names - set(allowed)
+    if unknown:
+        raise ValueError('unknown {}: {}'.format(
+            kind, ', '.join(sorted(unknown))))
+    return names
+
+
+def bookmark_shape():
+    """Parse fields, expand and depth arguments into keyword arguments
+    of Bookmark.to_dict(). Returns None if none of them is given, which
+    means the complete representation. Raises ValueError for unknown
+    names."""
+    if not any(x in request.args for x in ('fields', 'expand', 'depth')):
+        return None
+
+    fields = request.args.get('fields')
+    if fields is not None:
+        fields = split_names(fields, BOOKMARK_FIELDS, 'field')
+
+    expand = request.args.get('expand')
+    if expand is None:
+        expand = set(BOOKMARK_EXPANSIONS)
+    else:
+        expand = split_names(expand, BOOKMARK_EXPANSIONS, 'expansion')
+
+    def wanted(name):
+        return name in expand and (fields is None or name in fields)
+
+    depth = request.args.get('depth', type=int)
+    if depth is not None and depth < 0:
+        raise ValueError('depth must not be negative')
+
+    if not wanted('children'):
+        children = 0
+    elif depth is None:
+        children = True
+    else:
+        children = min(depth, TREE_MAX_DEPTH)
+
+    return {'fields': fields, 'notes': wanted('notes'), 'children': children}
+
+
+def shape_options(shape):
+    """Query options that load only the columns needed for the shape.
+    Columns used for ordering and building the tree are always
+    loaded."""
+    if shape is None or shape['fields'] is None:
+        return []
+    columns = {'id', 'parent_id', 'read', 'timestamp'}
+    columns.update(BOOKMARK_FIELDS[x] for x in shape['fields']
+                   if BOOKMARK_FIELDS[x])
+    return [sqlalchemy.orm.load_only(*columns)]
+
+
+def render_shaped(items, shape):
+    """Load what the shape needs for the bookmarks and convert them to
+    dicts. shape may be None for the complete representation."""
+    if shape is None:
+        db.load_tree(items)
+        return [x.to_dict() for x in items]
+
+    children = shape['children']
+    db.load_tree(items,
+                 depth=None if children is True else children,
+                 notes=shape['notes'],
+                 options=shape_options(shape))
+    return [x.to_dict(**shape) for x in items]
+
+
+def render_bookmarks(items, headers, shape=None):
+    """Build response for a list of bookmarks. If render_json_in_db()
+    is true and no shape is requested, items must come from a query
+    wrapped with db.page_keys(), and the body is streamed from the
+    database.
+    """
+    if shape is None and render_json_in_db():
+        body = itertools.chain(['['], db.bookmarks_json([x.id for x in items]),
+                               [']\n'])
+        return app.response_class(stream_with_context(body),
+                                  headers=headers,
+                                  mimetype='application/json')
+
+    return render_shaped(items, shape), 200, headers
+
+
+def make_etag(*versions):
+    """Strong ETag of the response to the current request, given
+    versions of the data it is rendered from. Flask-Compress changes
+    the body depending on Accept-Encoding, so it is part of the tag."""
+    key = json.dumps([request.full_path,
+                      request.headers.get('Accept-Encoding'),
+                      current_user.id] + list(versions), default=str)
+    return '"{}"'.format(hashlib.sha1(key.encode()).hexdigest())
+
+
+def not_modified(etag):
+    """304 response if the client already has the representation with
+    the etag, None otherwise."""
+    if request.if_none_match.contains_weak(etag.strip('"')):
+        return app.response_class(status=HTTPStatus.NOT_MODIFIED,
+                                  headers={'ETag': etag})
+    return None
+
+
+def cached_response(name, version, etag, render):
+    """Response of render(), which may return anything a resource
+    returns, cached for the current user and request path under the
+    version of the user the etag is made from."""
+    def compute():
+        response = render()
+        if not isinstance(response, app.response_class):
+            data, code, headers = unpack(response)
+            response = api.make_response(data, code, headers=headers)
+        return {
+            'status': response.status_code,
+            'headers': [(k, v) for k, v in response.headers
+                        if k != 'Content-Length'],
+            'body': response.get_data(as_text=True),
+        }
+
+    cached = cache.cached(name, current_user.id, request.full_path, compute,
+                          version=version)
+    response = app.response_class(cached['body'],
+                                  status=cached['status'],
+                                  headers=cached['headers'])
+    response.headers['ETag'] = etag
+    return response
 
-    for child in parent.children:
-        if is_child(child, potential_child):
-            return True
 
-    return False
+def enqueue_fetch_articles(bookmarks, user, bulk=False):
+    """Enqueue article fetching for the bookmarks of the user in one
+    redis round trip. Every job fetches FETCH_BATCH_SIZE bookmarks
+    concurrently. A few bookmarks are fetched with high priority, unless
+    they are part of a bulk operation."""
+    pairs = [(bookmark.id, bookmark.url) for bookmark in bookmarks]
+    if bulk or len(pairs) > app.config['FETCH_INTERACTIVE_MAX']:
+        jobs.enqueue_bulk(user, article.fetch_articles, pairs)
+    else:
+        jobs.enqueue(article.fetch_articles, pairs)
+
+
+def is_child(parent, potential_child):
+    """Whether potential_child is parent itself or one of its
+    descendants. Walks up ancestors of potential_child in a single
+    query."""
+    ancestors = db.db.session.query(db.Bookmark.id, db.Bookmark.parent_id) \
+                             .filter(db.Bookmark.id == potential_child.id) \
+                             .cte('ancestors', recursive=True)
+    # UNION (not UNION ALL) stops recursion if there already is a loop
+    ancestors = ancestors.union(
+        db.db.session.query(db.Bookmark.id, db.Bookmark.parent_id)
+                     .filter(db.Bookmark.id == ancestors.c.parent_id))
+
+    return db.db.session.query(
+        sqlalchemy.exists().where(ancestors.c.id == parent.id)).scalar()
+
+
+def bool_arg(name):
+    """Boolean argument, None if it is not given."""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    if value not in ('true', 'false'):
+        raise ValueError('{} must be true or false'.format(name))
+    return value == 'true'
+
+
+def datetime_arg(name):
+    """ISO 8601 date or datetime argument converted to UTC, None if it is
+    not given."""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        if 'T' in value:
+            return db.to_utc(aniso8601.parse_datetime(value))
+        return datetime.datetime.combine(aniso8601.parse_date(value),
+                                         datetime.time())
+    except ValueError:
+        raise ValueError('{} must be an ISO 8601 date or datetime'.format(
+            name))
+
+
+def meta_arg():
+    """Object that meta of bookmarks must contain. It is built from a
+    meta=<JSON object> argument and meta.<key>=<string> arguments."""
+    meta = {}
+    if 'meta' in request.args:
+        try:
+            meta = json.loads(request.args['meta'])
+        except ValueError:
+            meta = None
+        if not isinstance(meta, dict):
+            raise ValueError('meta must be a JSON object')
+
+    for key, value in request.args.items(multi=True):
+        if key.startswith('meta.'):
+            meta[key[len('meta.'):]] = value
+
+    return meta
+
+
+def bookmark_filters():
+    """Filters of the bookmark list requested by arguments. Ranges
+    include the lower bound and exclude the upper one. Raises ValueError
+    for invalid arguments."""
+    filters = [db.Bookmark.user == current_user.id]
+
+    url = request.args.get('url')
+    if url is not None:
+        filters.append(db.has_url([filter_url(url)]))
+
+    # If Bookmark.tags is null, filtering will yield no results
+    tags = request.args.getlist('tag')
+    if tags:
+        filters.append(db.Bookmark.tags.contains(tags))
+
+    read = bool_arg('read')
+    if read is not None:
+        filters.append(db.Bookmark.read.isnot(None) if read
+                       else db.Bookmark.read.is_(None))
+
+    ranges = [
+        ('read_after', db.Bookmark.read.__ge__),
+        ('read_before', db.Bookmark.read.__lt__),
+        ('created_after', db.Bookmark.timestamp.__ge__),
+        ('created_before', db.Bookmark.timestamp.__lt__),
+    ]
+    for name, condition in ranges:
+        value = datetime_arg(name)
+        if value is not None:
+            filters.append(condition(value))
+
+    if 'parent' in request.args:
+        try:
+            parent = int(request.args['parent'])
+        except ValueError:
+            raise ValueError('parent must be a bookmark id')
+        filters.append(db.Bookmark.parent_id == parent)
+
+    if bool_arg('root_only'):
+        filters.append(db.Bookmark.parent_id.is_(None))
+
+    meta = meta_arg()
+    if meta:
+        filters.append(db.Bookmark.meta.contains(meta))
+
+    return filters
 
 
 class Bookmarks(Resource):
     @token_required
     def get(self):
-        url = request.args.get('url')
-        tags = request.args.getlist('tag')
-
-        filters = [db.Bookmark.user == current_user.id]
-        if url is not None:
-            filters.append(db.Bookmark.url == filter_url(url))
-
-        # If Bookmark.tags is null, filtering will yield no results
-        if tags:
-            filters.append(db.Bookmark.tags.contains(tags))
-
-        result = db.Bookmark.query.filter(*filters) \
-                                  .order_by(
-                                      db.Bookmark.read.desc().nullsfirst(),
-                                      db.Bookmark.timestamp.desc()) \
-                                  .paginate()
-        headers = {}
+        version = cache.user_version(current_user.id)
+        etag = make_etag(version)
+        response = not_modified(etag)
+        if response:
+            return response
+
+        # Only first pages are cached, as they are requested over and
+        # over again
+        if 'cursor' in request.args:
+            first_page = request.args['cursor'] == ''
+        else:
+            first_page = request.args.get('page', 1, type=int) == 1
+
+        if first_page:
+            return cached_response('bookmarks', version, etag,
+                                   lambda: self.list(etag))
+        return self.list(etag)
+
+    def list(self, etag):
+        try:
+            filters = bookmark_filters()
+            shape = bookmark_shape()
+        except ValueError as e:
+            return {'error': str(e)}, HTTPStatus.BAD_REQUEST
+
+        query = db.Bookmark.query.filter(*filters)
+        if shape is not None:
+            query = query.options(*shape_options(shape))
+        elif render_json_in_db():
+            query = db.page_keys(query)
+
+        try:
+            per_page = per_page_arg()
+        except ValueError as e:
+            return {'error': str(e)}, HTTPStatus.BAD_REQUEST
+
+        # Cursor mode is enabled by passing cursor parameter (empty
+        # for the first page).
+        if 'cursor' in request.args:
+            return self.get_by_cursor(query, etag, shape, per_page)
+
+        if request.args.get('include_total') == 'false':
+            return self.get_without_total(query, etag, shape, per_page)
+
+        result = query.order_by(*BOOKMARKS_ORDER).paginate(per_page=per_page)
+        headers = {'ETag': etag, 'X-Total-Count': str(result.total)}
         links = []
         if result.has_next:
             last_url = update_query(request.url, {'page': result.pages})
@@ -96,7 +555,55 @@ class Bookmarks(Resource):
 
         if links:
             headers['Link'] = lh.format_links(links)
-        return list(map(lambda x: x.to_dict(), result.items)), 200, headers
+        return render_bookmarks(result.items, headers, shape)
+
+    def get_without_total(self, query, etag, shape, per_page):
+        """Page mode without COUNT. One more row than needed is fetched
+        to tell if there is a next page, so only the next link is
+        given."""
+        page = request.args.get('page', 1, type=int)
+        if page < 1:
+            return {'error': 'page must be positive'}, \
+                HTTPStatus.BAD_REQUEST
+
+        items = query.order_by(*BOOKMARKS_ORDER) \
+                     .offset((page - 1) * per_page) \
+                     .limit(per_page + 1) \
+                     .all()
+
+        headers = {'ETag': etag}
+        if len(items) > per_page:
+            items = items[:per_page]
+            next_url = update_query(request.url, {'page': page + 1})
+            headers['Link'] = lh.format_links([lh.Link(next_url,
+                                                       rel='next')])
+
+        return render_bookmarks(items, headers, shape)
+
+    def get_by_cursor(self, query, etag, shape, per_page):
+        try:
+            items, next_cursor, prev_cursor = keyset_paginate(
+                query, request.args['cursor'], per_page)
+        except ValueError:
+            return {'error': 'invalid cursor'}, HTTPStatus.BAD_REQUEST
+
+        headers = {'ETag': etag}
+        links = []
+        if next_cursor:
+            next_url = update_query(request.url, {'cursor': next_cursor})
+            links.append(lh.Link(next_url, rel='next'))
+        if prev_cursor:
+            prev_url = update_query(request.url, {'cursor': prev_cursor})
+            links.append(lh.Link(prev_url, rel='prev'))
+
+        if links:
+            headers['Link'] = lh.format_links(links)
+
+        # Counting is the expensive part, so do it only on request.
+        if request.args.get('include_total') == 'true':
+            headers['X-Total-Count'] = str(query.order_by(None).count())
+
+        return render_bookmarks(items, headers, shape)
 
     @token_required
     def post(self):
@@ -132,17 +639,6 @@ class Bookmarks(Resource):
 
             tags = entity.get('tags')
 
-            parent_id = entity.get('parent')
-            if parent_id is not None:
-                parent = db.Bookmark.query \
-                                  .filter_by(id=parent_id,
-                                             user=current_user.id) \
-                                  .first()
-
-                if parent is None:
-                    return {'error': 'parent does not exist'}, \
-                        HTTPStatus.BAD_REQUEST
-
             bookmark = db.Bookmark(
                 user=current_user.id,
                 url=url,
@@ -152,14 +648,28 @@ class Bookmarks(Resource):
                 read=read,
                 meta=meta,
                 tags=tags,
-                parent_id=parent_id)
-
-            db.db.session.add(bookmark)
-            db.db.session.commit()
+                parent_id=entity.get('parent'))
 
             bookmarks.append(bookmark)
 
-            q.enqueue(article.fetch_article, bookmark.id, url)
+        parent_ids = set(b.parent_id for b in bookmarks
+                         if b.parent_id is not None)
+        if parent_ids:
+            parents = db.Bookmark.query \
+                                 .filter(db.Bookmark.id.in_(parent_ids),
+                                         db.Bookmark.user == current_user.id) \
+                                 .count()
+            if parents != len(parent_ids):
+                return {'error': 'parent does not exist'}, \
+                    HTTPStatus.BAD_REQUEST
+
+        # All bookmarks are saved in one transaction, so the batch is
+        # either imported completely or not at all.
+        db.insert_bookmarks(bookmarks)
+        db.db.session.commit()
+        cache.bump_version(current_user.id)
+
+        enqueue_fetch_articles(bookmarks, current_user.id)
 
         res = list(map(lambda x: x.to_dict(), bookmarks))
         return res[0] if len(res) == 1 else res, HTTPStatus.CREATED
@@ -168,12 +678,27 @@ class Bookmarks(Resource):
 class Bookmark(Resource):
     @token_required
     def get(self, id):
+        # The response includes descendants, so the version of the
+        # whole library is used
+        version = cache.user_version(current_user.id)
+        etag = make_etag(version)
+        response = not_modified(etag)
+        if response:
+            return response
+
+        try:
+            shape = bookmark_shape()
+        except ValueError as e:
+            return {'error': str(e)}, HTTPStatus.BAD_REQUEST
+
         bookmark = db.Bookmark.query \
+                              .options(*shape_options(shape)) \
                               .filter_by(id=id, user=current_user.id) \
                               .first()
         if bookmark is None:
             return {'error': 'Not found'}, HTTPStatus.NOT_FOUND
-        return bookmark.to_dict()
+        return render_shaped([bookmark], shape)[0], HTTPStatus.OK, \
+            {'ETag': etag}
 
     @token_required
     def post(self, id):
@@ -224,7 +749,9 @@ class Bookmark(Resource):
 
         db.db.session.add(bookmark)
         db.db.session.commit()
+        cache.bump_version(current_user.id)
 
+        db.load_tree([bookmark])
         return bookmark.to_dict(), HTTPStatus.OK
 
     @token_required
@@ -237,20 +764,92 @@ class Bookmark(Resource):
 
         db.db.session.delete(bookmark)
         db.db.session.commit()
+        cache.bump_version(current_user.id)
 
         return (), HTTPStatus.NO_CONTENT
 
 
+# Maximum number of urls accepted by BookmarksLookup
+LOOKUP_MAX_URLS = 1000
+
+
+class BookmarksLookup(Resource):
+    @token_required
+    def post(self):
+        """Find out which of the urls are bookmarked. Returns a dict
+        mapping every requested url to a list of matching bookmark ids.
+        """
+        r = request.get_json()
+        if not r or 'urls' not in r:
+            return {'error': 'urls field is mandatory'}, \
+                HTTPStatus.BAD_REQUEST
+
+        urls = r['urls']
+        if not isinstance(urls, list) or \
+           not all(isinstance(url, str) for url in urls):
+            return {'error': 'urls must be a list of strings'}, \
+                HTTPStatus.BAD_REQUEST
+        if len(urls) > LOOKUP_MAX_URLS:
+            return {'error': 'at most {} urls are allowed'.format(
+                LOOKUP_MAX_URLS)}, HTTPStatus.BAD_REQUEST
+
+        normalized = {url: filter_url(url) for url in urls}
+
+        found = {}
+        if normalized:
+            rows = db.db.session \
+                        .query(db.Bookmark.id, db.Bookmark.url) \
+                        .filter(db.Bookmark.user == current_user.id,
+                                db.has_url(set(normalized.values()))) \
+                        .order_by(db.Bookmark.id)
+            for id, url in rows:
+                found.setdefault(url, []).append(id)
+
+        return {url: found.get(n, []) for url, n in normalized.items()}
+
+
+# Maximum depth of the tree returned by BookmarkTree
+TREE_MAX_DEPTH = 100
+
+
+class BookmarkTree(Resource):
+    @token_required
+    def get(self, id):
+        depth = request.args.get('depth', TREE_MAX_DEPTH, type=int)
+        if depth < 0:
+            return {'error': 'depth must not be negative'}, \
+                HTTPStatus.BAD_REQUEST
+
+        bookmark = db.load_subtree(id, current_user.id,
+                                   min(depth, TREE_MAX_DEPTH))
+        if bookmark is None:
+            return {'error': 'Not found'}, HTTPStatus.NOT_FOUND
+        return bookmark.to_dict()
+
+
 class BookmarkContent(Resource):
     @token_required
     def get(self, id):
-        bookmark = db.Bookmark.query \
-                              .options(sqlalchemy.orm.load_only(
-                                  'content_text', 'content_html')) \
-                              .filter_by(id=id, user=current_user.id) \
-                              .first_or_404()
+        version = db.bookmark_version(id, current_user.id)
+        if version is None:
+            return {'error': 'Not found'}, HTTPStatus.NOT_FOUND
+
+        article.record_open(id)
 
-        return {'html': bookmark.content_html, 'text': bookmark.content_text}
+        etag = make_etag(*version)
+        response = not_modified(etag)
+        if response:
+            return response
+
+        html, text = db.Bookmark.query \
+                                .outerjoin(db.Bookmark.page) \
+                                .with_entities(db.Page.content_html,
+                                               db.Page.content_text) \
+                                .filter(db.Bookmark.id == id,
+                                        db.Bookmark.user == current_user.id) \
+                                .first_or_404()
+
+        return {'html': html, 'text': text}, HTTPStatus.OK, {'ETag': etag}
 
 
 class BookmarkNotes(Resource):
@@ -270,17 +869,358 @@ class BookmarkNotes(Resource):
 
         db.db.session.add(note)
         db.db.session.commit()
+        cache.bump_version(current_user.id)
 
         return note.to_dict(), HTTPStatus.CREATED
 
 
+# Number of bookmarks read from the database and written to the
+# client at once during export
+EXPORT_CHUNK_SIZE = 1000
+
+
+def export_lines(query, with_content):
+    """Yield bookmarks of the query as NDJSON, one chunk of lines at a
+    time. Rows are read through a server-side cursor and notes are
+    loaded per chunk, so memory use doesn't depend on the number of
+    bookmarks."""
+    rows = iter(query.yield_per(EXPORT_CHUNK_SIZE))
+    while True:
+        chunk = list(itertools.islice(rows, EXPORT_CHUNK_SIZE))
+        if not chunk:
+            return
+
+        db.load_notes(chunk)
+
+        lines = []
+        for bookmark in chunk:
+            # Children are exported as separate lines
+            d = bookmark.to_dict(children=False)
+            if with_content:
+                page = bookmark.page
+                d['content'] = {
+                    'html': page.content_html if page else None,
+                    'text': page.content_text if page else None,
+                }
+            lines.append(json.dumps(d) + '\n')
+        yield ''.join(lines).encode()
+
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class Export(Resource):
+    @token_required
+    def get(self):
+        with_content = request.args.get('content') == 'true'
+
+        query = db.Bookmark.query \
+                           .filter(db.Bookmark.user == current_user.id) \
+                           .order_by(db.Bookmark.id)
+        if with_content:
+            query = query.options(
+                sqlalchemy.orm.joinedload('page').undefer('content_html'),
+                sqlalchemy.orm.joinedload('page').undefer('content_text'))
+
+        body = export_lines(query, with_content)
+        headers = {'Content-Disposition':
+                   'attachment; filename="bookmarks.ndjson"'}
+
+        # Flask-Compress would read the whole body into memory, so the
+        # stream is compressed here
+        if 'gzip' in request.headers.get('Accept-Encoding', '').lower():
+            body = gzip_stream(body)
+            headers['Content-Encoding'] = 'gzip'
+            headers['Vary'] = 'Accept-Encoding'
+
+        return app.response_class(stream_with_context(body),
+                                  headers=headers,
+                                  mimetype='application/x-ndjson')
+
+
+# Number of bookmarks enqueued for fetching in one redis round trip after
+# import
+IMPORT_ENQUEUE_BATCH = 1000
+
+
+def import_row(entity, now, line):
+    """Normalize a parsed bookmark the same way POST /api/v1/bookmarks
+    does, as a row for db.copy_bookmarks(). line is the number of the
+    line the parser was at, for errors."""
+    url = entity.get('url')
+    if not url or not isinstance(url, str):
+        raise importer.ParseError('url field is mandatory')
+    try:
+        url = filter_url(url)
+    except ValueError:
+        raise importer.ParseError('invalid url on line {}'.format(line))
+
+    def timestamp(name):
+        value = entity.get(name)
+        if isinstance(value, str):
+            try:
+                value = aniso8601.parse_datetime(value)
+            except ValueError:
+                raise importer.ParseError(
+                    'invalid {}: {}'.format(name, value))
+        elif value is not None and \
+                not isinstance(value, datetime.datetime):
+            raise importer.ParseError('{} must be a string'.format(name))
+        return db.to_utc(value)
+
+    title = entity.get('title')
+    if title is not None and not isinstance(title, str):
+        raise importer.ParseError('title must be a string')
+
+    tags = entity.get('tags') or []
+    if not isinstance(tags, list) or \
+       not all(isinstance(t, str) for t in tags):
+        raise importer.ParseError('tags must be a list of strings')
+
+    meta = entity.get('meta')
+    if meta is not None:
+        try:
+            # NaN and Infinity are not JSON
+            meta = json.dumps(meta, allow_nan=False)
+        except ValueError:
+            raise importer.ParseError('meta must be valid JSON')
+
+    return (
+        timestamp('timestamp') or now,
+        url,
+        title or url,
+        timestamp('read'),
+        meta,
+        tags,
+    )
+
+
+def import_bookmarks(user, format, lines):
+    """Parse lines in the format and import them for the user.
+
+    Parsing, normalization and COPY run as a single stream, so the file
+    is never held in memory. Fetch jobs for the new bookmarks are
+    enqueued in batches after commit.
+
+    Notes and parents of exported bookmarks are not imported, dropped is
+    the number of bookmarks that had any.
+    """
+    now = datetime.datetime.utcnow()
+    progress = {'line': 0, 'dropped': 0}
+
+    def counted(lines):
+        for progress['line'], line in enumerate(lines, 1):
+            yield line
+
+    def rows():
+        for entity in importer.PARSERS[format](counted(lines)):
+            if entity.get('notes') or entity.get('parent') is not None:
+                progress['dropped'] += 1
+            yield import_row(entity, now, progress['line'])
+
+    try:
+        total, new = db.copy_bookmarks(user, rows())
+        db.db.session.commit()
+    except Exception:
+        db.db.session.rollback()
+        raise
+    cache.bump_version(user)
+
+    for i in range(0, len(new), IMPORT_ENQUEUE_BATCH):
+        enqueue_fetch_articles(new[i:i + IMPORT_ENQUEUE_BATCH], user,
+                               bulk=True)
+
+    return {'imported': len(new), 'skipped': total - len(new),
+            'dropped': progress['dropped']}
+
+
+class Import(Resource):
+    @token_required
+    def post(self):
+        format = request.args.get('format') or \
+            importer.MIMETYPES.get(request.mimetype)
+        if format not in importer.PARSERS:
+            return {'error': 'format must be one of: {}'.format(
+                ', '.join(sorted(importer.PARSERS)))}, \
+                HTTPStatus.BAD_REQUEST
+
+        lines = codecs.getreader('utf-8-sig')(request.stream)
+        try:
+            result = import_bookmarks(current_user.id, format, lines)
+        except (importer.ParseError, UnicodeDecodeError) as e:
+            return {'error': str(e)}, HTTPStatus.BAD_REQUEST
+
+        return result, HTTPStatus.CREATED
+
+
+@app.cli.command('import-bookmarks')
+@click.argument('username')
+@click.argument('file', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--format', type=click.Choice(sorted(importer.PARSERS)),
+              help='Format of FILE. Guessed from extension by default.')
+def import_bookmarks_command(username, file, format):
+    """Import bookmarks of USERNAME (or email) from FILE."""
+    user = User.query.filter(sqlalchemy.or_(User.username == username,
+                                            User.email == username)) \
+                     .first()
+    if user is None:
+        raise click.BadParameter('no such user', param_hint='USERNAME')
+
+    if format is None:
+        extension = os.path.splitext(file.name)[1].lower()
+        format = {'.json': 'ndjson', '.ndjson': 'ndjson',
+                  '.htm': 'html', '.html': 'html',
+                  '.csv': 'csv'}.get(extension)
+        if format is None:
+            raise click.BadParameter('can\'t guess format of ' + file.name,
+                                     param_hint='--format')
+
+    try:
+        result = import_bookmarks(user.id, format, file)
+    except importer.ParseError as e:
+        raise click.ClickException(str(e))
+
+    click.echo('Imported {imported} bookmarks, skipped {skipped} '
+               'duplicates'.format(**result))
+    if result['dropped']:
+        click.echo('Notes and parents of {dropped} bookmarks were not '
+                   'imported'.format(**result), err=True)
+
+
+@app.cli.command('refresh-pages')
+@click.option('--limit', default=1000,
+              help='Maximum number of pages to refresh.')
+def refresh_pages_command(limit):
+    """Enqueue refetching of pages older than PAGE_MAX_AGE, most
+    recently opened first. Meant to be run periodically."""
+    article.flush_opens()
+    urls = db.stale_pages(app.config['PAGE_MAX_AGE'], limit)
+    jobs.enqueue_bulk(jobs.REFRESH_OWNER, article.fetch_urls, urls)
+    click.echo('Enqueued {} pages'.format(len(urls)))
+
+
+# Maximum number of bookmarks returned by one sync request
+SYNC_PAGE_SIZE = 1000
+
+
+def encode_sync_token(timestamp, id):
+    """Encode position in the (updated_at, id) order as an opaque
+    token."""
+    micros = (timestamp - EPOCH) // datetime.timedelta(microseconds=1)
+    return base64.urlsafe_b64encode(json.dumps([micros, id]).encode()) \
+                 .decode()
+
+
+def decode_sync_token(token):
+    """Decode token produced by encode_sync_token. Returns (timestamp,
+    id) tuple. Raises ValueError if token is malformed."""
+    try:
+        micros, id = json.loads(
+            base64.urlsafe_b64decode(token.encode()).decode())
+        return EPOCH + datetime.timedelta(microseconds=micros), int(id)
+    except (binascii.Error, TypeError, OverflowError, UnicodeError):
+        raise ValueError('malformed token')
+
+
+class Sync(Resource):
+    @token_required
+    def get(self):
+        """Bookmarks changed and deleted since the token.
+
+        Without a token all bookmarks are returned. Clients should
+        repeat the request with the returned token while "more" is true,
+        and keep the last token for the next sync. A bookmark may be
+        returned more than once.
+        """
+        since = request.args.get('since')
+        if since:
+            try:
+                since_time, since_id = decode_sync_token(since)
+            except ValueError:
+                return {'error': 'malformed since token'}, \
+                    HTTPStatus.BAD_REQUEST
+
+        horizon = db.sync_horizon()
+
+        query = db.Bookmark.query \
+                           .filter(db.Bookmark.user == current_user.id,
+                                   db.Bookmark.updated_at < horizon) \
+                           .order_by(db.Bookmark.updated_at, db.Bookmark.id)
+        if since:
+            query = query.filter(
+                sqlalchemy.tuple_(db.Bookmark.updated_at, db.Bookmark.id) >
+                sqlalchemy.tuple_(since_time, since_id))
+
+        items = query.limit(SYNC_PAGE_SIZE + 1).all()
+        more = len(items) > SYNC_PAGE_SIZE
+        items = items[:SYNC_PAGE_SIZE]
+
+        if more:
+            end = items[-1].updated_at
+            token = encode_sync_token(end, items[-1].id)
+        else:
+            end = horizon
+            token = encode_sync_token(end, 0)
+
+        deleted = []
+        if since:
+            # Deletions are reported for the same span of time as
+            # bookmarks, so that the next page continues where this one
+            # stopped
+            deleted = db.db.session.query(db.BookmarkTombstone.id) \
+                .filter(db.BookmarkTombstone.user == current_user.id,
+                        db.BookmarkTombstone.deleted_at >= since_time,
+                        db.BookmarkTombstone.deleted_at < end) \
+                .order_by(db.BookmarkTombstone.deleted_at,
+                          db.BookmarkTombstone.id)
+            deleted = [id for (id,) in deleted]
+
+        db.load_notes(items)
+        return {
+            'bookmarks': [b.to_dict(children=False) for b in items],
+            'deleted': deleted,
+            'token': token,
+            'more': more,
+        }
+
+
 class Tags(Resource):
     @token_required
     def get(self):
-        bookmarks = db.Bookmark.query \
-                    .filter(db.Bookmark.user == current_user.id,
-                            db.Bookmark.tags != None).all() # noqa
-        return list(set().union(*map(lambda x: x.tags, bookmarks)))
+        prefix = request.args.get('prefix')
+        limit = request.args.get('limit', type=int)
+        if limit is not None and limit < 0:
+            return {'error': 'limit must not be negative'}, \
+                HTTPStatus.BAD_REQUEST
+
+        # Tags are derived from bookmarks
+        version = cache.user_version(current_user.id)
+        etag = make_etag(version)
+        response = not_modified(etag)
+        if response:
+            return response
+
+        def render():
+            query = db.Tag.query \
+                          .filter(db.Tag.user == current_user.id) \
+                          .order_by(db.Tag.count.desc(), db.Tag.name)
+            if prefix:
+                query = query.filter(db.Tag.name.startswith(
+                    prefix, autoescape=True))
+            if limit is not None:
+                query = query.limit(limit)
+
+            if request.args.get('counts') == 'true':
+                return list(map(lambda x: x.to_dict(), query))
+            return list(map(lambda x: x.name, query))
+
+        return cached_response('tags', version, etag, render)
 
 
 class Notes(Resource):
@@ -308,6 +1248,7 @@ class Notes(Resource):
 
         db.db.session.add(note)
         db.db.session.commit()
+        cache.bump_version(current_user.id)
 
         return note.to_dict(), HTTPStatus.OK
 
@@ -321,53 +1262,171 @@ class Notes(Resource):
 
         db.db.session.delete(note)
         db.db.session.commit()
+        cache.bump_version(current_user.id)
 
         return (), HTTPStatus.NO_CONTENT
 
 
-class Stats(Resource):
+def search_bookmarks(user, terms):
+    """Query of bookmarks of the user matching terms, best first.
+
+    Content is indexed once per page. Matches of bookmarks and of pages
+    are looked up separately, so that each uses its GIN index, and only
+    they are ranked by the combined vector.
+    """
+    query = sqlalchemy.func.plainto_tsquery(db.SEARCH_CONFIG, terms)
+    own = db.db.session.query(db.Bookmark.id) \
+                       .filter(db.Bookmark.user == user)
+    matches = sqlalchemy.union(
+        own.filter(db.Bookmark.search.op('@@')(query)).statement,
+        own.join(db.Bookmark.page)
+           .filter(db.Page.search.op('@@')(query)).statement) \
+        .alias('matches')
+    search = db.Bookmark.search.op('||')(sqlalchemy.func.coalesce(
+        db.Page.search, sqlalchemy.cast('', postgresql.TSVECTOR)))
+    rank = sqlalchemy.func.ts_rank_cd(search, query)
+
+    return db.Bookmark.query \
+                      .join(matches, matches.c.id == db.Bookmark.id) \
+                      .outerjoin(db.Bookmark.page) \
+                      .order_by(rank.desc(), db.Bookmark.id.desc())
+
+
+class Search(Resource):
+    @token_required
     def get(self):
-        total_read = db.Bookmark.query \
-                                .filter(db.Bookmark.read != None) \
-                                .count() # noqa
-
-        week_ago = datetime.datetime.now() - datetime.timedelta(days=7)
-        read_in_7days = db.Bookmark.query \
-                                   .filter(db.Bookmark.read > week_ago) \
-                                   .count()
-
-        stats = {
-            'total_read': total_read,
-            'total_read_7days': read_in_7days,
-        }
+        terms = request.args.get('q')
+        if not terms:
+            return {'error': 'q is mandatory'}, HTTPStatus.BAD_REQUEST
 
-        if current_user.is_authenticated:
-            stats['user_read_today'] = \
-                db.Bookmark.query \
-                           .filter(db.Bookmark.user == current_user.id,
-                                   db.Bookmark.read >= datetime.date.today()) \
-                           .count()
+        page = request.args.get('page', 1, type=int)
+        if page < 1:
+            return {'error': 'page must be positive'}, \
+                HTTPStatus.BAD_REQUEST
+        try:
+            per_page = per_page_arg()
+        except ValueError as e:
+            return {'error': str(e)}, HTTPStatus.BAD_REQUEST
+
+        bookmarks = search_bookmarks(current_user.id, terms)
+        if render_json_in_db():
+            bookmarks = db.page_keys(bookmarks)
+
+        # Matches are not counted, one more row than needed tells if
+        # there is a next page
+        items = bookmarks.offset((page - 1) * per_page) \
+                         .limit(per_page + 1) \
+                         .all()
+        headers = {}
+        if len(items) > per_page:
+            items = items[:per_page]
+            next_url = update_query(request.url, {'page': page + 1})
+            headers['Link'] = lh.format_links([lh.Link(next_url,
+                                                       rel='next')])
+        return render_bookmarks(items, headers)
+
+
+# Stats and when they were computed. The key differs from that of plain
+# cached stats, which deployed processes may still be writing.
+STATS_CACHE_KEY = 'heutagogy:global-stats'
+# Held by the request that recomputes global stats
+STATS_LOCK_KEY = 'heutagogy:stats:lock'
+STATS_LOCK_TIMEOUT = 60
+
+
+def global_stats():
+    """Stats over all users. These scan the whole bookmark table, so
+    they are cached in redis and recomputed once older than
+    STATS_MAX_AGE seconds.
+
+    Only the request that takes the lock recomputes them, the others
+    serve the old value meanwhile. Without any value (e.g. after redis
+    is flushed) they wait for it for a while, rather than all scanning
+    the table at once.
+    """
+    max_age = app.config['STATS_MAX_AGE']
+    if not max_age:
+        return compute_global_stats()
+
+    deadline = time.time() + 5
+    while True:
+        cached = redis_db.get(STATS_CACHE_KEY)
+        if cached is not None:
+            cached = json.loads(cached.decode())
+            if time.time() - cached['computed_at'] < max_age:
+                return cached['stats']
+
+        if redis_db.set(STATS_LOCK_KEY, 1, nx=True, ex=STATS_LOCK_TIMEOUT):
+            break
+        if cached is not None:
+            return cached['stats']
+        if time.time() > deadline:
+            return compute_global_stats()
+        time.sleep(0.05)
+
+    try:
+        stats = compute_global_stats()
+        redis_db.set(STATS_CACHE_KEY, json.dumps({
+            'stats': stats,
+            'computed_at': time.time(),
+        }))
+    finally:
+        redis_db.delete(STATS_LOCK_KEY)
+    return stats
+
+
+def compute_global_stats():
+    week_ago = datetime.datetime.now() - datetime.timedelta(days=7)
+    total_read, read_in_7days = db.db.session.query(
+        sqlalchemy.func.count().filter(db.Bookmark.read.isnot(None)),
+        sqlalchemy.func.count().filter(db.Bookmark.read > week_ago)).one()
+
+    return {
+        'total_read': total_read,
+        'total_read_7days': read_in_7days,
+    }
 
-            year_start = datetime.date.today().replace(month=1, day=1)
-            stats['user_read_year'] = \
-                db.Bookmark.query \
-                           .filter(db.Bookmark.user == current_user.id,
-                                   db.Bookmark.read >= year_start) \
-                           .count()
 
-            stats['user_read'] = \
-                db.Bookmark.query \
-                           .filter(db.Bookmark.user == current_user.id,
-                                   db.Bookmark.read != None) \
-                           .count() # noqa
+class Stats(Resource):
+    def get(self):
+        stats = global_stats()
+
+        if current_user.is_authenticated:
+            today = datetime.date.today()
+            stats.update(cache.cached('stats', current_user.id,
+                                      today.isoformat(),
+                                      lambda: self.user_stats(today)))
 
         return stats
 
+    def user_stats(self, today):
+        year_start = today.replace(month=1, day=1)
+        read_today, read_year, read = db.db.session.query(
+            sqlalchemy.func.count().filter(db.Bookmark.read >= today),
+            sqlalchemy.func.count().filter(
+                db.Bookmark.read >= year_start),
+            sqlalchemy.func.count().filter(
+                db.Bookmark.read.isnot(None))) \
+            .filter(db.Bookmark.user == current_user.id) \
+            .one()
+
+        return {
+            'user_read_today': read_today,
+            'user_read_year': read_year,
+            'user_read': read,
+        }
+
 
 api.add_resource(Bookmarks,       '/api/v1/bookmarks')
+api.add_resource(BookmarksLookup, '/api/v1/bookmarks/lookup')
 api.add_resource(Bookmark,        '/api/v1/bookmarks/<int:id>')
+api.add_resource(BookmarkTree,    '/api/v1/bookmarks/<int:id>/tree')
 api.add_resource(BookmarkContent, '/api/v1/bookmarks/<int:id>/content')
 api.add_resource(BookmarkNotes,   '/api/v1/bookmarks/<int:id>/notes')
+api.add_resource(Export,          '/api/v1/export')
+api.add_resource(Import,          '/api/v1/import')
+api.add_resource(Sync,            '/api/v1/sync')
 api.add_resource(Tags,            '/api/v1/tags')
 api.add_resource(Notes,           '/api/v1/notes/<int:id>')
 api.add_resource(Stats,           '/api/v1/stats')
+api.add_resource(Search,          '/api/v1/search')
@@ -0,0 +1,128 @@
+"""Add functions rendering bookmarks as JSON
+
+Revision ID: 0b8e5d6c1f27
+Revises: c1f3a9d27b44
+Create Date: 2026-10-18 14:22:07.402113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0b8e5d6c1f27'
+down_revision = 'c1f3a9d27b44'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(r"""
+CREATE OR REPLACE FUNCTION json_ascii(s text) RETURNS text AS $$
+    SELECT CASE
+        WHEN octet_length(s) = char_length(s) AND strpos(s, chr(127)) = 0
+            THEN s
+        ELSE (
+            -- Runs of ASCII are kept, other characters are escaped
+            SELECT string_agg(CASE
+                WHEN ascii(m[1]) < 127 THEN m[1]
+                WHEN ascii(m[1]) < 65536
+                    THEN '\u' || lpad(to_hex(ascii(m[1])), 4, '0')
+                ELSE '\u' || to_hex(55296 + ((ascii(m[1]) - 65536) >> 10)) ||
+                     '\u' || to_hex(56320 + ((ascii(m[1]) - 65536) & 1023))
+            END, '' ORDER BY n)
+            FROM regexp_matches(s, '[\x01-\x7e]+|.', 'g')
+                 WITH ORDINALITY AS t(m, n))
+    END
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION json_isoformat(t timestamp) RETURNS text AS $$
+    SELECT CASE
+        WHEN t IS NULL THEN 'null'
+        WHEN date_trunc('second', t) = t
+            THEN '"' || to_char(t, 'YYYY-MM-DD"T"HH24:MI:SS') || '"'
+        ELSE '"' || to_char(t, 'YYYY-MM-DD"T"HH24:MI:SS.US') || '"'
+    END
+$$ LANGUAGE sql IMMUTABLE;
+
+-- repr() of the float, given the shortest representation that
+-- PostgreSQL 12+ prints
+CREATE OR REPLACE FUNCTION json_float(x float8) RETURNS text AS $$
+DECLARE
+    s text := abs(x)::text;
+    mantissa text := split_part(s, 'e', 1);
+    digits text := replace(mantissa, '.', '');
+    -- Decimal exponent of the first significant digit
+    e integer := coalesce(nullif(split_part(s, 'e', 2), '')::integer, 0) +
+                 length(split_part(mantissa, '.', 1)) - 1 -
+                 (length(digits) - length(ltrim(digits, '0')));
+    sign text := CASE WHEN x < 0 THEN '-' ELSE '' END;
+    k integer;
+    n numeric;
+    unit numeric;
+    c numeric;
+    best numeric;
+BEGIN
+    -- Some of these integers are printed with more digits than needed,
+    -- so the shortest one that reads back as x is searched for. n is x
+    -- exactly: abs(x) / 2 ^ k is an integer that fits bigint.
+    IF abs(x) >= 2 ^ 53 THEN
+        k := greatest(floor(log(2, abs(x)::numeric))::integer - 54, 0);
+        n := trunc((abs(x) / 2 ^ k)::bigint * 2::numeric ^ k);
+        FOR p IN 1..17 LOOP
+            unit := 10::numeric ^ (length(n::text) - p);
+            FOREACH c IN ARRAY ARRAY[div(n, unit) * unit,
+                                     (div(n, unit) + 1) * unit] LOOP
+                -- Rounding up may go past the largest float
+                CONTINUE WHEN c >= 2::numeric ^ 1024;
+                IF c::float8 = abs(x) AND
+                   (best IS NULL OR abs(c - n) < abs(best - n)) THEN
+                    best := c;
+                END IF;
+            END LOOP;
+            EXIT WHEN best IS NOT NULL;
+        END LOOP;
+        digits := trunc(best)::text;
+        e := length(digits) - 1;
+    END IF;
+
+    digits := rtrim(ltrim(digits, '0'), '0');
+    IF digits = '' THEN
+        RETURN sign || '0.0';
+    ELSIF e >= 16 OR e < -4 THEN
+        RETURN sign || left(digits, 1) ||
+            CASE WHEN length(digits) > 1 THEN '.' || substr(digits, 2)
+                 ELSE '' END ||
+            CASE WHEN e < 0 THEN 'e-' ELSE 'e+' END ||
+            CASE WHEN abs(e) < 10 THEN '0' ELSE '' END || abs(e);
+    ELSIF e < 0 THEN
+        RETURN sign || '0.' || repeat('0', -e - 1) || digits;
+    END IF;
+    RETURN sign || rpad(left(digits, e + 1), e + 1, '0') || '.' ||
+        coalesce(nullif(substr(digits, e + 2), ''), '0');
+END
+$$ LANGUAGE plpgsql IMMUTABLE SET extra_float_digits = 1;
+
+-- jsonb as json.dumps() renders it after psycopg2 loads it: fractional
+-- numbers become floats, integers stay as they are
+CREATE OR REPLACE FUNCTION json_meta(meta jsonb) RETURNS text AS $$
+    SELECT CASE
+        WHEN strpos(meta::text, '.') = 0 THEN json_ascii(meta::text)
+        ELSE (
+            SELECT string_agg(CASE
+                WHEN m[1] ~ '^-?[0-9].*[.]' THEN json_float(m[1]::float8)
+                ELSE json_ascii(m[1])
+            END, '' ORDER BY n)
+            FROM regexp_matches(meta::text,
+                                '"(?:[^"\\]|\\.)*"|-?[0-9][-+.eE0-9]*|[^"0-9-]+',
+                                'g') WITH ORDINALITY AS t(m, n))
+    END
+$$ LANGUAGE sql IMMUTABLE;
+""")
+
+
+def downgrade():
+    op.execute('DROP FUNCTION json_meta(jsonb)')
+    op.execute('DROP FUNCTION json_float(float8)')
+    op.execute('DROP FUNCTION json_isoformat(timestamp)')
+    op.execute('DROP FUNCTION json_ascii(text)')
@@ -0,0 +1,29 @@
+"""Index bookmark urls by hash
+
+Revision ID: 2d7a0c93f5b1
+Revises: 8f4c2a71e6d9
+Create Date: 2026-10-18 17:48:26.734910
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2d7a0c93f5b1'
+down_revision = '8f4c2a71e6d9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # B-tree entries are limited in size, so long urls could not be
+    # inserted with plain (user, url) index
+    op.drop_index('ix_bookmark_user_url', table_name='bookmark')
+    op.create_index('ix_bookmark_user_url_md5', 'bookmark',
+                    ['user', sa.text('md5(url)')])
+
+
+def downgrade():
+    op.drop_index('ix_bookmark_user_url_md5', table_name='bookmark')
+    op.create_index('ix_bookmark_user_url', 'bookmark', ['user', 'url'])
@@ -0,0 +1,56 @@
+"""Count tags of inserted bookmarks once per statement
+
+Revision ID: 5f0e8b2c4a19
+Revises: 2d7a0c93f5b1
+Create Date: 2026-10-18 19:02:47.115830
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5f0e8b2c4a19'
+down_revision = '2d7a0c93f5b1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("""
+DROP TRIGGER bookmark_tags_changed ON bookmark;
+
+CREATE TRIGGER bookmark_tags_changed
+AFTER DELETE OR UPDATE OF "user", tags ON bookmark
+FOR EACH ROW EXECUTE PROCEDURE bookmark_tags_changed();
+
+CREATE OR REPLACE FUNCTION bookmark_tags_inserted() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO tag ("user", name, count)
+    SELECT b."user", t.name, count(DISTINCT b.id)
+      FROM inserted AS b, unnest(b.tags) AS t(name)
+     WHERE t.name IS NOT NULL
+     GROUP BY b."user", t.name
+    ON CONFLICT ("user", name) DO UPDATE
+       SET count = tag.count + EXCLUDED.count;
+
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER bookmark_tags_inserted
+AFTER INSERT ON bookmark
+REFERENCING NEW TABLE AS inserted
+FOR EACH STATEMENT EXECUTE PROCEDURE bookmark_tags_inserted();
+""")
+
+
+def downgrade():
+    op.execute("""
+DROP TRIGGER bookmark_tags_inserted ON bookmark;
+DROP FUNCTION bookmark_tags_inserted();
+DROP TRIGGER bookmark_tags_changed ON bookmark;
+
+CREATE TRIGGER bookmark_tags_changed
+AFTER INSERT OR DELETE OR UPDATE OF "user", tags ON bookmark
+FOR EACH ROW EXECUTE PROCEDURE bookmark_tags_changed();
+""")
@@ -0,0 +1,72 @@
+"""Add tag table maintained by trigger
+
+Revision ID: 6e2d94b0a8c3
+Revises: 0b8e5d6c1f27
+Create Date: 2026-10-18 15:40:12.550392
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e2d94b0a8c3'
+down_revision = '0b8e5d6c1f27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('tag',
+    sa.Column('user', sa.Integer(), nullable=False),
+    sa.Column('name', sa.Text(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user', 'name')
+    )
+    op.create_index('ix_tag_user_name_pattern', 'tag',
+                    ['user', sa.text('name text_pattern_ops')])
+
+    op.execute("""
+CREATE OR REPLACE FUNCTION bookmark_tags_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE tag SET count = count - 1
+         WHERE tag."user" = OLD."user" AND tag.name = ANY(OLD.tags);
+        DELETE FROM tag
+         WHERE tag."user" = OLD."user" AND tag.name = ANY(OLD.tags)
+           AND tag.count <= 0;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO tag ("user", name, count)
+        SELECT DISTINCT NEW."user", t.name, 1
+          FROM unnest(NEW.tags) AS t(name)
+         WHERE t.name IS NOT NULL
+        ON CONFLICT ("user", name) DO UPDATE SET count = tag.count + 1;
+    END IF;
+
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER bookmark_tags_changed
+AFTER INSERT OR DELETE OR UPDATE OF "user", tags ON bookmark
+FOR EACH ROW EXECUTE PROCEDURE bookmark_tags_changed();
+""")
+
+    op.execute("""
+INSERT INTO tag ("user", name, count)
+SELECT "user", name, count(*)
+  FROM (SELECT DISTINCT id, "user", unnest(tags) AS name
+          FROM bookmark) AS t
+ WHERE name IS NOT NULL
+ GROUP BY "user", name
+""")
+
+
+def downgrade():
+    op.execute('DROP TRIGGER bookmark_tags_changed ON bookmark')
+    op.execute('DROP FUNCTION bookmark_tags_changed()')
+    op.drop_index('ix_tag_user_name_pattern', table_name='tag')
+    op.drop_table('tag')
@@ -0,0 +1,91 @@
+"""Add full-text search vector for bookmarks
+
+Revision ID: 8f4c2a71e6d9
+Revises: 6e2d94b0a8c3
+Create Date: 2026-10-18 16:55:48.017264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '8f4c2a71e6d9'
+down_revision = '6e2d94b0a8c3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('bookmark', sa.Column('search', postgresql.TSVECTOR(), nullable=True))
+
+    op.execute("""
+CREATE OR REPLACE FUNCTION bookmark_search_vector(
+    target_id integer, title text, tags text[], content_text text)
+RETURNS tsvector AS $$
+    SELECT setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+           setweight(to_tsvector('english',
+                                 coalesce(array_to_string(tags, ' '), '')),
+                     'A') ||
+           setweight(to_tsvector('english', coalesce(
+               (SELECT string_agg(note.text, ' ' ORDER BY note.id)
+                  FROM note
+                 WHERE note.bookmark_id = target_id), '')), 'B') ||
+           -- tsvector size is limited to 1MB
+           setweight(to_tsvector('english',
+                                 left(coalesce(content_text, ''), 500000)),
+                     'C')
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION bookmark_search_changed() RETURNS trigger AS $$
+BEGIN
+    NEW.search := bookmark_search_vector(NEW.id, NEW.title, NEW.tags,
+                                         NEW.content_text);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER bookmark_search_changed
+BEFORE INSERT OR UPDATE OF title, tags, content_text ON bookmark
+FOR EACH ROW EXECUTE PROCEDURE bookmark_search_changed();
+
+CREATE OR REPLACE FUNCTION note_search_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE bookmark
+           SET search = bookmark_search_vector(id, title, tags, content_text)
+         WHERE id = OLD.bookmark_id;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE bookmark
+           SET search = bookmark_search_vector(id, title, tags, content_text)
+         WHERE id = NEW.bookmark_id;
+    END IF;
+
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER note_search_changed
+AFTER INSERT OR DELETE OR UPDATE OF bookmark_id, text ON note
+FOR EACH ROW EXECUTE PROCEDURE note_search_changed();
+""")
+
+    op.execute("""
+UPDATE bookmark
+   SET search = bookmark_search_vector(id, title, tags, content_text)
+""")
+
+    op.create_index('ix_bookmark_search', 'bookmark', ['search'],
+                    postgresql_using='gin')
+
+
+def downgrade():
+    op.drop_index('ix_bookmark_search', table_name='bookmark')
+    op.execute('DROP TRIGGER note_search_changed ON note')
+    op.execute('DROP FUNCTION note_search_changed()')
+    op.execute('DROP TRIGGER bookmark_search_changed ON bookmark')
+    op.execute('DROP FUNCTION bookmark_search_changed()')
+    op.execute('DROP FUNCTION bookmark_search_vector(integer, text, text[], text)')
+    op.drop_column('bookmark', 'search')
@@ -0,0 +1,81 @@
+"""Track updated_at and deleted bookmarks for sync
+
+Revision ID: a4d1c7e93b62
+Revises: 5f0e8b2c4a19
+Create Date: 2026-10-18 20:11:05.902214
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d1c7e93b62'
+down_revision = '5f0e8b2c4a19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    utc_now = sa.text("(clock_timestamp() AT TIME ZONE 'UTC')")
+    op.add_column('bookmark', sa.Column('updated_at', sa.DateTime(),
+                                        server_default=utc_now,
+                                        nullable=False))
+    op.add_column('note', sa.Column('updated_at', sa.DateTime(),
+                                    server_default=utc_now,
+                                    nullable=False))
+    op.create_table('bookmark_tombstone',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('user', sa.Integer(), nullable=False),
+    sa.Column('deleted_at', sa.DateTime(), server_default=utc_now,
+              nullable=False),
+    sa.ForeignKeyConstraint(['user'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_bookmark_user_updated_at', 'bookmark',
+                    ['user', 'updated_at', 'id'])
+    op.create_index('ix_bookmark_tombstone_user_deleted_at',
+                    'bookmark_tombstone', ['user', 'deleted_at'])
+
+    op.execute("""
+CREATE OR REPLACE FUNCTION touch_updated_at() RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at := clock_timestamp() AT TIME ZONE 'UTC';
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER bookmark_touch_updated_at
+BEFORE UPDATE ON bookmark
+FOR EACH ROW EXECUTE PROCEDURE touch_updated_at();
+
+CREATE TRIGGER note_touch_updated_at
+BEFORE UPDATE ON note
+FOR EACH ROW EXECUTE PROCEDURE touch_updated_at();
+
+CREATE OR REPLACE FUNCTION bookmark_deleted() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO bookmark_tombstone (id, "user")
+    VALUES (OLD.id, OLD."user");
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER bookmark_deleted
+AFTER DELETE ON bookmark
+FOR EACH ROW EXECUTE PROCEDURE bookmark_deleted();
+""")
+
+
+def downgrade():
+    op.execute('DROP TRIGGER bookmark_deleted ON bookmark')
+    op.execute('DROP FUNCTION bookmark_deleted()')
+    op.execute('DROP TRIGGER note_touch_updated_at ON note')
+    op.execute('DROP TRIGGER bookmark_touch_updated_at ON bookmark')
+    op.execute('DROP FUNCTION touch_updated_at()')
+    op.drop_index('ix_bookmark_tombstone_user_deleted_at',
+                  table_name='bookmark_tombstone')
+    op.drop_index('ix_bookmark_user_updated_at', table_name='bookmark')
+    op.drop_table('bookmark_tombstone')
+    op.drop_column('note', 'updated_at')
+    op.drop_column('bookmark', 'updated_at')
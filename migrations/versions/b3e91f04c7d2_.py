@@ -0,0 +1,217 @@
+"""Share fetched content of a url between bookmarks
+
+Revision ID: b3e91f04c7d2
+Revises: e7b35a0d9c48
+Create Date: 2026-10-19 14:02:37.514820
+
+"""
+from alembic import op
+from sqlalchemy.dialects import postgresql
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3e91f04c7d2'
+down_revision = 'e7b35a0d9c48'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    utc_now = sa.text("(clock_timestamp() AT TIME ZONE 'UTC')")
+    op.create_table('page',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('url', sa.String(), nullable=False),
+    sa.Column('title', sa.String(), nullable=True),
+    sa.Column('content_html', sa.Text(), nullable=True),
+    sa.Column('content_text', sa.Text(), nullable=True),
+    sa.Column('search', postgresql.TSVECTOR(), nullable=True),
+    sa.Column('fetched_at', sa.DateTime(), server_default=utc_now,
+              nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_page_url_md5', 'page', [sa.text('md5(url)')],
+                    unique=True)
+    op.create_index('ix_page_search', 'page', ['search'],
+                    postgresql_using='gin')
+    op.add_column('bookmark', sa.Column('page_id', sa.Integer(),
+                                        nullable=True))
+    op.create_foreign_key('bookmark_page_id_fkey', 'bookmark', 'page',
+                          ['page_id'], ['id'], ondelete='SET NULL')
+    op.create_index('ix_bookmark_page_id', 'bookmark', ['page_id'])
+    op.create_index('ix_bookmark_url_md5', 'bookmark', [sa.text('md5(url)')])
+
+    op.execute("""
+DROP TRIGGER bookmark_search_changed ON bookmark;
+DROP FUNCTION bookmark_search_vector(integer, text, text[], text);
+
+CREATE FUNCTION bookmark_search_vector(
+    target_id integer, title text, tags text[])
+RETURNS tsvector AS $$
+    SELECT setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+           setweight(to_tsvector('english',
+                                 coalesce(array_to_string(tags, ' '), '')),
+                     'A') ||
+           setweight(to_tsvector('english', coalesce(
+               (SELECT string_agg(note.text, ' ' ORDER BY note.id)
+                  FROM note
+                 WHERE note.bookmark_id = target_id), '')), 'B')
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION bookmark_search_changed() RETURNS trigger AS $$
+BEGIN
+    NEW.search := bookmark_search_vector(NEW.id, NEW.title, NEW.tags);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER bookmark_search_changed
+BEFORE INSERT OR UPDATE OF title, tags ON bookmark
+FOR EACH ROW EXECUTE PROCEDURE bookmark_search_changed();
+
+CREATE OR REPLACE FUNCTION note_search_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE bookmark
+           SET search = bookmark_search_vector(id, title, tags)
+         WHERE id = OLD.bookmark_id;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE bookmark
+           SET search = bookmark_search_vector(id, title, tags)
+         WHERE id = NEW.bookmark_id;
+    END IF;
+
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION page_search_changed() RETURNS trigger AS $$
+BEGIN
+    -- tsvector size is limited to 1MB
+    NEW.search := setweight(
+        to_tsvector('english', left(coalesce(NEW.content_text, ''), 500000)),
+        'C');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER page_search_inserted
+BEFORE INSERT ON page
+FOR EACH ROW EXECUTE PROCEDURE page_search_changed();
+
+CREATE TRIGGER page_search_changed
+BEFORE UPDATE OF content_text ON page
+FOR EACH ROW
+WHEN (OLD.content_text IS DISTINCT FROM NEW.content_text)
+EXECUTE PROCEDURE page_search_changed();
+""")
+
+    # The latest content of every url becomes its page, and leaves search
+    # vectors of its bookmarks. Bookmarks don't change for clients, so
+    # updated_at is left alone and sync doesn't send all of them again.
+    op.execute("""
+INSERT INTO page (url, content_html, content_text, fetched_at)
+SELECT DISTINCT ON (url) url, content_html, content_text, updated_at
+  FROM bookmark
+ WHERE content_html IS NOT NULL OR content_text IS NOT NULL
+ ORDER BY url, updated_at DESC;
+
+ALTER TABLE bookmark DISABLE TRIGGER bookmark_touch_updated_at;
+
+UPDATE bookmark
+   SET page_id = page.id,
+       search = bookmark_search_vector(bookmark.id, bookmark.title,
+                                       bookmark.tags)
+  FROM page
+ WHERE md5(bookmark.url) = md5(page.url) AND bookmark.url = page.url;
+
+ALTER TABLE bookmark ENABLE TRIGGER bookmark_touch_updated_at;
+""")
+
+    op.drop_column('bookmark', 'content_text')
+    op.drop_column('bookmark', 'content_html')
+
+
+def downgrade():
+    op.add_column('bookmark', sa.Column('content_html', sa.Text(),
+                                        nullable=True))
+    op.add_column('bookmark', sa.Column('content_text', sa.Text(),
+                                        nullable=True))
+    op.execute("""
+DROP TRIGGER page_search_changed ON page;
+DROP TRIGGER page_search_inserted ON page;
+DROP FUNCTION page_search_changed();
+DROP TRIGGER bookmark_search_changed ON bookmark;
+DROP FUNCTION bookmark_search_vector(integer, text, text[]);
+
+CREATE FUNCTION bookmark_search_vector(
+    target_id integer, title text, tags text[], content_text text)
+RETURNS tsvector AS $$
+    SELECT setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+           setweight(to_tsvector('english',
+                                 coalesce(array_to_string(tags, ' '), '')),
+                     'A') ||
+           setweight(to_tsvector('english', coalesce(
+               (SELECT string_agg(note.text, ' ' ORDER BY note.id)
+                  FROM note
+                 WHERE note.bookmark_id = target_id), '')), 'B') ||
+           -- tsvector size is limited to 1MB
+           setweight(to_tsvector('english',
+                                 left(coalesce(content_text, ''), 500000)),
+                     'C')
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION bookmark_search_changed() RETURNS trigger AS $$
+BEGIN
+    NEW.search := bookmark_search_vector(NEW.id, NEW.title, NEW.tags,
+                                         NEW.content_text);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER bookmark_search_changed
+BEFORE INSERT OR UPDATE OF title, tags, content_text ON bookmark
+FOR EACH ROW EXECUTE PROCEDURE bookmark_search_changed();
+
+CREATE OR REPLACE FUNCTION note_search_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE bookmark
+           SET search = bookmark_search_vector(id, title, tags, content_text)
+         WHERE id = OLD.bookmark_id;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE bookmark
+           SET search = bookmark_search_vector(id, title, tags, content_text)
+         WHERE id = NEW.bookmark_id;
+    END IF;
+
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+""")
+
+    # Content is copied back after the triggers, so that it gets back
+    # into search vectors. updated_at is left alone.
+    op.execute("""
+ALTER TABLE bookmark DISABLE TRIGGER bookmark_touch_updated_at;
+
+UPDATE bookmark
+   SET content_html = page.content_html, content_text = page.content_text
+  FROM page
+ WHERE page.id = bookmark.page_id;
+
+ALTER TABLE bookmark ENABLE TRIGGER bookmark_touch_updated_at;
+""")
+
+    op.drop_index('ix_bookmark_url_md5', table_name='bookmark')
+    op.drop_index('ix_bookmark_page_id', table_name='bookmark')
+    op.drop_constraint('bookmark_page_id_fkey', 'bookmark',
+                       type_='foreignkey')
+    op.drop_column('bookmark', 'page_id')
+    op.drop_index('ix_page_search', table_name='page')
+    op.drop_index('ix_page_url_md5', table_name='page')
+    op.drop_table('page')
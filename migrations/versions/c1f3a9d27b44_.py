@@ -0,0 +1,38 @@
+"""Add indexes for bookmark queries
+
+Revision ID: c1f3a9d27b44
+Revises: 47c2334ea5b2
+Create Date: 2026-10-18 12:04:31.118251
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c1f3a9d27b44'
+down_revision = '47c2334ea5b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Matches the listing order: read DESC NULLS FIRST, timestamp DESC, id DESC
+    op.create_index('ix_bookmark_user_read_timestamp', 'bookmark',
+                    ['user',
+                     sa.text('read DESC NULLS FIRST'),
+                     sa.text('timestamp DESC'),
+                     sa.text('id DESC')])
+    op.create_index('ix_bookmark_user_url', 'bookmark', ['user', 'url'])
+    op.create_index('ix_bookmark_tags', 'bookmark', ['tags'],
+                    postgresql_using='gin')
+    op.create_index('ix_bookmark_parent_id', 'bookmark', ['parent_id'])
+    op.create_index('ix_note_bookmark_id', 'note', ['bookmark_id'])
+
+
+def downgrade():
+    op.drop_index('ix_note_bookmark_id', table_name='note')
+    op.drop_index('ix_bookmark_parent_id', table_name='bookmark')
+    op.drop_index('ix_bookmark_tags', table_name='bookmark')
+    op.drop_index('ix_bookmark_user_url', table_name='bookmark')
+    op.drop_index('ix_bookmark_user_read_timestamp', table_name='bookmark')
@@ -0,0 +1,34 @@
+"""Validators and last open of pages, for conditional refresh
+
+Revision ID: c6f2d8a1e5b3
+Revises: b3e91f04c7d2
+Create Date: 2026-10-20 10:41:12.208113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c6f2d8a1e5b3'
+down_revision = 'b3e91f04c7d2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('page', sa.Column('etag', sa.String(), nullable=True))
+    op.add_column('page', sa.Column('last_modified', sa.String(),
+                                    nullable=True))
+    op.add_column('page', sa.Column('opened_at', sa.DateTime(),
+                                    nullable=True))
+    op.create_index('ix_page_opened_at_fetched_at', 'page',
+                    [sa.text('opened_at DESC NULLS LAST'), 'fetched_at'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_page_opened_at_fetched_at', table_name='page')
+    op.drop_column('page', 'opened_at')
+    op.drop_column('page', 'last_modified')
+    op.drop_column('page', 'etag')
@@ -0,0 +1,35 @@
+"""Store bookmark meta as jsonb and index filters
+
+Revision ID: e7b35a0d9c48
+Revises: a4d1c7e93b62
+Create Date: 2026-10-18 21:34:51.288406
+
+"""
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7b35a0d9c48'
+down_revision = 'a4d1c7e93b62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.alter_column('bookmark', 'meta',
+                    type_=postgresql.JSONB(),
+                    postgresql_using='meta::jsonb')
+    op.create_index('ix_bookmark_meta', 'bookmark', ['meta'],
+                    postgresql_using='gin',
+                    postgresql_ops={'meta': 'jsonb_path_ops'})
+    op.create_index('ix_bookmark_user_timestamp', 'bookmark',
+                    ['user', 'timestamp'])
+
+
+def downgrade():
+    op.drop_index('ix_bookmark_user_timestamp', table_name='bookmark')
+    op.drop_index('ix_bookmark_meta', table_name='bookmark')
+    op.alter_column('bookmark', 'meta',
+                    type_=postgresql.JSON(),
+                    postgresql_using='meta::json')
@@ -16,6 +16,7 @@ setup(
         'Flask-User',
         'bcrypt',
         'newspaper3k',
+        'requests',
         'rq',
     ],
 )
@@ -1,13 +1,36 @@
 #!/usr/bin/env python3
 import heutagogy
+import heutagogy.persistence as persistence
 from heutagogy.persistence import db
-from heutagogy.auth import User
+import heutagogy.auth as auth
+from heutagogy.auth import User, identity_cache, jwt
+from heutagogy.heutagogy import high_q, low_q, redis_db
+from heutagogy.views import STATS_CACHE_KEY, STATS_LOCK_KEY, \
+    render_json_in_db
+from heutagogy.fetcher import Fetcher, FetchError
+import heutagogy.article
+import heutagogy.jobs as jobs
 from http import HTTPStatus
 import unittest
+import flask_user
+import http.server
+import requests
+import socketserver
+import threading
+import google.auth.exceptions
+import time
+import gzip
+import tempfile
 import json
 import urllib.parse
 from urllib.parse import urlencode
 import link_header as lh
+import sqlalchemy
+from collections import OrderedDict
+from contextlib import contextmanager
+from unittest.mock import patch
+from click.testing import CliRunner
+from flask.cli import ScriptInfo
 from datetime import datetime, timedelta
 
 
@@ -55,6 +78,23 @@ making test results deterministic."""
     return list(map(parse_header_link, link_header))
 
 
+@contextmanager
+def count_queries():
+    """Counts SQL statements issued inside the block. Yields a list,
+    which will hold the number of statements on exit."""
+    result = [0]
+
+    def callback(*args):
+        result[0] += 1
+
+    sqlalchemy.event.listen(db.engine, 'before_cursor_execute', callback)
+    try:
+        yield result
+    finally:
+        sqlalchemy.event.remove(db.engine, 'before_cursor_execute',
+                                callback)
+
+
 class HeutagogyTestCase(unittest.TestCase):
 
     def authorization(self, username, password):
@@ -75,6 +115,9 @@ class HeutagogyTestCase(unittest.TestCase):
 
     def setUp(self):
         heutagogy.app.config['TESTING'] = True
+        heutagogy.app.config['STATS_MAX_AGE'] = 0
+        heutagogy.app.config['RESPONSE_CACHE_TTL'] = 0
+        heutagogy.app.config['IDENTITY_CACHE_TTL'] = 0
 
         db.create_all()
 
@@ -93,8 +136,15 @@ class HeutagogyTestCase(unittest.TestCase):
         return self._user2
 
     def tearDown(self):
+        db.session.remove()
         db.drop_all()
 
+    def set_content(self, bookmark_id, text):
+        """Stores content the way article fetching worker does."""
+        bookmark = persistence.Bookmark.query.get(bookmark_id)
+        heutagogy.article.store_articles(
+            [(bookmark.url, {'title': '', 'html': None, 'text': text})])
+
     def add_bookmark(self,
                      bookmark={'url': 'http://github.com',
                                'title': 'test title'},
@@ -112,6 +162,14 @@ class HeutagogyTestCase(unittest.TestCase):
             'api/v1/bookmarks/{}'.format(bookmark_id),
             headers=[user])
 
+    def add_note(self, bookmark_id, text='test note', user=None):
+        user = user or self.user1
+        return self.app.post(
+            'api/v1/bookmarks/{}/notes'.format(bookmark_id),
+            content_type='application/json',
+            data=json.dumps({'text': text}),
+            headers=[user])
+
     def delete_bookmark(self, bookmark_id, user=None):
         user = user or self.user1
         return self.app.delete(
@@ -468,6 +526,59 @@ class ApiTestCase(HeutagogyTestCase):
         self.assertEqual(2, result[1]['id'])
         self.assertEqual("http://example.com/", result[1]['url'])
 
+    @single_user
+    def test_post_bookmarks_is_atomic(self):
+        parent_id = get_json(self.add_bookmark())['id']
+
+        res = self.app.post(
+            '/api/v1/bookmarks',
+            content_type='application/json',
+            data=json.dumps([
+                {'url': 'https://github.com/', 'parent': parent_id},
+                {'url': 'http://example.com/', 'parent': 42},
+            ]),
+            headers=[self.user1])
+        self.assertEqual(HTTPStatus.BAD_REQUEST, res.status_code)
+
+        res = self.app.post(
+            '/api/v1/bookmarks',
+            content_type='application/json',
+            data=json.dumps([
+                {'url': 'https://github.com/'},
+                {'title': 'No url'},
+            ]),
+            headers=[self.user1])
+        self.assertEqual(HTTPStatus.BAD_REQUEST, res.status_code)
+
+        res = self.app.get('/api/v1/bookmarks', headers=[self.user1])
+        self.assertEqual([parent_id], [x['id'] for x in get_json(res)])
+
+    @single_user
+    def test_post_many_bookmarks(self):
+        parent_id = get_json(self.add_bookmark())['id']
+        high, low = high_q.count, low_q.count
+
+        with count_queries() as count:
+            res = self.app.post(
+                '/api/v1/bookmarks',
+                content_type='application/json',
+                data=json.dumps([
+                    {'url': 'https://github.com/{}'.format(i),
+                     'parent': parent_id if i % 2 else None}
+                    for i in range(50)
+                ]),
+                headers=[self.user1])
+
+        self.assertEqual(HTTPStatus.CREATED, res.status_code)
+        result = get_json(res)
+        self.assertEqual(50, len(result))
+        self.assertEqual('https://github.com/49', result[-1]['url'])
+        self.assertEqual(result[-1]['id'],
+                         get_json(self.get_bookmark(result[-1]['id']))['id'])
+        # Fetched concurrently in a single bulk job
+        self.assertEqual((high, low + 1), (high_q.count, low_q.count))
+        self.assertLessEqual(count[0], 6)
+
     def test_cors_headers(self):
         res = self.app.options(
             '/api/v1/bookmarks',
@@ -571,6 +682,167 @@ class ApiTestCase(HeutagogyTestCase):
         self.assertEqual(HTTPStatus.OK, res.status_code)
         self.assertEqual(15, len(get_json(res)))
 
+    @single_user
+    def test_paginate_max_per_page(self):
+        for i in range(4):
+            self.add_bookmark({'url': 'http://example.com/{}'.format(i)})
+
+        with patch('heutagogy.views.MAX_PER_PAGE', 3):
+            res = self.app.get('api/v1/bookmarks?per_page=100',
+                               headers=[self.user1])
+            self.assertEqual(3, len(get_json(res)))
+            self.assertEqual('4', res.headers['X-Total-Count'])
+
+            res = self.app.get('api/v1/bookmarks?per_page=0',
+                               headers=[self.user1])
+            self.assertEqual(HTTPStatus.BAD_REQUEST, res.status_code)
+
+    @single_user
+    def test_paginate_without_total(self):
+        for i in range(5):
+            self.add_bookmark({'url': 'http://example.com/{}'.format(i)})
+        expected = get_json(self.app.get('/api/v1/bookmarks',
+                                         headers=[self.user1]))
+
+        result = []
+        url = '/api/v1/bookmarks?per_page=2&include_total=false'
+        with patch.object(sqlalchemy.orm.Query, 'count',
+                          side_effect=AssertionError('count() called')):
+            while url:
+                res = self.app.get(url, headers=[self.user1])
+                self.assertEqual(HTTPStatus.OK, res.status_code)
+                self.assertNotIn('X-Total-Count', res.headers)
+                links = self.get_links(res)
+                self.assertNotIn('last', links)
+                result += get_json(res)
+                url = links.get('next')
+
+        self.assertEqual(expected, result)
+
+    @single_user
+    def test_get_bookmarks_filters(self):
+        self.add_bookmark({'url': 'http://example.com/1',
+                           'timestamp': '2017-01-01T10:00:00+02:00',
+                           'meta': {'source': 'pocket', 'n': 1}})
+        self.add_bookmark({'url': 'http://example.com/2',
+                           'timestamp': '2017-02-01T10:00:00Z',
+                           'read': '2017-03-01T10:00:00Z',
+                           'meta': {'source': 'web', 'n': 2}})
+        self.add_bookmark({'url': 'http://example.com/3',
+                           'timestamp': '2017-03-01T10:00:00Z',
+                           'read': '2017-04-01T10:00:00Z',
+                           'parent': 2})
+
+        def ids(query):
+            res = self.app.get('/api/v1/bookmarks?' + query,
+                               headers=[self.user1])
+            self.assertEqual(HTTPStatus.OK, res.status_code)
+            return sorted(x['id'] for x in get_json(res))
+
+        self.assertEqual([1], ids('read=false'))
+        self.assertEqual([2, 3], ids('read=true'))
+        self.assertEqual([3], ids('read_after=2017-03-02'))
+        self.assertEqual([2], ids('read_before=2017-04-01T10:00:00Z'))
+        self.assertEqual([1], ids('created_before=2017-01-01T09:00:00Z'))
+        self.assertEqual([2, 3], ids('created_after=2017-01-01T10:00:00Z'))
+        self.assertEqual([2], ids('created_after=2017-01-02'
+                                  '&created_before=2017-03-01'))
+        self.assertEqual([3], ids('parent=2'))
+        self.assertEqual([1, 2], ids('root_only=true'))
+        self.assertEqual([2], ids('meta.source=web'))
+        self.assertEqual([1], ids(urlencode({'meta': '{"n": 1}'})))
+        self.assertEqual([], ids(urlencode({'meta': '{"n": 1}',
+                                            'meta.source': 'web'})))
+
+    @single_user
+    def test_get_bookmarks_invalid_filters(self):
+        for query in ['read=yes', 'read_after=yesterday', 'parent=x',
+                      'meta=[1]', 'meta=x']:
+            res = self.app.get('/api/v1/bookmarks?' + query,
+                               headers=[self.user1])
+            self.assertEqual(HTTPStatus.BAD_REQUEST, res.status_code,
+                             query)
+
+    def get_links(self, res):
+        """Returns dict mapping rel to url of the Link header."""
+        if 'Link' not in res.headers:
+            return {}
+        links = lh.parse(res.headers['Link']).to_py()
+        return {dict(attrs)['rel']: url for url, attrs in links}
+
+    @single_user
+    def test_cursor_pagination_walks_all_bookmarks(self):
+        # Duplicate timestamps and read dates to exercise tiebreakers
+        for i in range(7):
+            read = '2017-02-0{}T13:20:01Z'.format(i % 3 + 1)
+            self.add_bookmark({
+                'url': 'http://example{}.com'.format(i),
+                'timestamp': '2017-02-01T11:12:12Z',
+                'read': read if i % 2 else None,
+            })
+
+        expected = get_json(
+            self.app.get('/api/v1/bookmarks', headers=[self.user1]))
+
+        result = []
+        url = '/api/v1/bookmarks?cursor=&per_page=3'
+        while url:
+            res = self.app.get(url, headers=[self.user1])
+            self.assertEqual(HTTPStatus.OK, res.status_code)
+            self.assertNotIn('X-Total-Count', res.headers)
+            result += get_json(res)
+            last = res
+            url = self.get_links(res).get('next')
+
+        self.assertEqual([x['id'] for x in expected],
+                         [x['id'] for x in result])
+
+        # And back, across the boundary of unread and read bookmarks
+        result = get_json(last)
+        url = self.get_links(last).get('prev')
+        while url:
+            res = self.app.get(url, headers=[self.user1])
+            result = get_json(res) + result
+            url = self.get_links(res).get('prev')
+
+        self.assertEqual([x['id'] for x in expected],
+                         [x['id'] for x in result])
+
+    @single_user
+    def test_cursor_pagination_prev(self):
+        for _ in range(5):
+            self.add_bookmark()
+
+        first = self.app.get('/api/v1/bookmarks?cursor=&per_page=2',
+                             headers=[self.user1])
+        self.assertNotIn('prev', self.get_links(first))
+
+        second = self.app.get(self.get_links(first)['next'],
+                              headers=[self.user1])
+        prev = self.app.get(self.get_links(second)['prev'],
+                            headers=[self.user1])
+
+        self.assertEqual(get_json(first), get_json(prev))
+        self.assertNotIn('prev', self.get_links(prev))
+
+    @single_user
+    def test_cursor_pagination_total(self):
+        for _ in range(5):
+            self.add_bookmark()
+
+        res = self.app.get(
+            '/api/v1/bookmarks?cursor=&per_page=2&include_total=true',
+            headers=[self.user1])
+
+        self.assertEqual('5', res.headers['X-Total-Count'])
+
+    @single_user
+    def test_cursor_pagination_invalid_cursor(self):
+        res = self.app.get('/api/v1/bookmarks?cursor=garbage',
+                           headers=[self.user1])
+
+        self.assertEqual(HTTPStatus.BAD_REQUEST, res.status_code)
+
     @single_user
     def test_delete_does_delete(self):
         res = self.add_bookmark()
@@ -884,6 +1156,55 @@ class ApiTestCase(HeutagogyTestCase):
         self.assertEqual(sorted([]),
                          sorted(get_json(res)))
 
+    @multiple_users
+    def test_get_tags_with_counts(self):
+        self.add_bookmark({'url': 'http://a.com', 'tags': ['git', 'test']})
+        self.add_bookmark({'url': 'http://b.com', 'tags': ['github', 'git']})
+        self.add_bookmark({'url': 'http://c.com', 'tags': ['git']})
+        self.add_bookmark({'url': 'http://d.com', 'tags': ['git']},
+                          user=self.user2)
+
+        res = self.app.get('/api/v1/tags?counts=true', headers=[self.user1])
+
+        self.assertEqual(HTTPStatus.OK, res.status_code)
+        self.assertEqual([
+            {'name': 'git', 'count': 3},
+            {'name': 'github', 'count': 1},
+            {'name': 'test', 'count': 1},
+        ], get_json(res))
+
+    @single_user
+    def test_get_tags_prefix_and_limit(self):
+        self.add_bookmark({'url': 'http://a.com',
+                           'tags': ['git', 'github', 'gitlab', 'g%']})
+        self.add_bookmark({'url': 'http://b.com', 'tags': ['github']})
+
+        res = self.app.get('/api/v1/tags?prefix=git&limit=2',
+                           headers=[self.user1])
+        self.assertEqual(['github', 'git'], get_json(res))
+
+        res = self.app.get('/api/v1/tags?prefix=g%25', headers=[self.user1])
+        self.assertEqual(['g%'], get_json(res))
+
+    @single_user
+    def test_get_tags_follows_updates(self):
+        bookmark_id = get_json(self.add_bookmark({
+            'url': 'http://a.com', 'tags': ['old', 'kept']}))['id']
+        self.add_bookmark({'url': 'http://b.com', 'tags': ['kept']})
+
+        self.app.post(
+            '/api/v1/bookmarks/{}'.format(bookmark_id),
+            content_type='application/json',
+            data=json.dumps({'tags': ['kept', 'new']}),
+            headers=[self.user1])
+        res = self.app.get('/api/v1/tags?counts=true', headers=[self.user1])
+        self.assertEqual([{'name': 'kept', 'count': 2},
+                          {'name': 'new', 'count': 1}], get_json(res))
+
+        self.delete_bookmark(bookmark_id)
+        res = self.app.get('/api/v1/tags?counts=true', headers=[self.user1])
+        self.assertEqual([{'name': 'kept', 'count': 1}], get_json(res))
+
     @single_user
     def test_add_note(self):
         bookmark = {
@@ -1084,6 +1405,253 @@ class ApiTestCase(HeutagogyTestCase):
         self.assertEqual(1, len(r['children']))
         self.assertEqual(child_id, r['children'][0]['id'])
 
+    def add_bookmark_tree(self, depth, width, parent=None):
+        """Adds a tree of bookmarks with a note on every bookmark."""
+        for _ in range(width):
+            bookmark_id = get_json(self.add_bookmark({
+                'url': 'https://github.com',
+                'parent': parent,
+            }))['id']
+            self.add_note(bookmark_id)
+            if depth > 1:
+                self.add_bookmark_tree(depth - 1, width, bookmark_id)
+
+    @single_user
+    def test_get_bookmarks_fields(self):
+        self.add_bookmark_tree(depth=2, width=2)
+
+        statements = []
+
+        def callback(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        self.user1  # authorize outside of measured block
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute',
+                                callback)
+        try:
+            res = self.app.get('/api/v1/bookmarks?fields=id,title,parent',
+                               headers=[self.user1])
+        finally:
+            sqlalchemy.event.remove(db.engine, 'before_cursor_execute',
+                                    callback)
+
+        self.assertEqual(HTTPStatus.OK, res.status_code)
+        bookmarks = get_json(res)
+        self.assertEqual(6, len(bookmarks))
+        self.assertEqual({'id', 'title'}, set(bookmarks[-1]))
+        self.assertEqual({'id', 'title', 'parent'}, set(bookmarks[0]))
+        self.assertFalse(any('bookmark.meta' in x for x in statements))
+        self.assertFalse(any('FROM note' in x for x in statements))
+
+    @single_user
+    def test_get_bookmark_expand(self):
+        self.add_bookmark_tree(depth=3, width=1)
+        url = '/api/v1/bookmarks/1?'
+
+        res = get_json(self.app.get(url + 'expand=children&depth=1',
+                                    headers=[self.user1]))
+        self.assertNotIn('notes', res)
+        self.assertEqual(2, res['children'][0]['id'])
+        self.assertNotIn('children', res['children'][0])
+
+        res = get_json(self.app.get(url + 'expand=notes',
+                                    headers=[self.user1]))
+        self.assertEqual(1, len(res['notes']))
+        self.assertNotIn('children', res)
+
+        res = get_json(self.app.get(url + 'expand=&fields=url',
+                                    headers=[self.user1]))
+        self.assertEqual({'url': 'https://github.com'}, res)
+
+        res = get_json(self.app.get(url + 'fields=id,children',
+                                    headers=[self.user1]))
+        self.assertEqual(
+            {'id': 1, 'children': [{'id': 2, 'children': [{'id': 3}]}]},
+            res)
+
+    @single_user
+    def test_get_bookmarks_fields_cursor(self):
+        for i in range(3):
+            self.add_bookmark({'url': 'http://example.com/{}'.format(i)})
+
+        res = self.app.get('/api/v1/bookmarks?cursor=&per_page=2'
+                           '&fields=url', headers=[self.user1])
+        next_url = self.get_links(res)['next']
+        res = self.app.get(next_url, headers=[self.user1])
+        self.assertEqual([{'url': 'http://example.com/0'}], get_json(res))
+
+    @single_user
+    def test_get_bookmarks_unknown_field(self):
+        for url in ['/api/v1/bookmarks?fields=id,password',
+                    '/api/v1/bookmarks?expand=meta',
+                    '/api/v1/bookmarks?depth=-1']:
+            res = self.app.get(url, headers=[self.user1])
+            self.assertEqual(HTTPStatus.BAD_REQUEST, res.status_code)
+
+    @single_user
+    def test_get_bookmarks_query_count_does_not_grow(self):
+        self.add_bookmark_tree(depth=1, width=1)
+        self.user1  # authorize outside of measured block
+        with count_queries() as small:
+            self.app.get('/api/v1/bookmarks', headers=[self.user1])
+
+        self.add_bookmark_tree(depth=3, width=3)
+        with count_queries() as large:
+            res = self.app.get('/api/v1/bookmarks?per_page=50',
+                               headers=[self.user1])
+
+        self.assertEqual(HTTPStatus.OK, res.status_code)
+        # Bookmark 2 is the root of the large tree
+        root = next(x for x in get_json(res) if x['id'] == 2)
+        self.assertEqual(
+            1, len(root['children'][0]['children'][0]['notes']))
+        self.assertEqual(small[0], large[0])
+        self.assertLessEqual(large[0], 6)
+
+    @single_user
+    def test_get_bookmark_query_count_does_not_grow(self):
+        self.add_bookmark_tree(depth=4, width=3)
+        self.user1  # authorize outside of measured block
+        with count_queries() as count:
+            res = self.get_bookmark(1)
+
+        self.assertEqual(HTTPStatus.OK, res.status_code)
+        self.assertEqual(3, len(get_json(res)['children']))
+        self.assertLessEqual(count[0], 5)
+
+    @single_user
+    def test_json_rendered_in_db_matches_to_dict(self):
+        parent_id = get_json(self.add_bookmark({
+            'url': 'https://example.com/?q="quoted"&b=\\',
+            'title': 'Caf\u00e9 \U0001F600 \u4e2d\u6587 "q" \\ \n\t\x01\x7f',
+            'timestamp': '2017-02-01T11:12:12.123400Z',
+            'read': '2017-02-02T11:12:12Z',
+            'meta': {'z': [1, 2.5, None, True], 'a': {'\u00e9': '\u2028'}},
+            'tags': ['t\u00e4g', 'tag'],
+        }))['id']
+        self.add_note(parent_id, 'n\u00f6te "1"')
+        self.add_note(parent_id, 'note 2')
+        child_id = get_json(self.add_bookmark({
+            'url': 'https://github.com', 'parent': parent_id,
+        }))['id']
+        self.add_bookmark({'url': 'https://github.com', 'parent': child_id})
+        self.add_bookmark({'url': 'https://python.org', 'parent': parent_id})
+        self.add_bookmark({'url': 'https://github.com', 'tags': []})
+
+        rendered = self.assertRenderedInDb('/api/v1/bookmarks')
+        self.assertEqual(5, len(rendered))
+
+        rendered = self.assertRenderedInDb('/api/v1/bookmarks?per_page=1')
+        self.assertEqual(1, len(rendered))
+
+    @single_user
+    def test_json_rendered_in_db_float_meta(self):
+        self.add_bookmark({
+            'url': 'https://example.com',
+            'meta': {'small': 1e-07, 'pi': 3.141592653589793238,
+                     'large': 1.5e+300, 'whole': 2.0, 'int': 10 ** 20,
+                     'other': [-0.001, 5e-324, 123456789.125]},
+        })
+        # Fractions too large to come from Python, which writes them
+        # with exponents that jsonb turns into integers
+        db.session.execute("""
+            INSERT INTO bookmark ("user", url, title, timestamp, meta)
+            SELECT "user", url, title, timestamp,
+                   jsonb_build_array(
+                       33966679592554231.5, 9007199254740993.0,
+                       17976931348623157 * 10::numeric ^ 292 + 0.5)
+              FROM bookmark""")
+        db.session.commit()
+
+        rendered = self.assertRenderedInDb('/api/v1/bookmarks')
+
+        self.assertEqual(
+            [3.396667959255423e+16, 9007199254740992.0,
+             1.7976931348623157e+308], rendered[0]['meta'])
+        self.assertEqual(1e-07, rendered[1]['meta']['small'])
+
+    def assertRenderedInDb(self, url):
+        """Assert that the database renders the bookmark list at url
+        exactly as json.dumps() renders to_dict(): with the same values,
+        keys in the order to_dict() adds them and the same formatting.
+        Returns the parsed list. Parts are compared separately, as dicts
+        don't keep order before Python 3.6."""
+        if not render_json_in_db():
+            self.skipTest('rendering in the database needs PostgreSQL 12+')
+
+        in_db = self.app.get(url, headers=[self.user1])
+        heutagogy.app.config['BOOKMARKS_JSON_IN_DB'] = False
+        try:
+            in_python = self.app.get(url, headers=[self.user1])
+        finally:
+            heutagogy.app.config['BOOKMARKS_JSON_IN_DB'] = True
+
+        self.assertEqual(HTTPStatus.OK, in_db.status_code)
+        self.assertEqual(in_python.headers.get('Link'),
+                         in_db.headers.get('Link'))
+        body = in_db.get_data(as_text=True)
+        rendered = json.loads(body, object_pairs_hook=OrderedDict)
+        self.assertEqual(get_json(in_python), rendered)
+
+        keys = ['id', 'url', 'title', 'timestamp', 'read', 'meta', 'tags',
+                'notes', 'parent', 'children']
+        bookmarks = list(rendered)
+        while bookmarks:
+            bookmark = bookmarks.pop()
+            self.assertEqual([k for k in keys if k in bookmark],
+                             list(bookmark))
+            bookmarks += bookmark.get('children', [])
+
+        self.assertEqual(json.dumps(rendered) + '\n', body)
+        return rendered
+
+    @multiple_users
+    def test_lookup_urls(self):
+        id1 = get_json(self.add_bookmark({'url': 'https://github.com'}))['id']
+        id2 = get_json(self.add_bookmark({'url': 'https://github.com'}))['id']
+        id3 = get_json(self.add_bookmark(
+            {'url': 'https://medium.com/a?utm_source=x'}))['id']
+        self.add_bookmark({'url': 'https://python.org'}, user=self.user2)
+
+        res = self.app.post(
+            '/api/v1/bookmarks/lookup',
+            content_type='application/json',
+            data=json.dumps({'urls': [
+                'https://github.com#readme',
+                'https://medium.com/a',
+                'https://python.org',
+            ]}),
+            headers=[self.user1])
+
+        self.assertEqual(HTTPStatus.OK, res.status_code)
+        self.assertEqual({
+            'https://github.com#readme': [id1, id2],
+            'https://medium.com/a': [id3],
+            'https://python.org': [],
+        }, get_json(res))
+
+    @single_user
+    def test_lookup_urls_requires_list(self):
+        res = self.app.post(
+            '/api/v1/bookmarks/lookup',
+            content_type='application/json',
+            data=json.dumps({'urls': 'https://github.com'}),
+            headers=[self.user1])
+
+        self.assertEqual(HTTPStatus.BAD_REQUEST, res.status_code)
+
+    @single_user
+    def test_long_url(self):
+        url = 'https://example.com/?q=' + 'x' * 10000
+        res = self.add_bookmark({'url': url})
+        self.assertEqual(HTTPStatus.CREATED, res.status_code)
+
+        res = self.app.get(
+            'api/v1/bookmarks?{}'.format(urlencode({'url': url})),
+            headers=[self.user1])
+
+        self.assertEqual(url, get_json(res)[0]['url'])
+
     @single_user
     def test_drop_utm_params(self):
         bookmark = {
@@ -1183,8 +1751,1251 @@ class ApiTestCase(HeutagogyTestCase):
 
         self.assertEqual(HTTPStatus.BAD_REQUEST, res.status_code)
 
+    @single_user
+    def test_reparent_query_count_does_not_grow(self):
+        self.add_bookmark_tree(depth=1, width=1)
+        self.add_bookmark_tree(depth=4, width=3)
+        # 2 -> 3 -> 4 -> 5 is the first branch of the large tree
+        leaf_id = 5
+
+        with count_queries() as small:
+            self.app.post('/api/v1/bookmarks/1',
+                          content_type='application/json',
+                          data=json.dumps({'parent': None}),
+                          headers=[self.user1])
+        with count_queries() as large:
+            res = self.app.post('/api/v1/bookmarks/2',
+                                content_type='application/json',
+                                data=json.dumps({'parent': leaf_id}),
+                                headers=[self.user1])
+
+        self.assertEqual(HTTPStatus.BAD_REQUEST, res.status_code)
+        self.assertLessEqual(large[0], small[0] + 2)
+
+    @single_user
+    def test_get_tree(self):
+        self.add_bookmark_tree(depth=3, width=2)
+
+        with count_queries() as count:
+            res = self.app.get('/api/v1/bookmarks/1/tree?depth=1',
+                               headers=[self.user1])
+
+        self.assertEqual(HTTPStatus.OK, res.status_code)
+        r = get_json(res)
+        self.assertEqual(1, len(r['notes']))
+        self.assertEqual(2, len(r['children']))
+        self.assertEqual(1, len(r['children'][0]['notes']))
+        self.assertNotIn('children', r['children'][0])
+        self.assertLessEqual(count[0], 3)
+
+        res = self.app.get('/api/v1/bookmarks/1/tree', headers=[self.user1])
+        r = get_json(res)
+        self.assertEqual(2, len(r['children'][1]['children']))
+
+    @multiple_users
+    def test_get_tree_of_other_user(self):
+        self.add_bookmark(user=self.user2)
+
+        res = self.app.get('/api/v1/bookmarks/1/tree', headers=[self.user1])
+
+        self.assertEqual(HTTPStatus.NOT_FOUND, res.status_code)
+
+
+class ExportTestCase(HeutagogyTestCase):
+    def export(self, url='/api/v1/export', headers=()):
+        res = self.app.get(url, headers=[self.user1] + list(headers))
+        self.assertEqual(HTTPStatus.OK, res.status_code)
+        self.assertEqual('application/x-ndjson', res.mimetype)
+        return res
+
+    @single_user
+    def test_export(self):
+        parent_id = get_json(self.add_bookmark())['id']
+        self.add_note(parent_id, 'note')
+        for i in range(5):
+            self.add_bookmark({'url': 'http://example.com/{}'.format(i),
+                               'parent': parent_id})
+
+        with patch('heutagogy.views.EXPORT_CHUNK_SIZE', 2):
+            res = self.export()
+
+        lines = res.get_data().decode().splitlines()
+        self.assertEqual(6, len(lines))
+        bookmarks = list(map(json.loads, lines))
+        self.assertEqual(list(range(1, 7)), [x['id'] for x in bookmarks])
+        self.assertEqual('note', bookmarks[0]['notes'][0]['text'])
+        self.assertNotIn('children', bookmarks[0])
+        self.assertEqual(parent_id, bookmarks[5]['parent'])
+        self.assertNotIn('content', bookmarks[0])
+
+    @single_user
+    def test_export_content_gzip(self):
+        bookmark_id = get_json(self.add_bookmark())['id']
+        self.set_content(bookmark_id, 'text')
+
+        res = self.export('/api/v1/export?content=true',
+                          headers=[('Accept-Encoding', 'gzip')])
+
+        self.assertEqual('gzip', res.headers['Content-Encoding'])
+        bookmark = json.loads(gzip.decompress(res.get_data()).decode())
+        self.assertEqual({'html': None, 'text': 'text'}, bookmark['content'])
+
+    @multiple_users
+    def test_export_only_own_bookmarks(self):
+        self.add_bookmark(user=self.user2)
+
+        res = self.export()
+
+        self.assertEqual(b'', res.get_data())
+
+
+class ImportTestCase(HeutagogyTestCase):
+    def import_bookmarks(self, data, content_type, user=None, query=''):
+        return self.app.post('/api/v1/import' + query,
+                             content_type=content_type,
+                             data=data,
+                             headers=[user or self.user1])
+
+    def get_bookmarks(self):
+        res = self.app.get('/api/v1/bookmarks?per_page=100',
+                           headers=[self.user1])
+        return sorted(get_json(res), key=lambda x: x['id'])
+
+    @single_user
+    def test_import_ndjson(self):
+        self.add_bookmark({'url': 'http://github.com'})
+        lines = [
+            {'url': 'http://example.com/?utm_source=x&b=2&a=1',
+             'title': 'Example\ttab\nline \\ "quoted"',
+             'timestamp': '2016-10-01T12:00:00+02:00',
+             'tags': ['a b', 'q"uote\\'],
+             'meta': {'k': 'v'}},
+            {'url': 'http://example.com/?a=1&b=2#fragment'},
+            {'url': 'http://github.com', 'title': 'existing'},
+            {'url': 'http://example.org',
+             'read': '2016-10-02T00:00:00Z'},
+        ]
+        data = '\n'.join(map(json.dumps, lines)) + '\n\n'
+
+        with patch('heutagogy.views.enqueue_fetch_articles') as enqueue:
+            res = self.import_bookmarks(data, 'application/x-ndjson')
+
+        self.assertEqual(HTTPStatus.CREATED, res.status_code)
+        self.assertEqual({'imported': 2, 'skipped': 2, 'dropped': 0},
+                         get_json(res))
+        enqueued = [(b.id, b.url) for call in enqueue.call_args_list
+                    for b in call[0][0]]
+        self.assertEqual([(2, 'http://example.com/?a=1&b=2'),
+                          (3, 'http://example.org')], enqueued)
+
+        bookmarks = self.get_bookmarks()
+        self.assertEqual(3, len(bookmarks))
+        self.assertEqual(lines[0]['title'], bookmarks[1]['title'])
+        self.assertEqual('2016-10-01T10:00:00', bookmarks[1]['timestamp'])
+        self.assertEqual(lines[0]['tags'], bookmarks[1]['tags'])
+        self.assertEqual({'k': 'v'}, bookmarks[1]['meta'])
+        self.assertEqual('http://example.org', bookmarks[2]['title'])
+        self.assertEqual('2016-10-02T00:00:00', bookmarks[2]['read'])
+        self.assertEqual([], bookmarks[2]['tags'])
+
+    @single_user
+    def test_import_drops_notes_and_parents(self):
+        lines = [
+            {'id': 7, 'url': 'http://example.com', 'parent': None,
+             'notes': [{'id': 1, 'text': 'note'}]},
+            {'id': 8, 'url': 'http://example.org', 'parent': 7,
+             'notes': []},
+            {'id': 9, 'url': 'http://example.net', 'parent': None,
+             'notes': []},
+        ]
+        data = '\n'.join(map(json.dumps, lines)) + '\n'
+
+        res = self.import_bookmarks(data, 'application/x-ndjson')
+
+        self.assertEqual({'imported': 3, 'skipped': 0, 'dropped': 2},
+                         get_json(res))
+        bookmarks = self.get_bookmarks()
+        self.assertEqual([1, 2, 3], sorted(x['id'] for x in bookmarks))
+        self.assertEqual([[]] * 3, [x['notes'] for x in bookmarks])
+
+    @single_user
+    def test_import_netscape_html(self):
+        data = """<!DOCTYPE NETSCAPE-Bookmark-file-1>
+<TITLE>Bookmarks</TITLE>
+<DL><p>
+    <DT><H3>Folder</H3>
+    <DL><p>
+        <DT><A HREF="http://example.com/a" ADD_DATE="1475323200"
+            TAGS="x,y">Example &amp; A</A>
+        <DT><A HREF="http://example.com/b">
+    </DL><p>
+</DL>
+"""
+        res = self.import_bookmarks(data, 'text/html')
+
+        self.assertEqual(HTTPStatus.CREATED, res.status_code)
+        bookmarks = self.get_bookmarks()
+        self.assertEqual(['Example & A', 'http://example.com/b'],
+                         [b['title'] for b in bookmarks])
+        self.assertEqual('2016-10-01T12:00:00', bookmarks[0]['timestamp'])
+        self.assertEqual(['x', 'y'], bookmarks[0]['tags'])
+
+    @single_user
+    def test_import_pocket_csv(self):
+        data = ('title,url,time_added,tags,status\n'
+                '"Read, archived",http://example.com/a,1475323200,x|y,'
+                'archive\n'
+                ',http://example.com/b,1475323200,,unread\n')
+
+        res = self.import_bookmarks(data, 'text/csv')
+
+        self.assertEqual(HTTPStatus.CREATED, res.status_code)
+        bookmarks = self.get_bookmarks()
+        self.assertEqual('Read, archived', bookmarks[0]['title'])
+        self.assertEqual('2016-10-01T12:00:00', bookmarks[0]['read'])
+        self.assertEqual(['x', 'y'], bookmarks[0]['tags'])
+        self.assertEqual('http://example.com/b', bookmarks[1]['title'])
+        self.assertIsNone(bookmarks[1]['read'])
+
+    @single_user
+    def test_import_invalid(self):
+        data = '{"url": "http://example.com"}\n{"url": \n'
+
+        res = self.import_bookmarks(data, 'application/x-ndjson')
+
+        self.assertEqual(HTTPStatus.BAD_REQUEST, res.status_code)
+        self.assertEqual({'error': 'invalid JSON on line 2'}, get_json(res))
+        self.assertEqual([], self.get_bookmarks())
+
+        res = self.import_bookmarks(data, 'text/plain')
+        self.assertEqual(HTTPStatus.BAD_REQUEST, res.status_code)
+
+    @single_user
+    def test_import_invalid_fields(self):
+        for line, error in [
+                ('{"url": "http://x.com", "title": 5}',
+                 'title must be a string'),
+                ('{"url": "http://x.com", "timestamp": 1500000000}',
+                 'timestamp must be a string'),
+                ('{"url": "http://x.com", "read": true}',
+                 'read must be a string'),
+                ('{"url": "http://x.com", "read": "yesterday"}',
+                 'invalid read: yesterday'),
+                ('{"url": "http://x.com", "meta": {"x": NaN}}',
+                 'meta must be valid JSON'),
+                ('\n{"url": "http://[x.com"}',
+                 'invalid url on line 2')]:
+            res = self.import_bookmarks(line + '\n', 'application/x-ndjson')
+
+            self.assertEqual(HTTPStatus.BAD_REQUEST, res.status_code, line)
+            self.assertEqual({'error': error}, get_json(res))
+        self.assertEqual([], self.get_bookmarks())
+
+    @multiple_users
+    def test_import_cli(self):
+        self.add_bookmark({'url': 'http://example.com/a'}, user=self.user2)
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson') as f:
+            f.write('{"url": "http://example.com/a"}\n')
+            f.flush()
+
+            info = ScriptInfo(create_app=lambda *args: heutagogy.app)
+            result = CliRunner().invoke(
+                heutagogy.views.import_bookmarks_command,
+                ['random@gmail.com', f.name], obj=info)
+
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertIn('Imported 1 bookmarks, skipped 0', result.output)
+        self.assertEqual(1, len(self.get_bookmarks()))
+
+
+class SyncTestCase(HeutagogyTestCase):
+    def sync(self, token=None, user=None):
+        url = '/api/v1/sync'
+        if token is not None:
+            url += '?' + urlencode({'since': token})
+        res = self.app.get(url, headers=[user or self.user1])
+        self.assertEqual(HTTPStatus.OK, res.status_code)
+        return get_json(res)
+
+    @multiple_users
+    def test_sync(self):
+        first = get_json(self.add_bookmark())['id']
+        second = get_json(self.add_bookmark({'url': 'http://example.com'}))
+        second = second['id']
+        self.add_bookmark({'url': 'http://example.org'}, user=self.user2)
+
+        res = self.sync()
+        self.assertEqual([first, second],
+                         [b['id'] for b in res['bookmarks']])
+        self.assertEqual([], res['deleted'])
+        self.assertFalse(res['more'])
+
+        res = self.sync(res['token'])
+        self.assertEqual([], res['bookmarks'])
+        self.assertEqual([], res['deleted'])
+
+        self.app.post('/api/v1/bookmarks/{}'.format(first),
+                      content_type='application/json',
+                      data=json.dumps({'title': 'changed'}),
+                      headers=[self.user1])
+        res = self.sync(res['token'])
+        self.assertEqual(['changed'], [b['title'] for b in res['bookmarks']])
+
+        self.add_note(second, 'note')
+        res = self.sync(res['token'])
+        self.assertEqual([second], [b['id'] for b in res['bookmarks']])
+        self.assertEqual('note', res['bookmarks'][0]['notes'][0]['text'])
+
+        self.delete_bookmark(first)
+        res = self.sync(res['token'])
+        self.assertEqual([], res['bookmarks'])
+        self.assertEqual([first], res['deleted'])
+
+        res = self.sync(res['token'])
+        self.assertEqual([], res['deleted'])
+
+    @single_user
+    def test_sync_pages(self):
+        for i in range(5):
+            self.add_bookmark({'url': 'http://example.com/{}'.format(i)})
+        token = self.sync()['token']
+        self.delete_bookmark(1)
+        for i in [2, 3, 4]:
+            self.app.post('/api/v1/bookmarks/{}'.format(i),
+                          content_type='application/json',
+                          data=json.dumps({'title': str(i)}),
+                          headers=[self.user1])
+        self.delete_bookmark(5)
+
+        ids, deleted = [], []
+        with patch('heutagogy.views.SYNC_PAGE_SIZE', 2):
+            while True:
+                res = self.sync(token)
+                ids += [b['id'] for b in res['bookmarks']]
+                deleted += res['deleted']
+                token = res['token']
+                if not res['more']:
+                    break
+
+        self.assertEqual([2, 3, 4], ids)
+        self.assertEqual([1, 5], deleted)
+
+    @single_user
+    def test_sync_malformed_token(self):
+        res = self.app.get('/api/v1/sync?since=garbage',
+                           headers=[self.user1])
+        self.assertEqual(HTTPStatus.BAD_REQUEST, res.status_code)
+
+
+class ETagTestCase(HeutagogyTestCase):
+    def get(self, url, etag=None, user=None):
+        headers = [user or self.user1]
+        if etag is not None:
+            headers.append(('If-None-Match', etag))
+        return self.app.get(url, headers=headers)
+
+    def assertNotModified(self, url, etag, max_queries=1):
+        with count_queries() as queries:
+            res = self.get(url, etag)
+        self.assertEqual(HTTPStatus.NOT_MODIFIED, res.status_code)
+        self.assertEqual(b'', res.get_data())
+        self.assertEqual(etag, res.headers['ETag'])
+        # The user, versions of libraries are in redis
+        self.assertLessEqual(queries[0], max_queries)
+
+    @single_user
+    def test_etag(self):
+        id = get_json(self.add_bookmark({'url': 'http://github.com',
+                                         'tags': ['a']}))['id']
+
+        for url in ['/api/v1/bookmarks',
+                    '/api/v1/bookmarks?cursor=',
+                    '/api/v1/bookmarks/{}'.format(id),
+                    '/api/v1/tags']:
+            res = self.get(url)
+            self.assertEqual(HTTPStatus.OK, res.status_code)
+            etag = res.headers['ETag']
+            self.assertNotModified(url, etag)
+
+            self.add_note(id, 'note')
+
+            res = self.get(url, etag)
+            self.assertEqual(HTTPStatus.OK, res.status_code)
+            self.assertNotEqual(etag, res.headers['ETag'])
+
+    @single_user
+    def test_etag_depends_on_request(self):
+        self.add_bookmark()
+        etag = self.get('/api/v1/bookmarks').headers['ETag']
+
+        res = self.get('/api/v1/bookmarks?tag=x', etag)
+
+        self.assertEqual(HTTPStatus.OK, res.status_code)
+
+    @single_user
+    def test_etag_content(self):
+        id = get_json(self.add_bookmark())['id']
+        url = '/api/v1/bookmarks/{}/content'.format(id)
+        etag = self.get(url).headers['ETag']
+        # and the version of the bookmark
+        self.assertNotModified(url, etag, max_queries=2)
+
+        self.set_content(id, 'text')
+
+        res = self.get(url, etag)
+        self.assertEqual(HTTPStatus.OK, res.status_code)
+        self.assertEqual('text', get_json(res)['text'])
+
+        res = self.get('/api/v1/bookmarks/1000/content', etag)
+        self.assertEqual(HTTPStatus.NOT_FOUND, res.status_code)
+
+    @multiple_users
+    def test_etag_after_delete(self):
+        self.add_bookmark()
+        id = get_json(self.add_bookmark({'url': 'http://example.com'}))['id']
+        etag = self.get('/api/v1/bookmarks').headers['ETag']
+        self.assertNotModified('/api/v1/bookmarks', etag)
+
+        self.delete_bookmark(id)
+
+        res = self.get('/api/v1/bookmarks', etag)
+        self.assertEqual(HTTPStatus.OK, res.status_code)
+        res = self.get('/api/v1/bookmarks', etag, user=self.user2)
+        self.assertEqual(HTTPStatus.OK, res.status_code)
+
+
+class CacheTestCase(HeutagogyTestCase):
+    def setUp(self):
+        super().setUp()
+        heutagogy.app.config['RESPONSE_CACHE_TTL'] = 60
+        # User ids are reused between tests
+        self.flush()
+
+    def tearDown(self):
+        self.flush()
+        super().tearDown()
+
+    def flush(self):
+        for key in redis_db.scan_iter('heutagogy:*'):
+            redis_db.delete(key)
+
+    def get(self, url):
+        res = self.app.get(url, headers=[self.user1])
+        self.assertEqual(HTTPStatus.OK, res.status_code)
+        return res
+
+    @single_user
+    def test_cache(self):
+        id = get_json(self.add_bookmark({'url': 'http://github.com',
+                                         'tags': ['a']}))['id']
+
+        for url in ['/api/v1/bookmarks', '/api/v1/bookmarks?cursor=',
+                    '/api/v1/tags', '/api/v1/tags?counts=true']:
+            expected = self.get(url).get_data()
+            with count_queries() as queries:
+                res = self.get(url)
+            self.assertEqual(expected, res.get_data())
+            # The user, the version for the ETag is in redis
+            self.assertEqual(1, queries[0])
+
+        self.assertEqual({'hit': 2, 'miss': 2},
+                         heutagogy.cache.metrics()['bookmarks'])
+        self.assertEqual({'hit': 2, 'miss': 2},
+                         heutagogy.cache.metrics()['tags'])
+
+        self.app.post('/api/v1/bookmarks/{}'.format(id),
+                      content_type='application/json',
+                      data=json.dumps({'tags': ['b']}),
+                      headers=[self.user1])
+
+        self.assertEqual(['b'], get_json(self.get('/api/v1/tags')))
+        res = self.get('/api/v1/bookmarks')
+        self.assertEqual(['b'], get_json(res)[0]['tags'])
+        self.assertEqual(res.headers['ETag'],
+                         self.get('/api/v1/bookmarks').headers['ETag'])
+
+    @single_user
+    def test_cache_and_etag_share_version(self):
+        id = get_json(self.add_bookmark())['id']
+        res = self.get('/api/v1/bookmarks')
+
+        # Committed, but the version is not bumped yet
+        persistence.Bookmark.query.get(id).title = 'changed'
+        db.session.commit()
+        stale = self.get('/api/v1/bookmarks')
+        self.assertEqual(res.get_data(), stale.get_data())
+        self.assertEqual(res.headers['ETag'], stale.headers['ETag'])
+
+        heutagogy.cache.bump_version(1)
+        fresh = self.get('/api/v1/bookmarks')
+        self.assertEqual('changed', get_json(fresh)[0]['title'])
+        self.assertNotEqual(res.headers['ETag'], fresh.headers['ETag'])
+
+    @single_user
+    def test_evicted_version(self):
+        self.add_bookmark()
+        etag = self.get('/api/v1/bookmarks').headers['ETag']
+
+        # A lost version doesn't start over, so it doesn't repeat
+        # versions clients have seen
+        redis_db.delete(heutagogy.cache.version_key(1))
+        res = self.get('/api/v1/bookmarks')
+        self.assertNotEqual(etag, res.headers['ETag'])
+        redis_db.delete(heutagogy.cache.version_key(1))
+        heutagogy.cache.bump_version(1)
+        res = self.get('/api/v1/bookmarks')
+        self.assertNotEqual(etag, res.headers['ETag'])
+
+    @single_user
+    def test_cache_notes(self):
+        id = get_json(self.add_bookmark())['id']
+        self.get('/api/v1/bookmarks')
+
+        note_id = get_json(self.add_note(id, 'note'))['id']
+        res = self.get('/api/v1/bookmarks')
+        self.assertEqual('note', get_json(res)[0]['notes'][0]['text'])
+
+        self.app.delete('/api/v1/notes/{}'.format(note_id),
+                        headers=[self.user1])
+        res = self.get('/api/v1/bookmarks')
+        self.assertEqual([], get_json(res)[0]['notes'])
+
+    @single_user
+    def test_cache_user_stats(self):
+        id = get_json(self.add_bookmark())['id']
+        self.assertEqual(0, get_json(self.get('/api/v1/stats'))['user_read'])
+
+        self.app.post('/api/v1/bookmarks/{}'.format(id),
+                      content_type='application/json',
+                      data=json.dumps({'read': datetime.now().isoformat()}),
+                      headers=[self.user1])
+
+        self.assertEqual(1, get_json(self.get('/api/v1/stats'))['user_read'])
+        self.assertEqual(1, get_json(self.get('/api/v1/stats'))['user_read'])
+        self.assertEqual({'hit': 1, 'miss': 2},
+                         heutagogy.cache.metrics()['stats'])
+
+
+class IdentityCacheTestCase(HeutagogyTestCase):
+    def setUp(self):
+        super().setUp()
+        heutagogy.app.config['IDENTITY_CACHE_TTL'] = 60
+        # User ids are reused between tests
+        identity_cache.clear()
+        auth.google_user_cache.clear()
+
+    def tearDown(self):
+        identity_cache.clear()
+        auth.google_user_cache.clear()
+        super().tearDown()
+
+    def count_queries(self, user=None):
+        user = user or self.user1
+        with count_queries() as queries:
+            res = self.app.get('/api/v1/bookmarks', headers=[user])
+        self.assertEqual(HTTPStatus.OK, res.status_code)
+        return queries[0]
+
+    @single_user
+    def test_cached_identity(self):
+        uncached = self.count_queries()
+        self.assertEqual(uncached - 1, self.count_queries())
+
+    @single_user
+    def test_invalidate_identity(self):
+        uncached = self.count_queries()
+
+        user = User.query.filter_by(username='user1').one()
+        user.username = 'user3'
+        db.session.commit()
+        flask_user.signals.user_changed_username.send(heutagogy.app,
+                                                      user=user)
+        # Don't serve the user from the identity map of the session
+        db.session.remove()
+        self.assertEqual(uncached, self.count_queries())
+
+        user = User.query.filter_by(username='user3').one()
+        user.set_password('password3')
+        db.session.commit()
+        db.session.remove()
+        self.assertEqual(uncached, self.count_queries())
+
+    @multiple_users
+    def test_cache_size(self):
+        heutagogy.app.config['IDENTITY_CACHE_SIZE'] = 1
+        try:
+            uncached = self.count_queries()
+            self.count_queries(self.user2)
+            self.assertEqual(uncached, self.count_queries())
+        finally:
+            heutagogy.app.config['IDENTITY_CACHE_SIZE'] = 1000
+
+    @single_user
+    def test_decode_once(self):
+        self.add_bookmark()
+        with patch.object(jwt, 'jwt_decode_callback',
+                          wraps=jwt.jwt_decode_callback) as decode:
+            self.count_queries()
+        self.assertEqual(1, decode.call_count)
+
+
+class StubCertRequest(object):
+    """Serves certificates in place of Google."""
+
+    class Response(object):
+        def __init__(self, status, headers, data):
+            self.status = status
+            self.headers = headers
+            self.data = data
+
+    def __init__(self, status=HTTPStatus.OK, headers={}):
+        self.status = status
+        self.headers = headers
+        self.urls = []
+
+    def __call__(self, url, method='GET', **kwargs):
+        self.urls.append(url)
+        return self.Response(self.status, self.headers,
+                             json.dumps({'key': 'certificate'}).encode())
+
+
+class GoogleLoginTestCase(HeutagogyTestCase):
+    def setUp(self):
+        super().setUp()
+        heutagogy.app.config['IDENTITY_CACHE_TTL'] = 60
+        auth.google_user_cache.clear()
+
+    def tearDown(self):
+        auth.google_user_cache.clear()
+        super().tearDown()
+
+    def test_max_age(self):
+        self.assertEqual(100, auth.max_age(
+            {'Cache-Control': 'public, max-age=100, must-revalidate'}))
+        self.assertEqual(60, auth.max_age(
+            {'Cache-Control': 'max-age=100', 'Age': '40'}))
+        self.assertEqual(0, auth.max_age(
+            {'Cache-Control': 'max-age=100', 'Age': '140'}))
+        self.assertEqual(0, auth.max_age(
+            {'Cache-Control': 'no-cache, max-age=100'}))
+        self.assertEqual(0, auth.max_age({}))
+
+    def test_cert_cache(self):
+        request = StubCertRequest(headers={'Cache-Control': 'max-age=100'})
+        certs = auth.CertCache(request)
+        self.assertEqual({'key': 'certificate'}, certs.get())
+        self.assertEqual({'key': 'certificate'}, certs.get())
+        self.assertEqual([heutagogy.app.config['GOOGLE_CERTS_URL']],
+                         request.urls)
+
+        with patch('time.monotonic', return_value=time.monotonic() + 100):
+            certs.get()
+        self.assertEqual(2, len(request.urls))
+
+    def test_cert_cache_uncacheable(self):
+        request = StubCertRequest(headers={'Cache-Control': 'no-store'})
+        certs = auth.CertCache(request)
+        certs.get()
+        certs.get()
+        self.assertEqual(2, len(request.urls))
+
+    def test_cert_cache_error(self):
+        certs = auth.CertCache(StubCertRequest(HTTPStatus.BAD_GATEWAY))
+        with self.assertRaises(google.auth.exceptions.TransportError):
+            certs.get()
+
+    def login(self):
+        res = self.app.post('/api/v1/login',
+                            content_type='application/json',
+                            data=json.dumps({'id_token': 'token'}))
+        self.assertEqual(HTTPStatus.OK, res.status_code)
+
+    def test_login(self):
+        request = StubCertRequest(headers={'Cache-Control': 'max-age=100'})
+        idinfo = {'iss': 'accounts.google.com', 'sub': '42',
+                  'email': 'random@gmail.com'}
+        with patch.object(auth, 'google_certs', auth.CertCache(request)), \
+                patch('google.auth.jwt.decode',
+                      return_value=idinfo) as decode:
+            self.login()
+            self.login()
+            with count_queries() as queries:
+                self.login()
+
+        self.assertEqual(0, queries[0])
+        self.assertEqual(1, len(request.urls))
+        decode.assert_called_with(
+            'token', certs={'key': 'certificate'},
+            audience=heutagogy.app.config['GOOGLE_CLIENT_ID'])
+        self.assertEqual(1, User.query.filter_by(google_id='42').count())
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """Pages for fetcher tests. Counts requests in flight on the
+    server."""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.paths.append(self.path)
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            self.respond()
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def respond(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if path == '/missing':
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+
+        if path == '/slow':
+            time.sleep(1)
+        elif path == '/busy':
+            time.sleep(0.1)
+
+        body = b'<html><head><title>Stub page</title></head><body>' + \
+            b'<p>' + b'Some text of the stub page. ' * 20 + b'</p>' + \
+            b'</body></html>'
+        if path == '/large':
+            body *= 100
+
+        etag = '"stub"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.end_headers()
+            return
+
+        content_type = 'text/html; charset=utf-8'
+        if path == '/bogus-charset':
+            content_type = 'text/html; charset=utf8mb4'
+        elif path == '/meta-charset':
+            # UTF-8 declared only in the page
+            content_type = 'text/html'
+            body = '<html><head><meta charset="utf-8"><title>Caf\u00e9' \
+                '</title></head><body></body></html>'.encode()
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', content_type)
+        self.send_header('ETag', etag)
+        if path != '/large':
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.lock = threading.Lock()
+        self.paths = []
+        self.active = 0
+        self.max_active = 0
+
+    def handle_error(self, request, client_address):
+        # Fetcher drops connections of large and slow pages
+        pass
+
+
+class FetcherTestCase(HeutagogyTestCase):
+    def setUp(self):
+        super().setUp()
+        redis_db.delete(heutagogy.article.OPENED_KEY)
+        self.server = StubServer()
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+
+    def url(self, path, host='127.0.0.1'):
+        return 'http://{}:{}{}'.format(host, self.server.server_port, path)
+
+    def fetch_all(self, urls, **kwargs):
+        fetcher = Fetcher(read_timeout=0.5, max_bytes=10000, **kwargs)
+        return {url: (page, error)
+                for url, page, error in fetcher.fetch_all(urls)}
+
+    def test_fetch_all(self):
+        urls = [self.url(p) for p in ['/', '/missing', '/large', '/slow',
+                                      '/bogus-charset', '/meta-charset']]
+        result = self.fetch_all(urls)
+
+        for path in ['/', '/bogus-charset']:
+            page, error = result[self.url(path)]
+            self.assertIsNone(error)
+            self.assertEqual(HTTPStatus.OK, page.status)
+            self.assertIn('<title>Stub page</title>', page.html)
+
+        page, error = result[self.url('/meta-charset')]
+        self.assertIsNone(error)
+        self.assertIn('<title>Caf\u00e9</title>', page.html)
+
+        self.assertIsInstance(result[self.url('/missing')][1], FetchError)
+        self.assertIsInstance(result[self.url('/large')][1], FetchError)
+        self.assertIsInstance(result[self.url('/slow')][1],
+                              requests.exceptions.Timeout)
+
+    def test_per_host_limit(self):
+        urls = [self.url('/busy?{}'.format(i)) for i in range(6)]
+        self.fetch_all(urls, workers=8, per_host=2)
+        self.assertEqual(2, self.server.max_active)
+
+        # Other hosts don't wait
+        urls += [self.url('/busy?{}'.format(i), host='localhost')
+                 for i in range(6)]
+        self.fetch_all(urls, workers=8, per_host=2)
+        self.assertEqual(4, self.server.max_active)
+
+    def test_fetch_and_parse(self):
+        urls = [self.url('/?{}'.format(i)) for i in range(4)] + \
+            [self.url('/missing')]
+        fetcher = Fetcher(read_timeout=0.5)
+        for parsers in [1, 3]:
+            result = dict(heutagogy.article.fetch_and_parse(
+                urls, fetcher=fetcher, parsers=parsers))
+            self.assertEqual(set(urls[:4]), set(result))
+            for content in result.values():
+                self.assertEqual('Stub page', content['title'])
+                self.assertIn('Some text of the stub page.', content['text'])
+
+    @single_user
+    def test_fetch_articles(self):
+        url = self.url('/')
+        id = get_json(self.add_bookmark({'url': url}))['id']
+        missing_id = get_json(
+            self.add_bookmark({'url': self.url('/missing')}))['id']
+
+        with count_queries() as queries:
+            heutagogy.article.fetch_articles(
+                [(id, url), (missing_id, self.url('/missing'))])
+        # Pages are looked up, then stored and linked in one batch
+        self.assertEqual(4, queries[0])
+
+        res = self.app.get('/api/v1/bookmarks/{}/content'.format(id),
+                           headers=[self.user1])
+        self.assertIn('Some text of the stub page.', get_json(res)['text'])
+        self.assertEqual('Stub page', get_json(self.get_bookmark(id))['title'])
+
+        res = self.app.get('/api/v1/bookmarks/{}/content'.format(missing_id),
+                           headers=[self.user1])
+        self.assertIsNone(get_json(res)['text'])
+
+    def content(self, id, user):
+        res = self.app.get('/api/v1/bookmarks/{}/content'.format(id),
+                           headers=[user])
+        return get_json(res)['text']
+
+    @multiple_users
+    def test_shared_page(self):
+        url = self.url('/')
+        id1 = get_json(self.add_bookmark({'url': url}))['id']
+        id2 = get_json(self.add_bookmark({'url': url}, user=self.user2))['id']
+
+        heutagogy.article.fetch_articles([(id1, url)])
+        heutagogy.article.fetch_articles([(id2, url)])
+
+        self.assertEqual(['/'], self.server.paths)
+        self.assertEqual(1, persistence.Page.query.count())
+        self.assertIn('Some text of the stub page.',
+                      self.content(id2, self.user2))
+        self.assertEqual(self.content(id1, self.user1),
+                         self.content(id2, self.user2))
+
+        # A stale page is fetched again
+        heutagogy.app.config['PAGE_MAX_AGE'] = 0
+        try:
+            heutagogy.article.fetch_articles([(id2, url)])
+        finally:
+            heutagogy.app.config['PAGE_MAX_AGE'] = 7 * 24 * 3600
+        self.assertEqual(['/', '/'], self.server.paths)
+        self.assertEqual(1, persistence.Page.query.count())
+
+    @multiple_users
+    def test_stale_page_linked_when_refetch_fails(self):
+        url = self.url('/missing')
+        persistence.store_page(url, 'Missing', None, 'Old text')
+        db.session.commit()
+        id1 = get_json(self.add_bookmark({'url': url}))['id']
+        id2 = get_json(self.add_bookmark({'url': url}, user=self.user2))['id']
+
+        heutagogy.app.config['PAGE_MAX_AGE'] = 0
+        lock = redis_db.lock(heutagogy.article.lock_key(url))
+        try:
+            heutagogy.article.fetch_articles([(id1, url)])
+
+            # Another job is fetching the url
+            self.assertTrue(lock.acquire(blocking=False))
+            persistence.Bookmark.query.get(id2).page_id = None
+            db.session.commit()
+            heutagogy.article.fetch_articles([(id2, url)])
+        finally:
+            lock.release()
+            heutagogy.app.config['PAGE_MAX_AGE'] = 7 * 24 * 3600
+
+        self.assertEqual(['/missing'], self.server.paths)
+        self.assertEqual('Old text', self.content(id1, self.user1))
+        self.assertEqual('Old text', self.content(id2, self.user2))
+
+    @single_user
+    def test_conditional_refresh(self):
+        url = self.url('/')
+        id = get_json(self.add_bookmark({'url': url}))['id']
+        heutagogy.article.fetch_articles([(id, url)])
+        page = persistence.Page.query.one()
+        self.assertEqual('"stub"', page.etag)
+        fetched_at = page.fetched_at
+        page.content_text = 'Old text'
+        db.session.commit()
+
+        heutagogy.app.config['PAGE_MAX_AGE'] = 0
+        try:
+            # Not modified, only fetched_at changes
+            heutagogy.article.fetch_articles([(id, url)])
+            self.assertEqual('Old text', self.content(id, self.user1))
+            page = persistence.Page.query.one()
+            self.assertGreater(page.fetched_at, fetched_at)
+
+            page.etag = None
+            db.session.commit()
+            heutagogy.article.fetch_articles([(id, url)])
+        finally:
+            heutagogy.app.config['PAGE_MAX_AGE'] = 7 * 24 * 3600
+        self.assertEqual(['/', '/', '/'], self.server.paths)
+        self.assertIn('Some text of the stub page.',
+                      self.content(id, self.user1))
+
+    @single_user
+    def test_refresh_pages(self):
+        ids = {}
+        for path in ['/a', '/b', '/c']:
+            url = self.url(path)
+            ids[path] = get_json(self.add_bookmark({'url': url}))['id']
+            heutagogy.article.fetch_articles([(ids[path], url)])
+        self.content(ids['/b'], self.user1)
+        heutagogy.article.flush_opens()
+        # Pages without bookmarks are not refreshed
+        self.app.delete('/api/v1/bookmarks/{}'.format(ids['/c']),
+                        headers=[self.user1])
+
+        self.assertEqual([], persistence.stale_pages(3600, 10))
+        self.assertEqual([self.url('/b'), self.url('/a')],
+                         persistence.stale_pages(0, 10))
+
+        heutagogy.app.config['PAGE_MAX_AGE'] = 0
+        try:
+            with patch('heutagogy.jobs.enqueue_bulk') as enqueue:
+                info = ScriptInfo(create_app=lambda *args: heutagogy.app)
+                result = CliRunner().invoke(
+                    heutagogy.views.refresh_pages_command,
+                    ['--limit', '1'], obj=info)
+        finally:
+            heutagogy.app.config['PAGE_MAX_AGE'] = 7 * 24 * 3600
+
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertIn('Enqueued 1 pages', result.output)
+        enqueue.assert_called_once_with(jobs.REFRESH_OWNER,
+                                        heutagogy.article.fetch_urls,
+                                        [self.url('/b')])
+
+    @multiple_users
+    def test_coalesce_fetches(self):
+        url = self.url('/')
+        id1 = get_json(self.add_bookmark({'url': url}))['id']
+
+        # Another job is fetching the url
+        lock = redis_db.lock(heutagogy.article.lock_key(url), timeout=60)
+        self.assertTrue(lock.acquire(blocking=False))
+        try:
+            heutagogy.article.fetch_articles([(id1, url)])
+            self.assertEqual([], self.server.paths)
+        finally:
+            lock.release()
+
+        # Its bookmarks are linked by the job that holds the lock
+        id2 = get_json(self.add_bookmark({'url': url}, user=self.user2))['id']
+        heutagogy.article.fetch_articles([(id2, url)])
+        self.assertEqual(['/'], self.server.paths)
+        self.assertIn('Some text of the stub page.',
+                      self.content(id1, self.user1))
+        self.assertEqual('Stub page',
+                         get_json(self.get_bookmark(id1))['title'])
+
+
+class JobsTestCase(HeutagogyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.clear()
+
+    def tearDown(self):
+        self.clear()
+        super().tearDown()
+
+    def clear(self):
+        high_q.empty()
+        low_q.empty()
+        for key in redis_db.scan_iter('heutagogy:bulk*'):
+            redis_db.delete(key)
+        redis_db.delete(jobs.METRICS_KEY)
+
+    @single_user
+    def test_interactive_and_bulk(self):
+        self.add_bookmark()
+        self.assertEqual((1, 0), (high_q.count, low_q.count))
+
+        urls = [{'url': 'https://github.com/{}'.format(i)} for i in range(11)]
+        self.app.post('/api/v1/bookmarks',
+                      content_type='application/json',
+                      data=json.dumps(urls),
+                      headers=[self.user1])
+        self.assertEqual((1, 1), (high_q.count, low_q.count))
+
+        # Imports are bulk, however small
+        self.app.post('/api/v1/import',
+                      content_type='application/x-ndjson',
+                      data='{"url": "http://example.com"}\n',
+                      headers=[self.user1])
+        self.assertEqual((1, 2), (high_q.count, low_q.count))
+
+    def test_round_robin(self):
+        heutagogy.app.config['FETCH_BATCH_SIZE'] = 2
+        try:
+            jobs.enqueue_bulk(1, heutagogy.article.fetch_urls,
+                              ['a1', 'a2', 'a3', 'a4', 'a5'])
+            jobs.enqueue_bulk(2, heutagogy.article.fetch_urls, ['b1'])
+            jobs.enqueue_bulk(3, heutagogy.article.fetch_urls, ['c1', 'c2'])
+        finally:
+            heutagogy.app.config['FETCH_BATCH_SIZE'] = 100
+        self.assertEqual(5, low_q.count)
+
+        taken = []
+        batch = jobs.take('test')
+        while batch is not None:
+            taken.append(batch['items'])
+            batch = jobs.take('test')
+        self.assertEqual([['a1', 'a2'], ['b1'], ['c1', 'c2'],
+                          ['a3', 'a4'], ['a5']], taken)
+
+    def test_timeout(self):
+        jobs.enqueue(heutagogy.article.fetch_urls, ['a1'])
+        jobs.enqueue_bulk(1, heutagogy.article.fetch_urls, ['b1'])
+        # 50 rounds of 2 urls, each download up to 5 + 30 seconds
+        self.assertEqual(50 * 35 + jobs.JOB_TIMEOUT_MARGIN,
+                         jobs.job_timeout())
+        for job in high_q.jobs + low_q.jobs:
+            self.assertEqual(jobs.job_timeout(), job.timeout)
+
+    def test_failed_bulk_batch_is_retried(self):
+        jobs.enqueue_bulk(1, int, ['a1'])
+        for attempt in range(heutagogy.app.config['FETCH_JOB_ATTEMPTS']):
+            self.assertEqual(1, low_q.count)
+            low_q.empty()
+            with self.assertRaises(TypeError):
+                jobs.run_bulk()
+        self.assertEqual(0, low_q.count)
+        self.assertIsNone(jobs.take('test'))
+        self.assertEqual({}, redis_db.hgetall(jobs.RUNNING_KEY))
+
+    def test_lost_bulk_batch_is_recovered(self):
+        jobs.enqueue_bulk(1, heutagogy.article.fetch_urls, ['a1'])
+        batch = jobs.take('dead')
+        low_q.empty()
+        # The job died without finishing the batch, which is kept until
+        # its deadline
+        jobs.recover_lost()
+        self.assertIsNone(jobs.take('test'))
+
+        running = json.loads(redis_db.hget(jobs.RUNNING_KEY, 'dead').decode())
+        running['deadline'] = time.time() - 1
+        redis_db.hset(jobs.RUNNING_KEY, 'dead', json.dumps(running))
+        jobs.recover_lost()
+        self.assertEqual(1, low_q.count)
+        retried = jobs.take('test')
+        self.assertEqual(batch['items'], retried['items'])
+        self.assertEqual(2, retried['attempts'])
+        self.assertEqual([b'test'],
+                         list(redis_db.hgetall(jobs.RUNNING_KEY)))
+
+    def test_metrics(self):
+        jobs.enqueue(heutagogy.article.fetch_urls, ['http://127.0.0.1:1/'])
+        jobs.enqueue_bulk(1, heutagogy.article.fetch_urls,
+                          ['http://127.0.0.1:1/a'])
+        jobs.enqueue_bulk(2, heutagogy.article.fetch_urls,
+                          ['http://127.0.0.1:1/b'])
+
+        metrics = jobs.metrics()
+        self.assertEqual(1, metrics['high']['waiting'])
+        self.assertEqual(2, metrics['low']['waiting'])
+        self.assertEqual(2, metrics['low']['owners'])
+        self.assertGreaterEqual(metrics['low']['oldest'], 0)
+        self.assertEqual(0, metrics['low']['runs'])
+
+        jobs.run_bulk()
+        metrics = jobs.metrics()
+        self.assertEqual(1, metrics['low']['waiting'])
+        self.assertEqual(1, metrics['low']['runs'])
+        self.assertGreaterEqual(metrics['low']['wait'], 0)
+
+        info = ScriptInfo(create_app=lambda *args: heutagogy.app)
+        result = CliRunner().invoke(jobs.queue_metrics_command, obj=info)
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertIn('high: 1 waiting', result.output)
+        self.assertIn('low: 1 waiting from 1 owners', result.output)
+
+
+class SearchTestCase(HeutagogyTestCase):
+    def search(self, terms, user=None, **args):
+        user = user or self.user1
+        return self.app.get(
+            '/api/v1/search?{}'.format(urlencode(dict(args, q=terms))),
+            headers=[user])
+
+    @single_user
+    def test_search_requires_query(self):
+        res = self.app.get('/api/v1/search', headers=[self.user1])
+
+        self.assertEqual(HTTPStatus.BAD_REQUEST, res.status_code)
+
+    @single_user
+    def test_search_title_tags_notes_content(self):
+        title_id = get_json(self.add_bookmark({
+            'url': 'http://a.com', 'title': 'Running databases'}))['id']
+        tag_id = get_json(self.add_bookmark({
+            'url': 'http://b.com', 'tags': ['databases']}))['id']
+        note_id = get_json(self.add_bookmark({'url': 'http://c.com'}))['id']
+        self.add_note(note_id, 'great intro to databases')
+        content_id = get_json(self.add_bookmark({'url': 'http://d.com'}))['id']
+        self.set_content(content_id, 'A long article about a database.')
+        self.add_bookmark({'url': 'http://e.com', 'title': 'Unrelated'})
+
+        res = self.search('database')
+
+        self.assertEqual(HTTPStatus.OK, res.status_code)
+        ids = [x['id'] for x in get_json(res)]
+        self.assertEqual({title_id, tag_id, note_id, content_id}, set(ids))
+        # content has the lowest weight
+        self.assertEqual(content_id, ids[-1])
+
+    @single_user
+    def test_search_follows_note_changes(self):
+        bookmark_id = get_json(self.add_bookmark())['id']
+        note_id = get_json(self.add_note(bookmark_id, 'elephant'))['id']
+        self.assertEqual(1, len(get_json(self.search('elephant'))))
+
+        self.app.delete('/api/v1/notes/{}'.format(note_id),
+                        headers=[self.user1])
+
+        self.assertEqual([], get_json(self.search('elephant')))
+
+    @multiple_users
+    def test_search_shared_page_content(self):
+        id1 = get_json(self.add_bookmark({'url': 'http://a.com'}))['id']
+        id2 = get_json(self.add_bookmark({'url': 'http://a.com'},
+                                         user=self.user2))['id']
+        self.set_content(id1, 'An article about elephants.')
+        updated_at = persistence.Bookmark.query.get(id2).updated_at
+
+        self.set_content(id1, 'An article about giraffes.')
+
+        # Content is indexed on the page, bookmarks are left alone
+        self.assertEqual(updated_at,
+                         persistence.Bookmark.query.get(id2).updated_at)
+        self.assertEqual([], get_json(self.search('elephant')))
+        self.assertEqual([id1], [x['id'] for x in
+                                 get_json(self.search('giraffe'))])
+        self.assertEqual([id2], [x['id'] for x in get_json(
+            self.search('giraffe', user=self.user2))])
+
+    @single_user
+    def test_search_pages(self):
+        for i in range(3):
+            id = get_json(self.add_bookmark(
+                {'url': 'http://{}.com'.format(i)}))['id']
+            # Matches both in content and in the title
+            self.add_note(id, 'elephant')
+            self.set_content(id, 'An article about elephants.')
+
+        res = self.search('elephant', per_page=2)
+        self.assertEqual(2, len(get_json(res)))
+        links = lh.parse(res.headers['Link']).to_py()
+        self.assertEqual(['next'], [dict(attrs)['rel'] for _, attrs in links])
+
+        res = self.search('elephant', per_page=2, page=2)
+        self.assertEqual(1, len(get_json(res)))
+        self.assertNotIn('Link', res.headers)
+
+        res = self.search('elephant', page=0)
+        self.assertEqual(HTTPStatus.BAD_REQUEST, res.status_code)
+
+    @multiple_users
+    def test_search_only_own_bookmarks(self):
+        self.add_bookmark({'url': 'http://a.com', 'title': 'Elephant'},
+                          user=self.user2)
+
+        self.assertEqual([], get_json(self.search('elephant')))
+
 
 class StatsTestCase(HeutagogyTestCase):
+    def tearDown(self):
+        redis_db.delete(STATS_CACHE_KEY)
+        super().tearDown()
+
+    @single_user
+    def test_global_stats_are_cached(self):
+        heutagogy.app.config['STATS_MAX_AGE'] = 60
+        res = self.app.get('/api/v1/stats')
+        self.assertEqual(0, get_json(res)['total_read'])
+
+        self.add_bookmark({
+            'url': 'https://github.com',
+            'read': datetime.now().isoformat(),
+        })
+
+        res = self.app.get('/api/v1/stats')
+        self.assertEqual(0, get_json(res)['total_read'])
+
+        res = self.app.get('/api/v1/stats', headers=[self.user1])
+        self.assertEqual(1, get_json(res)['user_read'])
+
+        redis_db.delete(STATS_CACHE_KEY)
+        res = self.app.get('/api/v1/stats')
+        self.assertEqual(1, get_json(res)['total_read'])
+
+    @single_user
+    def test_stale_global_stats_are_recomputed_once(self):
+        heutagogy.app.config['STATS_MAX_AGE'] = 60
+        self.app.get('/api/v1/stats')
+        self.add_bookmark({
+            'url': 'https://github.com',
+            'read': datetime.now().isoformat(),
+        })
+        cached = json.loads(redis_db.get(STATS_CACHE_KEY).decode())
+        cached['computed_at'] -= 60
+        redis_db.set(STATS_CACHE_KEY, json.dumps(cached))
+
+        # Another request is recomputing them
+        redis_db.set(STATS_LOCK_KEY, 1)
+        try:
+            with count_queries() as queries:
+                res = self.app.get('/api/v1/stats')
+        finally:
+            redis_db.delete(STATS_LOCK_KEY)
+        self.assertEqual(0, get_json(res)['total_read'])
+        self.assertEqual(0, queries[0])
+
+        res = self.app.get('/api/v1/stats')
+        self.assertEqual(1, get_json(res)['total_read'])
+        self.assertIsNone(redis_db.get(STATS_LOCK_KEY))
+
     @single_user
     def test_response_is_ok(self):
         res = self.app.get('/api/v1/stats')